@@ -0,0 +1,129 @@
+"""Micro-benchmark of the OpenID auth request extensions and profile
+extraction.
+
+Compares building the AX and SReg requests on every login with adding the
+extensions precompiled by the consumer, the per-attribute lookups previously
+done by ``extract_openid_data`` with the indexed accessor, and validating
+the birthday with ``strptime`` with the regular expression used now.
+
+Run with ``python benchmarks/openid_extensions.py``.
+
+"""
+import datetime
+import timeit
+
+from openid.extensions import ax
+from openid.extensions import sreg
+from openid.message import Message
+from openid.message import OPENID2_NS
+
+from velruse.providers.openid import (
+    attributes,
+    AttribAccess,
+    birthday_re,
+    OpenIDConsumer,
+    sreg_fields,
+)
+
+
+NUMBER = 5000
+
+# the lookups done by extract_openid_data for a non Google identifier
+LOOKUPS = ['nickname', 'email', 'email', 'name_prefix', 'first_name',
+           'middle_name', 'last_name', 'name_suffix', 'full_name', 'web',
+           'gender', 'birthday', 'thumbnail']
+
+
+class DummyAuthRequest(object):
+    def __init__(self):
+        self.message = Message(OPENID2_NS)
+
+    def addExtension(self, ext):
+        ext.toMessage(self.message)
+
+
+def build_extensions(authrequest):
+    ax_request = ax.FetchRequest()
+    for attrib in attributes.values():
+        ax_request.add(ax.AttrInfo(attrib))
+    authrequest.addExtension(ax_request)
+    sreg_request = sreg.SRegRequest(
+        optional=['nickname', 'email', 'fullname', 'dob', 'gender',
+                  'postcode', 'country', 'language', 'timezone'],
+    )
+    authrequest.addExtension(sreg_request)
+
+
+class PerAttributeAccess(object):
+    """The accessor used before the responses were indexed"""
+    def __init__(self, sreg_resp, ax_resp):
+        self.sreg_resp = sreg_resp or {}
+        self.ax_resp = ax_resp or ax.AXKeyValueMessage()
+
+    def get(self, key, ax_only=False):
+        v = self.ax_resp.getSingle(attributes[key])
+        if v:
+            return v
+        if ax_only:
+            return None
+        key = sreg_fields.get(key)
+        if key is None:
+            return None
+        return self.sreg_resp.get(key)
+
+
+def make_responses():
+    ax_resp = ax.FetchResponse()
+    for key in ('email', 'first_name', 'last_name', 'language', 'country'):
+        ax_resp.addValue(attributes[key], '%s value' % key)
+    ax_resp.setValues(attributes['email'], ['jdoe@example.com'])
+    sreg_resp = sreg.SRegResponse(data={
+        'nickname': 'jdoe', 'fullname': 'John Doe', 'gender': 'M',
+        'dob': '1980-01-01', 'timezone': 'Europe/Paris',
+    })
+    return sreg_resp, ax_resp
+
+
+def main():
+    consumer = OpenIDConsumer('openid', 'openid', discovery_cache=False)
+
+    def precompiled():
+        consumer._update_authrequest(None, DummyAuthRequest())
+
+    def per_login():
+        build_extensions(DummyAuthRequest())
+
+    sreg_resp, ax_resp = make_responses()
+
+    def lookups(cls):
+        def run():
+            attribs = cls(sreg_resp, ax_resp)
+            for key in LOOKUPS:
+                attribs.get(key)
+        return run
+
+    def parse_birthday():
+        match = birthday_re.match('1980-01-01')
+        datetime.date(*[int(x) for x in match.groups()]).strftime('%Y-%m-%d')
+
+    def strptime_birthday():
+        datetime.datetime.strptime('1980-01-01', '%Y-%m-%d').date().strftime(
+            '%Y-%m-%d')
+
+    for name, before, after in [
+        ('auth request extensions', per_login, precompiled),
+        ('attribute lookups', lookups(PerAttributeAccess),
+         lookups(AttribAccess)),
+        ('birthday validation', strptime_birthday, parse_birthday),
+    ]:
+        t_before = min(timeit.repeat(before, number=NUMBER, repeat=5))
+        t_after = min(timeit.repeat(after, number=NUMBER, repeat=5))
+        print('%-24s %8.1fus -> %8.1fus (%.1fx)' % (
+            name,
+            t_before / NUMBER * 1e6,
+            t_after / NUMBER * 1e6,
+            t_before / t_after))
+
+
+if __name__ == '__main__':
+    main()
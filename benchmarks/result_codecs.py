@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the codecs used for the results kept in the Velruse store.
+
+Compares the size of the values stored by default, pickled by
+`anykeystore`, with the JSON and MessagePack codecs with and without zlib
+compression, and the time taken to encode and decode them, for typical
+results of several providers.
+
+Run with ``python benchmarks/result_codecs.py``.
+
+"""
+import timeit
+
+from anykeystore.compat import pickle
+
+from velruse.app.codecs import JSONCodec
+from velruse.app.codecs import MsgpackCodec
+
+
+NUMBER = 2000
+
+
+def result(provider_name, provider_type, profile, credentials):
+    return {
+        'provider_name': provider_name,
+        'provider_type': provider_type,
+        'profile': profile,
+        'credentials': credentials,
+    }
+
+
+OAUTH2_CREDENTIALS = {'oauthAccessToken': 'a' * 40}
+OAUTH1_CREDENTIALS = {'oauthAccessToken': 'a' * 50,
+                      'oauthAccessTokenSecret': 's' * 45}
+
+RESULTS = {
+    'facebook': result('facebook', 'facebook', {
+        'accounts': [{'domain': 'facebook.com', 'userid': '100001234567890',
+                      'username': 'john.doe'}],
+        'displayName': 'John Doe',
+        'name': {'formatted': 'John Doe', 'givenName': 'John',
+                 'familyName': 'Doe'},
+        'gender': 'male',
+        'preferredUsername': 'john.doe',
+        'emails': [{'value': 'john.doe@example.com'}],
+        'verifiedEmail': 'john.doe@example.com',
+        'utcOffset': '+0100',
+        'locale': 'en_US',
+        'birthday': '1980-01-01',
+        'photos': [{'value': 'https://graph.facebook.com/100001234567890'
+                             '/picture?type=large'}],
+        'urls': [{'type': 'other',
+                  'value': 'https://www.facebook.com/john.doe'}],
+    }, OAUTH2_CREDENTIALS),
+    'github': result('github', 'github', {
+        'accounts': [{'domain': 'github.com', 'userid': 1234567,
+                      'username': 'jdoe'}],
+        'displayName': 'John Doe',
+        'preferredUsername': 'jdoe',
+        'emails': [{'value': 'john.doe@example.com', 'primary': True},
+                   {'value': 'jdoe@users.noreply.github.com'}],
+        'verifiedEmail': 'john.doe@example.com',
+        'photos': [{'value': 'https://avatars.githubusercontent.com/u/'
+                             '1234567?v=4'}],
+    }, OAUTH2_CREDENTIALS),
+    'twitter': result('twitter', 'twitter', {
+        'accounts': [{'domain': 'twitter.com', 'userid': '123456789',
+                      'username': 'jdoe'}],
+        'displayName': 'jdoe',
+        'preferredUsername': 'jdoe',
+        'name': {'formatted': 'John Doe'},
+        'photos': [{'value': 'https://pbs.twimg.com/profile_images/'
+                             '123456789/abcdef_normal.jpg'}],
+        'addresses': [{'formatted': 'Paris, France'}],
+        'urls': [{'value': 'https://example.com/'}],
+    }, OAUTH1_CREDENTIALS),
+    'google': result('google', 'google_oauth2', {
+        'accounts': [{'domain': 'google.com',
+                      'userid': '109876543210987654321'}],
+        'displayName': 'John Doe',
+        'name': {'givenName': 'John', 'familyName': 'Doe',
+                 'formatted': 'John Doe'},
+        'gender': 'male',
+        'emails': [{'value': 'john.doe@gmail.com', 'primary': True}],
+        'verifiedEmail': 'john.doe@gmail.com',
+        'locale': 'en',
+        'photos': [{'value': 'https://lh3.googleusercontent.com/'
+                             'a-/AOh14Gh' + 'x' * 60}],
+    }, dict(OAUTH2_CREDENTIALS, oauthRefreshToken='r' * 45)),
+    # the raw QQ user info is kept in the ``data`` of the profile
+    'qq': result('qq', 'qq', {
+        'accounts': [{'domain': 'qq.com', 'userid': 'A' * 32}],
+        'displayName': u'张三',
+        'preferredUsername': u'张三',
+        'gender': 'male',
+        'photos': [{'value': 'http://qzapp.qlogo.cn/qzapp/100000000/%s/%d'
+                             % ('A' * 32, size)}
+                   for size in (30, 50, 100)],
+        'data': dict(
+            [('ret', 0), ('msg', ''), ('is_lost', 0),
+             ('nickname', u'张三'), ('gender', u'男'),
+             ('province', u'北京'), ('city', u'海淀'),
+             ('year', '1980'), ('is_yellow_vip', '0'), ('vip', '0'),
+             ('yellow_vip_level', '0'), ('level', '0'),
+             ('is_yellow_year_vip', '0')] +
+            [('figureurl%s' % suffix,
+              'http://qzapp.qlogo.cn/qzapp/100000000/%s/%d'
+              % ('A' * 32, size))
+             for suffix, size in [('', 30), ('_1', 50), ('_2', 100),
+                                  ('_qq_1', 40), ('_qq_2', 100)]]),
+    }, OAUTH2_CREDENTIALS),
+    'denied': {'provider_name': 'github', 'provider_type': 'github',
+               'error': 'denied'},
+}
+
+
+def time_us(func):
+    return min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def main():
+    codecs = [
+        ('pickle', lambda v: pickle.dumps(v, pickle.HIGHEST_PROTOCOL),
+         pickle.loads),
+    ]
+    for name, cls in [('json', JSONCodec), ('msgpack', MsgpackCodec)]:
+        for label, threshold in [('', 0), ('+zlib', 1)]:
+            codec = cls(compress_threshold=threshold)
+            codecs.append((name + label, codec.encode, codec.decode))
+
+    print('%-10s %-14s %6s %10s %10s' % (
+        'provider', 'codec', 'bytes', 'encode', 'decode'))
+    for provider, value in sorted(RESULTS.items()):
+        for name, encode, decode in codecs:
+            data = encode(value)
+            print('%-10s %-14s %6d %8.1fus %8.1fus' % (
+                provider, name, len(data),
+                time_us(lambda: encode(value)),
+                time_us(lambda: decode(data))))
+        print('')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,15 @@ if PY3:
 else:
     requires.append('python-openid')
 
-testing_extras = [
+tokens_extras = [
+    'cryptography',
+]
+
+msgpack_extras = [
+    'msgpack',
+]
+
+testing_extras = tokens_extras + msgpack_extras + [
     'nose',
     'selenium',
     'webtest',
@@ -71,9 +79,14 @@ setup(name='velruse',
       extras_require={
           'docs': docs_extras,
           'testing': testing_extras,
+          'tokens': tokens_extras,
+          'msgpack': msgpack_extras,
       },
       entry_points="""
       [paste.app_factory]
       main = velruse.app:make_app
+
+      [paste.filter_app_factory]
+      middleware = velruse.app.middleware:make_velruse_middleware
       """,
       )
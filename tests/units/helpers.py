@@ -0,0 +1,53 @@
+"""Fixtures shared by the tests of the standalone app"""
+from webtest import TestApp
+
+
+CALLBACK_PATH = '/login/dummy/callback'
+
+
+class DummyProvider(object):
+    def __init__(self, context):
+        self.context = context
+
+    def callback(self, request):
+        return self.context
+
+
+def dummy_context(profile=None, credentials=None, provider_name='dummy'):
+    from velruse import AuthenticationComplete
+    if profile is None:
+        profile = {'displayName': 'jdoe'}
+    return AuthenticationComplete(
+        profile=profile, credentials=credentials or {},
+        provider_name=provider_name, provider_type=provider_name)
+
+
+def make_settings(**settings):
+    """Return the settings of a standalone app updated with ``settings``"""
+    app_settings = {
+        'endpoint': 'http://example.com/logged_in',
+        'session.secret': 'seekrit',
+    }
+    app_settings.update(settings)
+    return app_settings
+
+
+def make_config(provider=None, **settings):
+    """Return a configuration including the standalone app, with the
+    callback of ``provider`` routed at ``CALLBACK_PATH``"""
+    from pyramid.config import Configurator
+    config = Configurator(settings=make_settings(**settings))
+    config.include('velruse.app')
+    if provider is not None:
+        config.add_route('cb', CALLBACK_PATH, factory=provider.callback,
+                         use_global_views=True)
+    return config
+
+
+def make_app(provider=None, **settings):
+    return TestApp(make_config(provider, **settings).make_wsgi_app())
+
+
+def form_token(resp):
+    """Return the token the response POSTs to the endpoint"""
+    return resp.html.find('input', attrs={'name': 'token'})['value']
@@ -0,0 +1,89 @@
+import unittest
+
+from tests.units.helpers import make_app
+
+
+class TestAuthInfoBatch(unittest.TestCase):
+
+    def _makeApp(self, **settings):
+        settings['auth_info.max_batch'] = '3'
+        return make_app(**settings)
+
+    def test_it(self):
+        app = self._makeApp()
+        store = app.app.registry.velruse_store
+        store.store('a', {'provider_name': 'github'})
+        store.store('b', {'error': 'denied'})
+        resp = app.post_json('/auth_info?format=json', ['a', 'b', 'c'])
+        self.assertEqual(resp.json, {
+            'a': {'provider_name': 'github'},
+            'b': {'error': 'denied'},
+            'c': None,
+        })
+
+    def test_single_token_still_supported(self):
+        app = self._makeApp()
+        app.app.registry.velruse_store.store('a', {'provider_name': 'x'})
+        resp = app.get('/auth_info', {'format': 'json', 'token': 'a'})
+        self.assertEqual(resp.json, {'provider_name': 'x'})
+
+    def test_returns_stored_json(self):
+        app = self._makeApp()
+        results = app.app.registry.velruse_results
+        results.store('a', {'provider_name': 'github', 'profile': {}})
+        stored = app.app.registry.velruse_store.retrieve('a')
+        resp = app.get('/auth_info', {'format': 'json', 'token': 'a'})
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.body, stored)
+        resp = app.post_json('/auth_info?format=json', ['a'])
+        self.assertEqual(resp.body, b'{"a":' + stored + b'}')
+        resp = app.get('/auth_info', {'format': 'json', 'token': 'b'},
+                       status=400)
+        self.assertEqual(resp.json, None)
+
+    def test_invalid_batch(self):
+        app = self._makeApp()
+        app.post_json('/auth_info?format=json', ['a', 'b', 'c', 'd'],
+                      status=400)
+        app.post_json('/auth_info?format=json', {'token': 'a'}, status=400)
+        app.post_json('/auth_info?format=json', [1], status=400)
+        app.post('/auth_info?format=json', 'not json', status=400)
+
+    def test_encrypted_tokens(self):
+        app = self._makeApp(**{'delivery': 'token', 'token.secret': 's'})
+        token = app.app.registry.velruse_tokens.encode({'a': 1})
+        resp = app.post_json('/auth_info?format=json', [token, 'bad'])
+        self.assertEqual(resp.json, {token: {'a': 1}, 'bad': None})
+
+
+class TestRetrieveMany(unittest.TestCase):
+
+    def _callFUT(self, storage, keys):
+        from velruse.app.results import retrieve_many
+        return retrieve_many(storage, keys)
+
+    def test_uses_retrieve_many(self):
+        class Storage(object):
+            def retrieve_many(self, keys):
+                return dict((k, k.upper()) for k in keys)
+        self.assertEqual(self._callFUT(Storage(), ['a', 'a']), {'a': 'A'})
+
+    def test_redis_mget(self):
+        from anykeystore.backends.redis import RedisStore
+        from anykeystore.compat import pickle
+
+        class Conn(object):
+            def __init__(self):
+                self.calls = []
+
+            def mget(self, keys):
+                self.calls.append(keys)
+                return [pickle.dumps(k) if k != 'p.b' else None
+                        for k in keys]
+
+        conn = Conn()
+        storage = RedisStore(key_prefix='p.')
+        storage._get_conn = lambda: conn
+        self.assertEqual(self._callFUT(storage, ['a', 'b']),
+                         {'a': 'p.a', 'b': None})
+        self.assertEqual(len(conn.calls), 1)
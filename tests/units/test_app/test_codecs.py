@@ -0,0 +1,103 @@
+import unittest
+
+from tests.units.helpers import make_settings
+
+
+PROFILE = {
+    'provider_name': 'github',
+    'profile': {
+        'accounts': [{'domain': 'github.com', 'userid': 1}],
+        'displayName': u'J\xe9r\xf4me',
+        'emails': [{'value': 'jdoe@example.com'}],
+    },
+    'credentials': {'oauthAccessToken': 'abc'},
+}
+
+
+class TestCodecs(unittest.TestCase):
+
+    def _makeOne(self, name, **kw):
+        from velruse.app.codecs import codecs
+        return codecs[name](**kw)
+
+    def test_json_roundtrip(self):
+        codec = self._makeOne('json')
+        data = codec.encode(PROFILE)
+        self.assertEqual(data[:1], b'r')
+        self.assertEqual(codec.decode(data), PROFILE)
+
+    def test_msgpack_roundtrip(self):
+        codec = self._makeOne('msgpack')
+        data = codec.encode(PROFILE)
+        self.assertEqual(data[:1], b'r')
+        self.assertEqual(codec.decode(data), PROFILE)
+
+    def test_compression(self):
+        codec = self._makeOne('json', compress_threshold=10)
+        data = codec.encode(PROFILE)
+        self.assertEqual(data[:1], b'z')
+        self.assertEqual(codec.decode(data), PROFILE)
+
+    def test_json_bytes(self):
+        codec = self._makeOne('json', compress_threshold=10)
+        data = b'{"a":"' + b'x' * 20 + b'"}'
+        self.assertEqual(codec.decode_json(codec.encode_json(data)), data)
+        codec = self._makeOne('msgpack')
+        self.assertEqual(codec.decode_json(codec.encode_json(data)), data)
+
+    def test_no_compression(self):
+        codec = self._makeOne('json', compress_threshold=0)
+        value = {'data': 'x' * 5000}
+        data = codec.encode(value)
+        self.assertEqual(data[:1], b'r')
+        self.assertEqual(codec.decode(data), value)
+
+
+class TestCodecFromSettings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from velruse.app.codecs import codec_from_settings
+        return codec_from_settings(settings)
+
+    def test_default(self):
+        self.assertEqual(self._callFUT({}), None)
+        self.assertEqual(self._callFUT({'results.codec': 'none'}), None)
+
+    def test_settings(self):
+        from velruse.app.codecs import JSONCodec
+        codec = self._callFUT({
+            'results.codec': 'json',
+            'results.compress_threshold': '100',
+            'results.compress_level': '9',
+        })
+        self.assertTrue(isinstance(codec, JSONCodec))
+        self.assertEqual(codec.compress_threshold, 100)
+        self.assertEqual(codec.compress_level, 9)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._callFUT, {'results.codec': 'xml'})
+
+
+class TestResultStoreCodec(unittest.TestCase):
+
+    def test_encoded_in_backend(self):
+        from anykeystore.backends.memory import MemoryStore
+        from velruse.app.codecs import JSONCodec
+        from velruse.app.results import ResultStore
+        backend = MemoryStore()
+        results = ResultStore(backend, codec=JSONCodec(), sweep_interval=0)
+        results.store('t', PROFILE)
+        self.assertTrue(isinstance(backend.retrieve('t'), bytes))
+        self.assertEqual(results.retrieve('t'), PROFILE)
+        self.assertEqual(results.retrieve_many(['t', 'x']),
+                         {'t': PROFILE, 'x': None})
+        results.consume = True
+        self.assertEqual(results.retrieve('t'), PROFILE)
+        self.assertRaises(KeyError, results.retrieve, 't')
+
+    def test_unknown_codec_setting(self):
+        from pyramid.config import Configurator
+        from pyramid.exceptions import ConfigurationError
+        config = Configurator(
+            settings=make_settings(**{'results.codec': 'xml'}))
+        self.assertRaises(ConfigurationError, config.include, 'velruse.app')
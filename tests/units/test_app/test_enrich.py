@@ -0,0 +1,251 @@
+import unittest
+
+from webtest import TestApp
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import DummyProvider
+from tests.units.helpers import dummy_context
+from tests.units.helpers import form_token
+from tests.units.helpers import make_config
+
+
+class EnrichedProvider(DummyProvider):
+    def __init__(self, context, fail=False):
+        DummyProvider.__init__(self, context)
+        self.fail = fail
+        self.enriched = 0
+
+    def enrich_profile(self, profile, credentials):
+        self.enriched += 1
+        if self.fail:
+            raise ValueError('down')
+        profile = dict(profile, emails=[{'value': credentials['email']}])
+        profile.pop('partial')
+        return profile
+
+
+class TestLazyProfile(unittest.TestCase):
+
+    def _makeApp(self, fail=False, **settings):
+        from velruse.api import register_provider
+        context = dummy_context(
+            profile={'displayName': 'jdoe', 'partial': True},
+            credentials={'email': 'jdoe@example.com'})
+        self.provider = EnrichedProvider(context, fail=fail)
+        config = make_config(self.provider, **settings)
+        register_provider(config, 'dummy', self.provider)
+        app = TestApp(config.make_wsgi_app())
+        return app, form_token(app.get(CALLBACK_PATH))
+
+    def test_partial_by_default(self):
+        app, token = self._makeApp()
+        resp = app.get('/auth_info', {'format': 'json', 'token': token})
+        self.assertEqual(resp.json['profile'],
+                         {'displayName': 'jdoe', 'partial': True})
+        self.assertEqual(self.provider.enriched, 0)
+
+    def test_full_profile(self):
+        app, token = self._makeApp()
+        resp = app.get('/auth_info', {'format': 'json', 'token': token,
+                                      'profile': 'full'})
+        self.assertEqual(resp.json['profile'], {
+            'displayName': 'jdoe',
+            'emails': [{'value': 'jdoe@example.com'}],
+        })
+        resp = app.post_json('/auth_info?format=json&profile=full',
+                             [token, 'missing'])
+        self.assertEqual(resp.json[token]['profile']['emails'],
+                         [{'value': 'jdoe@example.com'}])
+        self.assertEqual(resp.json['missing'], None)
+
+    def test_masked_full_profile(self):
+        app, token = self._makeApp(profile_fields='displayName emails.value')
+        resp = app.get('/auth_info', {'format': 'json', 'token': token,
+                                      'profile': 'full'})
+        self.assertEqual(resp.json['profile'], {
+            'displayName': 'jdoe',
+            'emails': [{'value': 'jdoe@example.com'}],
+        })
+
+    def test_failed_enrichment(self):
+        app, token = self._makeApp(fail=True)
+        resp = app.get('/auth_info', {'format': 'json', 'token': token,
+                                      'profile': 'full'})
+        self.assertEqual(resp.json['profile'],
+                         {'displayName': 'jdoe', 'partial': True})
+        self.assertEqual(self.provider.enriched, 1)
+
+
+class DummyResponse(object):
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.text = data if isinstance(data, str) else ''
+        self.content = self.text
+
+    def json(self):
+        return self.data
+
+
+def DummyHTTP(responses):
+    from velruse.client import HTTPClient
+
+    class DummyHTTP(HTTPClient):
+        def oauth1(self, *args, **kw):
+            return None
+
+        def post(self, url, *args, **kw):
+            return self.get(url)
+
+        def get(self, url, *args, **kw):
+            self.urls.append(url)
+            for prefix, resp in responses.items():
+                if url.startswith(prefix):
+                    if isinstance(resp, Exception):
+                        raise resp
+                    return resp
+            raise AssertionError(url)
+
+    http = DummyHTTP()
+    http.urls = []
+    return http
+
+
+class TestTwitterLazyProfile(unittest.TestCase):
+
+    def _callback(self, lazy_profile, enrichment_cache=None, status=200):
+        from pyramid.testing import DummyRequest
+        from velruse.providers import twitter
+        http = DummyHTTP({
+            twitter.ACCESS_URL: DummyResponse(
+                'oauth_token=t&oauth_token_secret=s&user_id=1'
+                '&screen_name=jdoe'),
+            twitter.DATA_URL % 'jdoe': DummyResponse({'name': 'John Doe'},
+                                                     status),
+        })
+        provider = twitter.TwitterProvider(
+            'twitter', 'key', 'secret', http_client=http,
+            lazy_profile=lazy_profile, enrichment_cache=enrichment_cache)
+        request = DummyRequest(params={'oauth_verifier': 'v'})
+        request.session['velruse.token'] = {
+            'oauth_token': 'rt', 'oauth_token_secret': 'rs'}
+        return provider, http, provider.callback(request)
+
+    def test_eager(self):
+        provider, http, context = self._callback(False)
+        self.assertEqual(len(http.urls), 2)
+        self.assertEqual(context.profile['displayName'], 'John Doe')
+        self.assertFalse('partial' in context.profile)
+
+    def test_degraded(self):
+        provider, http, context = self._callback(False, status=503)
+        self.assertEqual(len(http.urls), 2)
+        self.assertEqual(context.profile['displayName'], 'jdoe')
+        self.assertEqual(context.profile['accounts'][0]['userid'], '1')
+        self.assertTrue(context.profile['partial'])
+
+    def test_lazy(self):
+        provider, http, context = self._callback(True)
+        self.assertEqual(len(http.urls), 1)
+        self.assertEqual(context.profile['displayName'], 'jdoe')
+        self.assertTrue(context.profile['partial'])
+        profile = provider.enrich_profile(context.profile,
+                                          context.credentials)
+        self.assertEqual(len(http.urls), 2)
+        self.assertEqual(profile['displayName'], 'John Doe')
+        self.assertFalse('partial' in profile)
+
+    def test_enrichment_cache(self):
+        from velruse.cache import EnrichmentCache
+        cache = EnrichmentCache()
+        provider, http, context = self._callback(False, cache)
+        self.assertEqual(len(http.urls), 2)
+        provider, http, context = self._callback(False, cache)
+        self.assertEqual(len(http.urls), 1)
+        self.assertEqual(context.profile['displayName'], 'John Doe')
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+
+class DummyState(object):
+    def verify(self, request, provider_name):
+        pass
+
+
+class TestGithubEmails(unittest.TestCase):
+
+    def _callback(self, emails_resp):
+        from pyramid import testing
+        from velruse.providers import github
+        # the emails URL is listed first since the profile URL prefixes it
+        http = DummyHTTP({
+            'https://github.com/login/oauth/access_token': DummyResponse(
+                'access_token=t'),
+            'https://api.github.com/user/emails': emails_resp,
+            'https://api.github.com/user': DummyResponse({
+                'login': 'jdoe', 'id': 1, 'name': 'John Doe',
+                'email': 'public@example.com'}),
+        })
+        provider = github.GithubProvider(
+            'github', 'key', 'secret', None, True, 'github.com',
+            http_client=http, state_manager=DummyState())
+        config = testing.setUp()
+        try:
+            config.add_route(provider.callback_route, '/callback')
+            request = testing.DummyRequest(params={'code': 'c'})
+            return provider.callback(request)
+        finally:
+            testing.tearDown()
+
+    def test_emails(self):
+        context = self._callback(DummyResponse([
+            {'email': 'jdoe@example.com', 'primary': True, 'verified': True},
+        ]))
+        self.assertEqual(context.profile['verifiedEmail'], 'jdoe@example.com')
+        self.assertFalse('partial' in context.profile)
+
+    def test_emails_not_allowed(self):
+        context = self._callback(DummyResponse({}, 404))
+        self.assertEqual(context.profile['emails'],
+                         [{'value': 'public@example.com'}])
+        self.assertFalse('partial' in context.profile)
+
+    def test_failed_emails(self):
+        context = self._callback(ValueError('down'))
+        self.assertEqual(context.profile['displayName'], 'John Doe')
+        self.assertEqual(context.profile['emails'],
+                         [{'value': 'public@example.com'}])
+        self.assertTrue(context.profile['partial'])
+
+
+class TestQQOpenID(unittest.TestCase):
+
+    def _callback(self, me):
+        from pyramid import testing
+        from velruse.providers import qq
+        http = DummyHTTP({
+            'https://graph.qq.com/oauth2.0/token': DummyResponse(
+                'access_token=t'),
+            'https://graph.qq.com/oauth2.0/me': DummyResponse(
+                'callback( %s );\n' % me),
+            'https://graph.qq.com/user/get_user_info': DummyResponse(
+                {}, 503),
+        })
+        provider = qq.QQProvider('qq', 'key', 'secret', None,
+                                 http_client=http)
+        config = testing.setUp()
+        try:
+            config.add_route(provider.callback_route, '/callback')
+            request = testing.DummyRequest(params={'code': 'c'})
+            return provider.callback(request)
+        finally:
+            testing.tearDown()
+
+    def test_degraded(self):
+        context = self._callback('{"openid": "1"}')
+        self.assertEqual(context.profile['accounts'][0]['userid'], '1')
+        self.assertTrue(context.profile['partial'])
+
+    def test_missing_openid(self):
+        from velruse.exceptions import ThirdPartyFailure
+        self.assertRaises(ThirdPartyFailure, self._callback,
+                          '{"error": 100016}')
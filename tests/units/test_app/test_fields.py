@@ -0,0 +1,94 @@
+import unittest
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import DummyProvider
+from tests.units.helpers import dummy_context
+from tests.units.helpers import form_token
+from tests.units.helpers import make_app
+
+
+PROFILE = {
+    'accounts': [{'domain': 'facebook.com', 'userid': '1'}],
+    'displayName': 'John Doe',
+    'name': {'formatted': 'John Doe', 'givenName': 'John'},
+    'emails': [{'value': 'jdoe@example.com', 'primary': True}],
+    'birthday': '1980-01-01',
+}
+
+
+class TestParseFields(unittest.TestCase):
+
+    def _callFUT(self, fields):
+        from velruse.app.fields import parse_fields
+        return parse_fields(fields)
+
+    def test_it(self):
+        self.assertEqual(
+            self._callFUT('accounts, name.formatted\nemails.value'),
+            {'accounts': None, 'name': {'formatted': None},
+             'emails': {'value': None}})
+
+    def test_whole_value_wins(self):
+        self.assertEqual(self._callFUT(['name', 'name.formatted']),
+                         {'name': None})
+        self.assertEqual(self._callFUT(['name.formatted', 'name']),
+                         {'name': None})
+
+
+class TestProfileMask(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from velruse.app.fields import ProfileMask
+        return ProfileMask(*args, **kw)
+
+    def test_apply(self):
+        mask = self._makeOne('accounts displayName name.formatted '
+                             'emails.value missing')
+        self.assertEqual(mask.apply(PROFILE, 'facebook'), {
+            'accounts': [{'domain': 'facebook.com', 'userid': '1'}],
+            'displayName': 'John Doe',
+            'name': {'formatted': 'John Doe'},
+            'emails': [{'value': 'jdoe@example.com'}],
+        })
+        stats = mask.stats()
+        self.assertEqual(stats['projected'], 1)
+        self.assertTrue(stats['bytes_saved'] > 0)
+        self.assertEqual(stats['bytes_saved'],
+                         stats['bytes_before'] - stats['bytes_after'])
+
+    def test_provider_fields(self):
+        mask = self._makeOne('displayName', {'github': 'birthday',
+                                             'qq': ''})
+        self.assertEqual(mask.apply(PROFILE, 'facebook'),
+                         {'displayName': 'John Doe'})
+        self.assertEqual(mask.apply(PROFILE, 'github'),
+                         {'birthday': '1980-01-01'})
+        self.assertEqual(mask.apply(PROFILE, 'qq'), PROFILE)
+        self.assertEqual(mask.stats()['projected'], 2)
+
+    def test_from_settings(self):
+        from velruse.app.fields import mask_from_settings
+        self.assertEqual(mask_from_settings({}), None)
+        mask = mask_from_settings({'profile_fields.github': 'displayName'})
+        self.assertEqual(mask.fields, None)
+        self.assertEqual(mask.provider_fields,
+                         {'github': {'displayName': None}})
+
+
+class TestProjectedResults(unittest.TestCase):
+
+    def test_it(self):
+        context = dummy_context(profile=PROFILE,
+                                credentials={'oauthAccessToken': 'a'},
+                                provider_name='facebook')
+        app = make_app(DummyProvider(context),
+                       profile_fields='accounts displayName')
+        token = form_token(app.get(CALLBACK_PATH))
+        info = app.get('/auth_info', {'format': 'json', 'token': token})
+        self.assertEqual(info.json['profile'], {
+            'accounts': [{'domain': 'facebook.com', 'userid': '1'}],
+            'displayName': 'John Doe',
+        })
+        self.assertEqual(info.json['credentials'], {'oauthAccessToken': 'a'})
+        stats = app.app.registry.velruse_profile_mask.stats()
+        self.assertEqual(stats['projected'], 1)
@@ -0,0 +1,62 @@
+import unittest
+
+from webtest import TestApp
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import DummyProvider
+from tests.units.helpers import dummy_context
+from tests.units.helpers import make_settings
+
+
+def wrapped_app(environ, start_response):
+    result = environ.get('velruse.result')
+    body = ('%s %s %r' % (environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                          result)).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [body]
+
+
+class TestVelruseMiddleware(unittest.TestCase):
+
+    def _makeApp(self, context):
+        from velruse.app.middleware import make_velruse_middleware
+        provider = DummyProvider(context)
+
+        def setup(config):
+            config.add_route('cb', CALLBACK_PATH, factory=provider.callback,
+                             use_global_views=True)
+
+        app = make_velruse_middleware(
+            wrapped_app, endpoint='http://example.com/logged_in',
+            setup=setup)
+        return TestApp(app)
+
+    def test_complete(self):
+        app = self._makeApp(dummy_context(credentials={'token': 't'}))
+        resp = app.post(CALLBACK_PATH + '?code=1', {'a': 'b'})
+        self.assertTrue(resp.text.startswith('GET /logged_in {'))
+        self.assertTrue("'displayName': 'jdoe'" in resp.text)
+
+    def test_denied(self):
+        from velruse import AuthenticationDenied
+        context = AuthenticationDenied(
+            'nope', provider_name='dummy', provider_type='dummy')
+        resp = self._makeApp(context).get(CALLBACK_PATH)
+        self.assertTrue("'error': 'nope'" in resp.text)
+
+    def test_passthrough(self):
+        resp = self._makeApp(None).get('/other')
+        self.assertEqual(resp.text, 'GET /other None')
+
+    def test_no_store_or_auth_info(self):
+        app = self._makeApp(None)
+        registry = app.app.registry
+        self.assertFalse(hasattr(registry, 'velruse_store'))
+        resp = app.get('/auth_info?format=json&token=x')
+        self.assertEqual(resp.text, 'GET /auth_info None')
+
+    def test_environ_delivery_requires_middleware(self):
+        from pyramid.exceptions import ConfigurationError
+        from velruse.app import make_app
+        self.assertRaises(ConfigurationError, make_app, {},
+                          **make_settings(delivery='environ'))
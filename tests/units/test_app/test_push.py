@@ -0,0 +1,91 @@
+import json
+import unittest
+
+from webtest import TestApp
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import DummyProvider
+from tests.units.helpers import dummy_context
+from tests.units.helpers import form_token
+from tests.units.helpers import make_config
+
+
+PUSH_SETTINGS = {
+    'delivery': 'push',
+    'push.url': 'http://example.com/push',
+    'push.secret': 'seekrit',
+}
+
+
+class DummyResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class DummyClient(object):
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.calls = []
+
+    def post(self, url, **kw):
+        self.calls.append((url, kw))
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return DummyResponse(self.outcome)
+
+
+class TestPushDelivery(unittest.TestCase):
+
+    def _makeApp(self, outcome):
+        config = make_config(DummyProvider(dummy_context()), **PUSH_SETTINGS)
+        self.client = DummyClient(outcome)
+        config.registry.velruse_push_client = self.client
+        self.store = config.registry.velruse_results
+        return TestApp(config.make_wsgi_app())
+
+    def test_pushed(self):
+        from velruse.app.utils import sign_payload
+        resp = self._makeApp(204).get(CALLBACK_PATH)
+        token = form_token(resp)
+        url, kw = self.client.calls[0]
+        self.assertEqual(url, 'http://example.com/push')
+        self.assertEqual(kw['idempotent'], False)
+        payload = json.loads(kw['data'])
+        self.assertEqual(payload['token'], token)
+        self.assertEqual(payload['result']['profile'],
+                         {'displayName': 'jdoe'})
+        headers = kw['headers']
+        self.assertEqual(
+            headers['X-Velruse-Signature'],
+            sign_payload('seekrit', headers['X-Velruse-Timestamp'],
+                         kw['data']))
+        self.assertRaises(KeyError, self.store.retrieve, token)
+
+    def test_rejected_falls_back_to_store(self):
+        resp = self._makeApp(503).get(CALLBACK_PATH)
+        token = form_token(resp)
+        self.assertEqual(self.store.retrieve(token)['provider_name'],
+                         'dummy')
+
+    def test_failed_falls_back_to_store(self):
+        from velruse.exceptions import ThirdPartyFailure
+        app = self._makeApp(ThirdPartyFailure('timeout'))
+        token = form_token(app.get(CALLBACK_PATH))
+        self.assertEqual(self.store.retrieve(token)['provider_name'],
+                         'dummy')
+
+    def test_client_timeouts(self):
+        settings = dict(PUSH_SETTINGS, **{'push.timeout.read': '2'})
+        client = make_config(**settings).registry.velruse_push_client
+        self.assertEqual(client.connect_timeout, 5)
+        self.assertEqual(client.read_timeout, 2)
+
+
+class TestSignPayload(unittest.TestCase):
+
+    def test_it(self):
+        from velruse.app.utils import sign_payload
+        sig = sign_payload('seekrit', '1000', '{}')
+        self.assertEqual(sig, sign_payload(b'seekrit', '1000', b'{}'))
+        self.assertNotEqual(sig, sign_payload('seekrit', '1001', '{}'))
+        self.assertEqual(len(sig), 64)
@@ -0,0 +1,194 @@
+import unittest
+
+
+class TestResultStore(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from anykeystore.backends.memory import MemoryStore
+        from velruse.app.results import ResultStore
+        kw.setdefault('sweep_interval', 0)
+        self.backend = MemoryStore()
+        return ResultStore(self.backend, **kw)
+
+    def test_store_and_retrieve(self):
+        results = self._makeOne()
+        results.store('t', {'profile': {}})
+        self.assertEqual(results.retrieve('t'), {'profile': {}})
+        self.assertEqual(results.retrieve('t'), {'profile': {}})
+        self.assertRaises(KeyError, results.retrieve, 'x')
+        stats = results.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['stored'], 1)
+        self.assertEqual(stats['retrieved'], 2)
+        self.assertEqual(stats['missed'], 1)
+
+    def test_retrieve_json(self):
+        results = self._makeOne()
+        results.store('t', {'profile': {'name': 'x'}})
+        self.assertEqual(self.backend.retrieve('t'),
+                         b'{"profile":{"name":"x"}}')
+        self.assertEqual(results.retrieve_json('t'),
+                         b'{"profile":{"name":"x"}}')
+        self.assertEqual(results.retrieve_many_json(['t', 'x']),
+                         {'t': b'{"profile":{"name":"x"}}', 'x': None})
+        # results stored as dictionaries by earlier versions
+        self.backend.store('old', {'profile': {}})
+        self.assertEqual(results.retrieve('old'), {'profile': {}})
+        self.assertEqual(results.retrieve_json('old'), b'{"profile":{}}')
+
+    def test_consume(self):
+        results = self._makeOne(consume=True)
+        results.store('t', {'profile': {}})
+        self.assertEqual(results.retrieve('t'), {'profile': {}})
+        self.assertRaises(KeyError, results.retrieve, 't')
+        results.store('a', {'profile': {}})
+        self.assertEqual(results.retrieve_many(['a', 'b']),
+                         {'a': {'profile': {}}, 'b': None})
+        self.assertEqual(results.size(), 0)
+
+    def test_ttls(self):
+        from datetime import datetime
+        results = self._makeOne(complete_ttl=100, denied_ttl=10)
+        results.store('ok', {'profile': {}})
+        results.store('denied', {'error': 'denied'})
+        now = datetime.utcnow()
+        ok = (self.backend._store['ok'][1] - now).total_seconds()
+        denied = (self.backend._store['denied'][1] - now).total_seconds()
+        self.assertTrue(90 < ok <= 100)
+        self.assertTrue(0 < denied <= 10)
+
+    def test_sweep(self):
+        results = self._makeOne(complete_ttl=-1)
+        results.store('old', {'profile': {}})
+        self.backend.store('kept', {}, expires=60)
+        results.sweep()
+        self.assertEqual(list(self.backend._store), ['kept'])
+        self.assertEqual(results.stats()['swept'], 1)
+
+    def test_sweeper_thread(self):
+        import time
+        results = self._makeOne(complete_ttl=-1, sweep_interval=0.01)
+        results.store('old', {'profile': {}})
+        for i in range(100):
+            if not results.size():
+                break
+            time.sleep(0.01)
+        self.assertEqual(results.size(), 0)
+
+
+class DummyRedisConnection(object):
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def mget(self, keys):
+        self.calls.append(('mget', keys))
+        return [self.data.get(k) for k in keys]
+
+    def pipeline(self, transaction=False):
+        return DummyRedisPipeline(self)
+
+
+class DummyRedisPipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = []
+
+    def get(self, key):
+        self.results.append(self.conn.data.get(key))
+        return self
+
+    def delete(self, key):
+        self.results.append(self.conn.data.pop(key, None) is not None)
+        return self
+
+    def execute(self):
+        self.conn.calls.append(('pipeline', len(self.results)))
+        return self.results
+
+
+def DummyRedisStore(internals=True):
+    from anykeystore.backends.redis import RedisStore
+    from anykeystore.compat import pickle
+
+    class DummyRedisStore(RedisStore):
+        def __init__(self):
+            RedisStore.__init__(self)
+            self.data = {}
+            self.conn = DummyRedisConnection(self.data)
+
+        if internals:
+            def _get_conn(self):
+                return self.conn
+        else:
+            # internals of another anykeystore version
+            _get_conn = None
+            _make_key = None
+
+        def retrieve(self, key):
+            key = self.key_prefix + key
+            if key not in self.data:
+                raise KeyError(key)
+            return pickle.loads(self.data[key])
+
+        def store(self, key, value, expires=None):
+            self.data[self.key_prefix + key] = pickle.dumps(value)
+
+        def delete(self, key):
+            self.data.pop(self.key_prefix + key, None)
+
+    return DummyRedisStore()
+
+
+class TestRedisBackend(unittest.TestCase):
+
+    def _makeOne(self, internals=True, **kw):
+        from velruse.app.results import ResultStore
+        self.backend = DummyRedisStore(internals)
+        return ResultStore(self.backend, **kw)
+
+    def test_single_round_trips(self):
+        results = self._makeOne(consume=True)
+        results.store('a', {'profile': {}})
+        self.assertEqual(results.retrieve('a'), {'profile': {}})
+        self.assertEqual(self.backend.conn.calls, [('pipeline', 2)])
+        self.assertRaises(KeyError, results.retrieve, 'a')
+
+    def test_retrieve_many(self):
+        from velruse.app.results import retrieve_many
+        backend = DummyRedisStore()
+        backend.store('a', 1)
+        self.assertEqual(retrieve_many(backend, ['a', 'a']), {'a': 1})
+        self.assertEqual(backend.conn.calls,
+                         [('mget', ['anykeystore.a'])])
+
+    def test_without_internals(self):
+        results = self._makeOne(internals=False, consume=True)
+        results.store('a', {'profile': {}})
+        results.store('b', {'profile': {}})
+        self.assertEqual(results.retrieve('a'), {'profile': {}})
+        self.assertRaises(KeyError, results.retrieve, 'a')
+        self.assertEqual(results.retrieve_many(['b', 'c']),
+                         {'b': {'profile': {}}, 'c': None})
+        results.consume = False
+        results.store('d', {'profile': {}})
+        self.assertEqual(results.retrieve_many(['d']),
+                         {'d': {'profile': {}}})
+        self.assertEqual(self.backend.conn.calls, [])
+        self.assertEqual(results.size(), None)
+
+
+class TestResultsFromSettings(unittest.TestCase):
+
+    def test_it(self):
+        from velruse.app.results import results_from_settings
+        results = results_from_settings({
+            'results.complete_ttl': '120',
+            'results.denied_ttl': '30',
+            'results.consume': 'true',
+            'results.sweep_interval': '0',
+        }, None)
+        self.assertEqual(results.complete_ttl, 120)
+        self.assertEqual(results.denied_ttl, 30)
+        self.assertTrue(results.consume)
+        self.assertEqual(results.sweep_interval, 0)
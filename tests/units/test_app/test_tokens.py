@@ -0,0 +1,53 @@
+import unittest
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import DummyProvider
+from tests.units.helpers import dummy_context
+from tests.units.helpers import form_token
+from tests.units.helpers import make_app
+
+
+class TestEncryptedTokens(unittest.TestCase):
+
+    def _makeOne(self, secret='seekrit', **kw):
+        from velruse.app.tokens import EncryptedTokens
+        return EncryptedTokens(secret, **kw)
+
+    def test_roundtrip(self):
+        result = {'provider_name': 'github', 'profile': {'a': [1, 2]}}
+        token = self._makeOne().encode(result)
+        self.assertEqual(self._makeOne().decode(token), result)
+
+    def test_wrong_secret(self):
+        token = self._makeOne().encode({})
+        self.assertRaises(KeyError, self._makeOne('other').decode, token)
+        self.assertRaises(KeyError, self._makeOne().decode, token[:-2])
+        self.assertRaises(KeyError, self._makeOne().decode, None)
+
+    def test_expired(self):
+        tokens = self._makeOne(max_age=-1)
+        self.assertRaises(KeyError, tokens.decode, tokens.encode({}))
+
+
+class TestTokenDelivery(unittest.TestCase):
+
+    def _makeApp(self, **settings):
+        return make_app(DummyProvider(dummy_context()), delivery='token',
+                        **settings)
+
+    def test_it(self):
+        from velruse.app.tokens import EncryptedTokens
+        app = self._makeApp(**{'token.secret': 'seekrit'})
+        self.assertFalse(hasattr(app.app.registry, 'velruse_store'))
+        token = form_token(app.get(CALLBACK_PATH))
+        result = EncryptedTokens('seekrit').decode(token)
+        self.assertEqual(result['profile'], {'displayName': 'jdoe'})
+
+        info = app.get('/auth_info', {'format': 'json', 'token': token})
+        self.assertEqual(info.json, result)
+        app.get('/auth_info', {'format': 'json', 'token': 'bad'},
+                status=400)
+
+    def test_requires_secret(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeApp)
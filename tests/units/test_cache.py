@@ -0,0 +1,347 @@
+import unittest
+
+from tests.units.helpers import CALLBACK_PATH
+from tests.units.helpers import dummy_context
+from tests.units.helpers import form_token
+from tests.units.helpers import make_config
+from tests.units.helpers import make_settings
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.cache import TTLCache
+        return TTLCache(**kw)
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 1), 1)
+        cache.set('a', 2)
+        self.assertEqual(cache.get('a'), 2)
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+
+    def test_expiry(self):
+        cache = self._makeOne(ttl=60)
+        cache.set('a', 1, ttl=0)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        cache.set('c', 3, ttl=0)
+        cache.purge_expired()
+        self.assertEqual(len(cache), 1)
+
+    def test_lru_eviction(self):
+        cache = self._makeOne(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def _makeOne(self):
+        from velruse.cache import SingleFlight
+        return SingleFlight()
+
+    def test_collapses_concurrent_calls(self):
+        import threading
+        import time
+        flight = self._makeOne()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'result'
+
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('key', work)))
+            for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_propagates_errors(self):
+        flight = self._makeOne()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+
+class DummyRegistry(object):
+    pass
+
+
+class TestEnrichmentCache(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.cache import EnrichmentCache
+        return EnrichmentCache(**kw)
+
+    def test_memory(self):
+        cache = self._makeOne(max_entries=1)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'n': len(calls)}
+
+        self.assertEqual(cache.get('twitter', '1', fetch), {'n': 1})
+        self.assertEqual(cache.get('twitter', '1', fetch), {'n': 1})
+        self.assertEqual(cache.get('bitbucket', '1', fetch), {'n': 2})
+        # evicted
+        self.assertEqual(cache.get('twitter', '1', fetch), {'n': 3})
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 3, 'hit_rate': 0.25})
+
+    def test_failures_not_cached(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('twitter', '1', lambda: None), None)
+        self.assertEqual(cache.get('twitter', '1', lambda: 1), 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_store(self):
+        from anykeystore.backends.memory import MemoryStore
+
+        class Registry(object):
+            velruse_store = MemoryStore()
+
+        cache = self._makeOne(ttl=60, registry=Registry)
+        self.assertEqual(cache.get('twitter', '1', lambda: {'a': 1}),
+                         {'a': 1})
+        self.assertEqual(len(Registry.velruse_store._store), 1)
+        self.assertEqual(cache.get('twitter', '1', lambda: None), {'a': 1})
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_from_settings(self):
+        from velruse.cache import enrichment_cache_from_settings
+        self.assertEqual(enrichment_cache_from_settings({}, 'p.'), None)
+        cache = enrichment_cache_from_settings({
+            'p.enrichment_cache.ttl': '60',
+            'p.enrichment_cache.max_entries': '5',
+        }, 'p.')
+        self.assertEqual(cache.ttl, 60)
+        self.assertEqual(cache.memory.max_entries, 5)
+        registry = DummyRegistry()
+        registry.velruse_store = object()
+        cache = enrichment_cache_from_settings({
+            'p.enrichment_cache.ttl': '60',
+            'p.enrichment_cache.store': 'velruse_store',
+        }, 'p.', registry)
+        self.assertTrue(cache.registry is registry)
+        self.assertRaises(ValueError, enrichment_cache_from_settings, {
+            'p.enrichment_cache.ttl': '60',
+            'p.enrichment_cache.store': 'redis',
+        }, 'p.')
+
+    def test_from_settings_without_velruse_store(self):
+        from pyramid.exceptions import ConfigurationError
+        from velruse.cache import enrichment_cache_from_settings
+        settings = {
+            'p.enrichment_cache.ttl': '60',
+            'p.enrichment_cache.store': 'velruse_store',
+        }
+        self.assertRaises(ConfigurationError, enrichment_cache_from_settings,
+                          settings, 'p.', DummyRegistry())
+        self.assertRaises(ConfigurationError, enrichment_cache_from_settings,
+                          settings, 'p.')
+
+    def test_velruse_store_with_token_delivery(self):
+        from pyramid.config import Configurator
+        from pyramid.exceptions import ConfigurationError
+        config = Configurator(settings=make_settings(**{
+            'delivery': 'token',
+            'token.secret': 'seekrit',
+            'provider.twitter.consumer_key': 'key',
+            'provider.twitter.consumer_secret': 'secret',
+            'provider.twitter.enrichment_cache.ttl': '60',
+            'provider.twitter.enrichment_cache.store': 'velruse_store',
+        }))
+        self.assertRaises(ConfigurationError, config.include, 'velruse.app')
+
+
+class CachedProvider(object):
+    name = 'dummy'
+
+    def __init__(self, callback_cache, fail=False):
+        from velruse.state import SessionState
+        self.callback_cache = callback_cache
+        self.state_manager = SessionState()
+        self.fail = fail
+        self.calls = 0
+
+    def login(self, request):
+        from pyramid.response import Response
+        return Response(self.state_manager.issue(request, self.name))
+
+    def _callback(self, request):
+        from velruse import AuthenticationDenied
+        self.state_manager.verify(request, self.name)
+        self.calls += 1
+        if self.fail:
+            return AuthenticationDenied('denied', provider_name=self.name)
+        return dummy_context()
+
+    def callback(self, request):
+        from velruse.cache import idempotent_callback
+        return idempotent_callback(CachedProvider._callback)(self, request)
+
+
+class TestCallbackCache(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.cache import CallbackCache
+        return CallbackCache(**kw)
+
+    def _login(self, provider, session=None):
+        from pyramid.testing import DummyRequest
+        request = DummyRequest()
+        if session is not None:
+            request.session = session
+        state = provider.state_manager.issue(request, provider.name)
+        return request.session, state
+
+    def _makeRequest(self, session, **params):
+        from pyramid.testing import DummyRequest
+        request = DummyRequest(params=params)
+        request.session = session
+        return request
+
+    def _makeApp(self, provider, **settings):
+        from webtest import TestApp
+        config = make_config(provider, **settings)
+        config.add_route('login', '/login')
+        config.add_view(provider, attr='login', route_name='login')
+        return TestApp(config.make_wsgi_app())
+
+    def test_duplicates(self):
+        provider = CachedProvider(self._makeOne())
+        session, state = self._login(provider)
+        first = provider.callback(
+            self._makeRequest(session, code='c', state=state))
+        second = provider.callback(
+            self._makeRequest(session, code='c', state=state))
+        self.assertTrue(first is second)
+        self.assertEqual(provider.calls, 1)
+        session, state = self._login(provider, session)
+        provider.callback(self._makeRequest(session, code='d', state=state))
+        self.assertEqual(provider.calls, 2)
+        self.assertEqual(provider.callback_cache.stats(),
+                         {'hits': 1, 'misses': 2, 'size': 2})
+
+    def test_other_browser(self):
+        from velruse.exceptions import CSRFError
+        provider = CachedProvider(self._makeOne())
+        session, state = self._login(provider)
+        provider.callback(self._makeRequest(session, code='c', state=state))
+        other_session = self._login(provider)[0]
+        self.assertRaises(CSRFError, provider.callback, self._makeRequest(
+            other_session, code='c', state=state))
+        self.assertRaises(CSRFError, provider.callback, self._makeRequest(
+            {}, code='c', state=state))
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual(provider.callback_cache.stats()['hits'], 0)
+
+    def test_duplicate_verified(self):
+        from velruse.exceptions import CSRFError
+        provider = CachedProvider(self._makeOne())
+        session, state = self._login(provider)
+        provider.callback(self._makeRequest(session, code='c', state=state))
+        # a later login of the same browser supersedes the first state
+        session, other_state = self._login(provider, session)
+        provider.callback(
+            self._makeRequest(session, code='d', state=other_state))
+        self.assertRaises(CSRFError, provider.callback, self._makeRequest(
+            session, code='c', state=state))
+        self.assertEqual(provider.calls, 2)
+
+    def test_without_code(self):
+        provider = CachedProvider(self._makeOne())
+        for i in range(2):
+            session, state = self._login(provider)
+            provider.callback(
+                self._makeRequest(session, error='denied', state=state))
+        self.assertEqual(provider.calls, 2)
+
+    def test_denied_not_cached(self):
+        from velruse.exceptions import CSRFError
+        provider = CachedProvider(self._makeOne(), fail=True)
+        session, state = self._login(provider)
+        provider.callback(self._makeRequest(session, code='c', state=state))
+        self.assertRaises(CSRFError, provider.callback, self._makeRequest(
+            session, code='c', state=state))
+        self.assertEqual(provider.calls, 1)
+
+    def test_concurrent_duplicates(self):
+        import threading
+        import time
+        cache = self._makeOne()
+        calls = []
+        verified = []
+        results = []
+
+        def callback():
+            from velruse import AuthenticationComplete
+            calls.append(1)
+            time.sleep(0.1)
+            return AuthenticationComplete()
+
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get(
+                'dummy', 'c', 's', 'b', callback,
+                lambda: verified.append(1))))
+            for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(verified), 4)
+        self.assertEqual(len(set(id(r) for r in results)), 1)
+
+    def test_duplicate_gets_same_token(self):
+        provider = CachedProvider(self._makeOne())
+        app = self._makeApp(provider)
+        state = app.get('/login').text
+        tokens = []
+        for i in range(2):
+            resp = app.get(CALLBACK_PATH, {'code': 'c', 'state': state})
+            tokens.append(form_token(resp))
+        self.assertEqual(tokens[0], tokens[1])
+        self.assertEqual(provider.calls, 1)
+
+    def test_consumed_result_not_stored_again(self):
+        provider = CachedProvider(self._makeOne())
+        app = self._makeApp(provider, **{'results.consume': 'true'})
+        state = app.get('/login').text
+        resp = app.get(CALLBACK_PATH, {'code': 'c', 'state': state})
+        token = form_token(resp)
+        resp = app.get('/auth_info', {'format': 'json', 'token': token})
+        self.assertEqual(resp.json['profile'], {'displayName': 'jdoe'})
+        resp = app.get(CALLBACK_PATH, {'code': 'c', 'state': state})
+        self.assertEqual(form_token(resp), token)
+        app.get('/auth_info', {'format': 'json', 'token': token}, status=400)
+
+    def test_from_settings(self):
+        from velruse.cache import callback_cache_from_settings
+        self.assertEqual(callback_cache_from_settings({}, 'p.'), None)
+        cache = callback_cache_from_settings({
+            'p.callback_cache.ttl': '10',
+            'p.callback_cache.max_entries': '5',
+        }, 'p.')
+        self.assertEqual(cache.memory.ttl, 10)
+        self.assertEqual(cache.memory.max_entries, 5)
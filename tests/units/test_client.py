@@ -0,0 +1,518 @@
+import unittest
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.client import HTTPClient
+        return HTTPClient(**kw)
+
+    def test_pool_settings(self):
+        client = self._makeOne(pool_connections=2, pool_maxsize=5)
+        adapter = client.session.get_adapter('https://example.com/')
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertTrue(client.session.get_adapter('http://example.com/')
+                        is adapter)
+
+    def test_keep_alive_disabled(self):
+        client = self._makeOne(keep_alive=False)
+        self.assertEqual(client.session.headers['Connection'], 'close')
+
+    def test_consumer_signer_is_reused(self):
+        client = self._makeOne()
+        a = client.oauth1('key', client_secret='secret',
+                          callback_uri='http://example.com/cb')
+        b = client.oauth1('key', client_secret='secret',
+                          callback_uri='http://example.com/cb')
+        self.assertTrue(a is b)
+
+    def test_token_signer_is_not_reused(self):
+        client = self._makeOne()
+        a = client.oauth1('key', client_secret='secret',
+                          resource_owner_key='token',
+                          resource_owner_secret='token-secret')
+        b = client.oauth1('key', client_secret='secret',
+                          resource_owner_key='token',
+                          resource_owner_secret='token-secret')
+        self.assertFalse(a is b)
+
+
+class TestDeadline(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.client import HTTPClient
+        return HTTPClient(**kw)
+
+    def test_timeout_without_flow(self):
+        client = self._makeOne(connect_timeout=1, read_timeout=2,
+                               deadline=5)
+        self.assertEqual(client._timeout(), (1, 2))
+        self.assertEqual(client.remaining(), None)
+
+    def test_timeout_capped_by_deadline(self):
+        client = self._makeOne(connect_timeout=10, read_timeout=30,
+                               deadline=5)
+        with client.flow():
+            connect, read = client._timeout()
+            self.assertTrue(0 < connect <= 5)
+            self.assertTrue(0 < read <= 5)
+        self.assertEqual(client.remaining(), None)
+
+    def test_explicit_timeout_capped_by_deadline(self):
+        client = self._makeOne(deadline=5)
+        self.assertEqual(client._timeout(60), (60, 60))
+        with client.flow():
+            connect, read = client._timeout(60)
+            self.assertTrue(0 < connect <= 5)
+            self.assertTrue(0 < read <= 5)
+            self.assertEqual(client._timeout((1, 60))[0], 1)
+
+    def test_explicit_timeout_sent_capped(self):
+        client = self._makeOne(deadline=5)
+        client.session = DummySession(200)
+        sent = []
+        request = client.session.request
+
+        def record(method, url, **kw):
+            sent.append(kw['timeout'])
+            return request(method, url, **kw)
+        client.session.request = record
+        with client.flow():
+            client.get('http://example.com/', timeout=60)
+        self.assertTrue(0 < sent[0][1] <= 5)
+
+    def test_deadline_exceeded(self):
+        from velruse.exceptions import ThirdPartyFailure
+        client = self._makeOne(deadline=0)
+        with client.flow():
+            self.assertRaises(ThirdPartyFailure, client.get,
+                              'http://example.com/')
+
+    def test_nested_flow_shares_budget(self):
+        client = self._makeOne(deadline=5)
+        with client.flow():
+            expires_at = client.expires_at()
+            with client.flow():
+                self.assertEqual(client.expires_at(), expires_at)
+            self.assertEqual(client.expires_at(), expires_at)
+
+    def test_with_deadline(self):
+        from velruse.client import with_deadline
+
+        class Provider(object):
+            http = self._makeOne(deadline=5)
+
+            @with_deadline
+            def callback(self, request):
+                return self.http.remaining()
+
+        self.assertTrue(0 < Provider().callback(None) <= 5)
+
+    def test_enrichment_budget(self):
+        client = self._makeOne(deadline=5, enrichment_timeout=1)
+        with client.flow():
+            with client.enrichment():
+                self.assertTrue(0 < client.remaining() <= 1)
+            self.assertTrue(1 < client.remaining() <= 5)
+
+    def test_enrichment_capped_by_deadline(self):
+        client = self._makeOne(deadline=1, enrichment_timeout=5)
+        with client.flow():
+            expires_at = client.expires_at()
+            with client.enrichment():
+                self.assertEqual(client.expires_at(), expires_at)
+
+
+class TestEnrichOrDegrade(unittest.TestCase):
+
+    def _callFUT(self, provider, profile):
+        from velruse.client import enrich_or_degrade
+        return enrich_or_degrade(provider, profile, {'token': 't'})
+
+    def _makeProvider(self, enrich):
+        from velruse.client import HTTPClient
+
+        class Provider(object):
+            name = 'dummy'
+            http = HTTPClient(enrichment_timeout=1)
+
+            def enrich_profile(self, profile, credentials):
+                return enrich(self, profile, credentials)
+
+        return Provider()
+
+    def test_enriched(self):
+        def enrich(provider, profile, credentials):
+            self.assertTrue(0 < provider.http.remaining() <= 1)
+            return dict(profile, displayName=credentials['token'])
+        provider = self._makeProvider(enrich)
+        self.assertEqual(self._callFUT(provider, {'accounts': []}),
+                         {'accounts': [], 'displayName': 't'})
+
+    def test_degraded(self):
+        from velruse.exceptions import ThirdPartyFailure
+
+        def enrich(provider, profile, credentials):
+            raise ThirdPartyFailure('Deadline exceeded')
+        provider = self._makeProvider(enrich)
+        profile = {'accounts': []}
+        self.assertEqual(self._callFUT(provider, profile),
+                         {'accounts': [], 'partial': True})
+        self.assertEqual(profile, {'accounts': []})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.client import CircuitBreaker
+        return CircuitBreaker(**kw)
+
+    def test_trips_on_error_rate(self):
+        breaker = self._makeOne(error_rate=0.5, min_requests=4, window=4)
+        for success in (True, False, True):
+            self.assertTrue(breaker.allow())
+            breaker.record(success)
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probe(self):
+        breaker = self._makeOne(error_rate=0.5, min_requests=1,
+                                reset_timeout=0)
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'open')
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half-open')
+        # only a single probe is let through
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'open')
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.info()['requests'], 0)
+
+    def test_client_fails_fast(self):
+        from velruse.client import HTTPClient
+        from velruse.exceptions import ThirdPartyFailure
+        client = HTTPClient(breaker=dict(error_rate=0.5, min_requests=1))
+        client.breaker('token').record(False)
+        self.assertRaises(ThirdPartyFailure, client.get,
+                          'http://example.com/token', endpoint='token')
+        self.assertEqual(client.breaker_states()['token']['state'], 'open')
+
+    def test_probe_failing_with_other_error(self):
+        import requests
+        from velruse.client import HTTPClient
+        client = HTTPClient(breaker=dict(error_rate=0.5, min_requests=1,
+                                         reset_timeout=0), retries=0)
+        client.session = DummySession(
+            requests.exceptions.ChunkedEncodingError('truncated'), 200)
+        breaker = client.breaker('me')
+        breaker.record(False)
+        self.assertRaises(requests.exceptions.ChunkedEncodingError,
+                          client.get, 'http://example.com/me', endpoint='me')
+        self.assertEqual(breaker.state, 'open')
+        resp = client.get('http://example.com/me', endpoint='me')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_client_without_breaker(self):
+        from velruse.client import HTTPClient
+        client = HTTPClient()
+        self.assertEqual(client.breaker('token'), None)
+        self.assertEqual(client.breaker_states(), {})
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.client import Bulkhead
+        return Bulkhead(**kw)
+
+    def test_rejects_beyond_queue(self):
+        from velruse.exceptions import ThirdPartyFailure
+        bulkhead = self._makeOne(max_concurrent=2)
+        bulkhead.acquire()
+        bulkhead.acquire()
+        self.assertRaises(ThirdPartyFailure, bulkhead.acquire)
+        bulkhead.release()
+        bulkhead.acquire()
+        info = bulkhead.info()
+        self.assertEqual(info['active'], 2)
+        self.assertEqual(info['admitted'], 3)
+        self.assertEqual(info['rejected'], 1)
+
+    def test_queued(self):
+        import threading
+        bulkhead = self._makeOne(max_concurrent=1, max_queue=1,
+                                 queue_timeout=5)
+        bulkhead.acquire()
+        waiter = threading.Thread(target=bulkhead.acquire)
+        waiter.start()
+        while not bulkhead.info()['waiting']:
+            waiter.join(0.01)
+        bulkhead.release()
+        waiter.join()
+        info = bulkhead.info()
+        self.assertEqual(info['active'], 1)
+        self.assertEqual(info['waiting'], 0)
+        self.assertEqual(info['queued'], 1)
+
+    def test_queue_timeout(self):
+        from velruse.exceptions import ThirdPartyFailure
+        bulkhead = self._makeOne(max_concurrent=1, max_queue=1,
+                                 queue_timeout=5)
+        bulkhead.acquire()
+        self.assertRaises(ThirdPartyFailure, bulkhead.acquire, 0.01)
+        info = bulkhead.info()
+        self.assertEqual(info['waiting'], 0)
+        self.assertEqual(info['rejected'], 1)
+
+    def test_client_releases_slots(self):
+        from velruse.client import HTTPClient
+        client = HTTPClient(bulkhead=dict(max_concurrent=1))
+        client.session = DummySession(200, ValueError('boom'))
+        client.get('http://example.com/me')
+        self.assertRaises(ValueError, client.get, 'http://example.com/me')
+        self.assertEqual(client.bulkhead.info()['active'], 0)
+        self.assertEqual(client.bulkhead.info()['admitted'], 2)
+
+    def test_client_fails_fast(self):
+        from velruse.client import HTTPClient
+        from velruse.exceptions import ThirdPartyFailure
+        client = HTTPClient(breaker=dict(error_rate=0.5, min_requests=1,
+                                         reset_timeout=0),
+                            bulkhead=dict(max_concurrent=1))
+        client.session = DummySession(200)
+        client.breaker('token').record(False)
+        client.bulkhead.acquire()
+        self.assertRaises(ThirdPartyFailure, client.get,
+                          'http://example.com/token', endpoint='token')
+        self.assertEqual(client.session.calls, [])
+        # the breaker's probe was not used up by the rejected call
+        client.bulkhead.release()
+        client.get('http://example.com/token', endpoint='token')
+        self.assertEqual(client.breaker_states()['token']['state'],
+                         'closed')
+
+
+class TestGather(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.client import HTTPClient
+        return HTTPClient(**kw)
+
+    def test_results_in_order(self):
+        client = self._makeOne()
+        self.assertEqual(client.gather(lambda: 1, lambda: 2, lambda: 3),
+                         [1, 2, 3])
+        self.assertEqual(client.gather(), [])
+
+    def test_runs_concurrently(self):
+        import time
+        client = self._makeOne()
+        start = time.time()
+        client.gather(lambda: time.sleep(0.2), lambda: time.sleep(0.2),
+                      lambda: time.sleep(0.2))
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_shares_deadline(self):
+        client = self._makeOne(deadline=5)
+        with client.flow():
+            expires_at = client.expires_at()
+            results = client.gather(client.expires_at, client.expires_at)
+        self.assertEqual(results, [expires_at, expires_at])
+
+    def test_reraises_first_error(self):
+        client = self._makeOne()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, client.gather, lambda: 1, fail)
+
+
+class DummyResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class DummySession(object):
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kw):
+        self.calls.append((method, url))
+        outcome = self.outcomes.pop(0)
+        if callable(outcome):
+            outcome = outcome()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return DummyResponse(outcome)
+
+
+class TestRetries(unittest.TestCase):
+
+    def _makeOne(self, *outcomes, **kw):
+        from velruse.client import HTTPClient
+        kw.setdefault('backoff', 0)
+        client = HTTPClient(**kw)
+        client.session = DummySession(*outcomes)
+        return client
+
+    def test_idempotent_retried_on_server_error(self):
+        client = self._makeOne(503, 502, 200)
+        resp = client.get('http://example.com/me')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(client.session.calls), 3)
+
+    def test_idempotent_gives_up(self):
+        client = self._makeOne(503, 503, retries=1)
+        resp = client.get('http://example.com/me')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(len(client.session.calls), 2)
+
+    def test_exchange_not_retried_on_server_error(self):
+        client = self._makeOne(503, 200)
+        resp = client.post('http://example.com/token')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(len(client.session.calls), 1)
+
+    def _connection_error(self):
+        import requests
+        from urllib3.exceptions import MaxRetryError
+        from urllib3.exceptions import NewConnectionError
+        reason = NewConnectionError(None, 'refused')
+        return requests.ConnectionError(MaxRetryError(None, '/', reason))
+
+    def test_exchange_not_retried_by_default(self):
+        import requests
+        client = self._makeOne(self._connection_error(), 200)
+        self.assertRaises(requests.ConnectionError, client.post,
+                          'http://example.com/token')
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_exchange_retried_on_connection_error(self):
+        client = self._makeOne(self._connection_error(), 200,
+                               exchange_retries=1)
+        resp = client.get('http://example.com/token', idempotent=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(client.session.calls), 2)
+
+    def test_exchange_not_retried_on_reset(self):
+        import requests
+        client = self._makeOne(requests.ConnectionError('reset'), 200,
+                               exchange_retries=1)
+        self.assertRaises(requests.ConnectionError, client.post,
+                          'http://example.com/token')
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_exchange_not_retried_on_read_timeout(self):
+        import requests
+        from velruse.exceptions import ThirdPartyFailure
+        client = self._makeOne(requests.ReadTimeout('slow'), 200,
+                               exchange_retries=1)
+        self.assertRaises(ThirdPartyFailure, client.post,
+                          'http://example.com/token')
+        self.assertEqual(len(client.session.calls), 1)
+
+    def test_hedged_request(self):
+        import time
+
+        def slow():
+            time.sleep(0.2)
+            return 500
+
+        client = self._makeOne(slow, 200, retries=0, hedge_delay=0.01)
+        resp = client.get('http://example.com/me')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(client.session.calls), 2)
+
+    def test_hedged_request_shares_deadline(self):
+        client = self._makeOne(hedge_delay=0.01, deadline=5)
+        remaining = []
+        client.session.outcomes = [
+            lambda: remaining.append(client.remaining()) or 200]
+        with client.flow():
+            client.get('http://example.com/me')
+        self.assertTrue(0 < remaining[0] <= 5)
+
+    def test_hedge_uses_observed_latency(self):
+        from velruse.client import LatencyTracker
+        tracker = LatencyTracker(min_samples=3)
+        self.assertEqual(tracker.percentile(95), None)
+        for latency in (0.3, 0.1, 0.2):
+            tracker.add(latency)
+        self.assertEqual(tracker.percentile(95), 0.3)
+        self.assertEqual(tracker.percentile(50), 0.2)
+
+
+class TestClientFromSettings(unittest.TestCase):
+
+    def _callFUT(self, settings, prefix):
+        from velruse.client import client_from_settings
+        return client_from_settings(settings, prefix)
+
+    def test_defaults(self):
+        client = self._callFUT({}, 'p.')
+        self.assertEqual(client.pool_connections, 10)
+        self.assertEqual(client.pool_maxsize, 10)
+        self.assertFalse(client.pool_block)
+        self.assertTrue(client.keep_alive)
+        self.assertEqual(client.connect_timeout, 10)
+        self.assertEqual(client.read_timeout, 30)
+        self.assertEqual(client.deadline, None)
+        self.assertEqual(client.breaker_settings, None)
+        self.assertEqual(client.retries, 2)
+        self.assertEqual(client.exchange_retries, 0)
+        self.assertEqual(client.hedge_delay, None)
+        self.assertEqual(client.enrichment_timeout, None)
+        self.assertEqual(client.bulkhead, None)
+
+    def test_it(self):
+        client = self._callFUT({
+            'p.pool.connections': '4',
+            'p.pool.maxsize': '20',
+            'p.pool.block': 'true',
+            'p.keep_alive': 'false',
+            'p.timeout.connect': '0.5',
+            'p.timeout.read': '2',
+            'p.timeout.deadline': '4',
+            'p.breaker.error_rate': '0.25',
+            'p.breaker.reset_timeout': '5',
+            'p.retry.max': '3',
+            'p.retry.exchange_max': '1',
+            'p.retry.backoff': '0.2',
+            'p.retry.backoff_max': '2',
+            'p.hedge.delay': '0.25',
+            'p.timeout.enrichment': '1.5',
+            'p.bulkhead.max_concurrent': '4',
+            'p.bulkhead.max_queue': '8',
+            'p.bulkhead.queue_timeout': '0.5',
+        }, 'p.')
+        self.assertEqual(client.pool_connections, 4)
+        self.assertEqual(client.pool_maxsize, 20)
+        self.assertTrue(client.pool_block)
+        self.assertFalse(client.keep_alive)
+        self.assertEqual(client.connect_timeout, 0.5)
+        self.assertEqual(client.read_timeout, 2)
+        self.assertEqual(client.deadline, 4)
+        self.assertEqual(client.breaker_settings, {
+            'error_rate': 0.25,
+            'min_requests': 10,
+            'window': 20,
+            'reset_timeout': 5,
+        })
+        self.assertEqual(client.retries, 3)
+        self.assertEqual(client.exchange_retries, 1)
+        self.assertEqual(client.backoff, 0.2)
+        self.assertEqual(client.backoff_max, 2)
+        self.assertEqual(client.hedge_delay, 0.25)
+        self.assertEqual(client.enrichment_timeout, 1.5)
+        self.assertEqual(client.bulkhead.max_concurrent, 4)
+        self.assertEqual(client.bulkhead.max_queue, 8)
+        self.assertEqual(client.bulkhead.queue_timeout, 0.5)
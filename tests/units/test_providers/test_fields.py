@@ -0,0 +1,59 @@
+import unittest
+
+
+class TestFieldList(unittest.TestCase):
+
+    def _callFUT(self, fields, required=()):
+        from velruse.utils import field_list
+        return field_list(fields, required)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT('email, name\nlink'), 'email,name,link')
+        self.assertEqual(self._callFUT(['name', 'email', 'name']),
+                         'name,email')
+
+    def test_required(self):
+        self.assertEqual(self._callFUT('email name', ['id', 'name']),
+                         'id,email,name')
+
+
+class TestProviderFields(unittest.TestCase):
+
+    def test_facebook(self):
+        from velruse.providers.facebook import FacebookProvider
+        provider = FacebookProvider('facebook', 'key', 'secret', None)
+        self.assertEqual(provider.fields.split(',')[:2], ['id', 'name'])
+        self.assertTrue('email' in provider.fields.split(','))
+        provider = FacebookProvider('facebook', 'key', 'secret', None,
+                                    fields='email')
+        self.assertEqual(provider.fields, 'id,name,email')
+
+    def test_linkedin(self):
+        from velruse.providers.linkedin import LinkedInProvider
+        provider = LinkedInProvider('linkedin', 'key', 'secret',
+                                    fields='email-address')
+        self.assertEqual(provider.fields,
+                         'id,first-name,last-name,email-address')
+
+    def test_vk(self):
+        from velruse.providers.vk import VKProvider
+        provider = VKProvider('vk', 'key', 'secret', None, fields='sex')
+        self.assertEqual(provider.fields, 'first_name,last_name,sex')
+
+
+class TestExtractors(unittest.TestCase):
+
+    def test_fb_strips_empty_values(self):
+        from velruse.providers.facebook import extract_fb_data
+        profile = extract_fb_data({'id': '1', 'name': 'John Doe',
+                                   'gender': ''})
+        self.assertEqual(profile['accounts'][0]['userid'], '1')
+        self.assertFalse('gender' in profile)
+
+    def test_vk_strips_empty_values(self):
+        from velruse.providers.vk import extract_normalize_vk_data
+        profile = extract_normalize_vk_data({
+            'uid': 1, 'first_name': 'John', 'last_name': 'Doe'})
+        self.assertEqual(profile['displayName'], 'John Doe')
+        self.assertFalse('photos' in profile)
+        self.assertFalse('preferredUsername' in profile)
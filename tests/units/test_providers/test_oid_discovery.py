@@ -0,0 +1,86 @@
+import unittest
+
+
+HTML = (
+    '<html><head>'
+    '<link rel="openid2.provider" href="http://op.example.com/server">'
+    '</head></html>'
+)
+
+
+class DummyFetcher(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.urls = []
+
+    def fetch(self, url, body=None, headers=None):
+        from openid.fetchers import HTTPResponse
+        self.urls.append(url)
+        headers = dict(self.headers, **{'content-type': 'text/html'})
+        return HTTPResponse(url, 200, headers, HTML)
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+    def _makeOne(self, headers=None, **kw):
+        from velruse.providers.oid_discovery import DiscoveryCache
+        self.fetcher = DummyFetcher(headers)
+        return DiscoveryCache(fetcher=self.fetcher, **kw)
+
+    def test_caches_by_identifier(self):
+        cache = self._makeOne()
+        claimed_id, services = cache.discover('http://a/')
+        self.assertEqual(claimed_id, 'http://a/')
+        self.assertEqual(services[0].server_url,
+                         'http://op.example.com/server')
+        cache.discover('http://a/')
+        cache.discover('http://b/')
+        self.assertEqual(self.fetcher.urls, ['http://a/', 'http://b/'])
+
+    def test_normalized_identifier(self):
+        cache = self._makeOne()
+        cache.discover('a.example.com')
+        cache.discover('http://a.example.com/')
+        cache.discover(' HTTP://A.example.com ')
+        self.assertEqual(self.fetcher.urls, ['http://a.example.com/'])
+
+    def test_invalid_identifier(self):
+        from openid.consumer.discover import DiscoveryFailure
+        cache = self._makeOne()
+        self.assertRaises(DiscoveryFailure, cache.discover, 'ftp://a/')
+
+    def test_default_fetcher_untouched(self):
+        from openid import fetchers
+        default = fetchers.getDefaultFetcher()
+        self._makeOne().discover('http://a/')
+        self.assertTrue(fetchers.getDefaultFetcher() is default)
+
+    def test_respects_no_cache(self):
+        cache = self._makeOne({'Cache-Control': 'no-cache'})
+        cache.discover('http://a/')
+        cache.discover('http://a/')
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+    def test_respects_max_age(self):
+        import time
+        cache = self._makeOne({'cache-control': 'public, max-age=60'},
+                              ttl=3600)
+        cache.discover('http://a/')
+        value, expires_at = cache.cache._data['http://a/']
+        self.assertTrue(expires_at - time.time() <= 60)
+
+
+class TestResponseFreshness(unittest.TestCase):
+
+    def _callFUT(self, headers):
+        from velruse.providers.oid_discovery import response_freshness
+        return response_freshness(headers)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT({}), None)
+        self.assertEqual(self._callFUT({'Cache-Control': 'max-age=30'}), 30)
+        self.assertEqual(
+            self._callFUT({'Cache-Control': 'private, no-store'}), 0)
+        self.assertEqual(
+            self._callFUT({'Expires': 'Thu, 01 Dec 1994 16:00:00 GMT'}), 0)
+        self.assertEqual(self._callFUT({'Expires': '0'}), 0)
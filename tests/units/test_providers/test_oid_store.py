@@ -0,0 +1,111 @@
+import time
+import unittest
+
+
+def make_association(handle, issued=None, lifetime=600):
+    from openid.association import Association
+    if issued is None:
+        issued = time.time()
+    return Association(handle, b'secret', issued, lifetime, 'HMAC-SHA1')
+
+
+class StoreTests(object):
+
+    def test_associations(self):
+        store = self._makeOne()
+        url = 'https://op.example.com/'
+        self.assertEqual(store.getAssociation(url), None)
+        old = make_association('old', issued=time.time() - 10)
+        new = make_association('new')
+        store.storeAssociation(url, old)
+        store.storeAssociation(url, new)
+        self.assertEqual(store.getAssociation(url).handle, 'new')
+        self.assertEqual(store.getAssociation(url, 'old').handle, 'old')
+        self.assertTrue(store.removeAssociation(url, 'new'))
+        self.assertFalse(store.removeAssociation(url, 'new'))
+        self.assertEqual(store.getAssociation(url).handle, 'old')
+
+    def test_expired_association(self):
+        store = self._makeOne()
+        url = 'https://op.example.com/'
+        assoc = make_association('h', issued=time.time() - 20, lifetime=10)
+        store.storeAssociation(url, assoc)
+        self.assertEqual(store.getAssociation(url), None)
+        self.assertEqual(store.getAssociation(url, 'h'), None)
+
+    def test_nonces(self):
+        store = self._makeOne()
+        url = 'https://op.example.com/'
+        now = int(time.time())
+        self.assertTrue(store.useNonce(url, now, 'salt'))
+        self.assertFalse(store.useNonce(url, now, 'salt'))
+        self.assertTrue(store.useNonce(url, now, 'pepper'))
+        self.assertFalse(store.useNonce(url, now - 24 * 3600, 'old'))
+
+
+class TestMemoryOpenIDStore(StoreTests, unittest.TestCase):
+
+    def _makeOne(self):
+        from velruse.providers.oid_store import MemoryOpenIDStore
+        return MemoryOpenIDStore()
+
+    def test_cleanup_nonces_uses_expiry_index(self):
+        from openid.store import nonce
+        store = self._makeOne()
+        url = 'https://op.example.com/'
+        now = int(time.time())
+        store.useNonce(url, now - nonce.SKEW + 1, 'old')
+        store.useNonce(url, now, 'new')
+        self.assertEqual(store.cleanupNonces(), 0)
+        store._nonce_expiry[0] = (now - 1, store._nonce_expiry[0][1])
+        self.assertEqual(store.cleanupNonces(), 1)
+        self.assertEqual(len(store.nonces), 1)
+
+
+class TestKeyValueOpenIDStore(StoreTests, unittest.TestCase):
+
+    def _makeOne(self):
+        from anykeystore.backends.memory import MemoryStore
+        from velruse.providers.oid_store import KeyValueOpenIDStore
+        return KeyValueOpenIDStore(MemoryStore())
+
+    def test_shared_between_instances(self):
+        from anykeystore.backends.memory import MemoryStore
+        from velruse.providers.oid_store import KeyValueOpenIDStore
+        backend = MemoryStore()
+        a = KeyValueOpenIDStore(backend)
+        b = KeyValueOpenIDStore(backend)
+        url = 'https://op.example.com/'
+        a.storeAssociation(url, make_association('h'))
+        self.assertEqual(b.getAssociation(url).handle, 'h')
+        now = int(time.time())
+        self.assertTrue(a.useNonce(url, now, 'salt'))
+        self.assertFalse(b.useNonce(url, now, 'salt'))
+
+
+class TestOpenIDStoreArgument(unittest.TestCase):
+
+    def _callFUT(self, storage, registry=None):
+        from velruse.providers.oid_store import openid_store
+        return openid_store(storage, registry)
+
+    def test_it(self):
+        from anykeystore.backends.memory import MemoryStore
+        from openid.store.memstore import MemoryStore as OIDMemoryStore
+        from velruse.providers.oid_store import (
+            KeyValueOpenIDStore,
+            MemoryOpenIDStore,
+        )
+
+        class Registry(object):
+            velruse_store = MemoryStore()
+
+        self.assertTrue(isinstance(self._callFUT(None), MemoryOpenIDStore))
+        self.assertEqual(self._callFUT(False), None)
+        store = self._callFUT('velruse_store', Registry)
+        self.assertTrue(isinstance(store, KeyValueOpenIDStore))
+        self.assertTrue(store.store is Registry.velruse_store)
+        backend = MemoryStore()
+        self.assertTrue(self._callFUT(backend).store is backend)
+        oid_store = OIDMemoryStore()
+        self.assertTrue(self._callFUT(oid_store) is oid_store)
@@ -0,0 +1,132 @@
+import unittest
+
+from pyramid import testing
+
+
+class TestOpenIDConsumerSession(unittest.TestCase):
+
+    def setUp(self):
+        from anykeystore.backends.memory import MemoryStore
+        self.request = testing.DummyRequest()
+        self.request.registry.velruse_store = MemoryStore()
+
+    def _makeOne(self, **kw):
+        from velruse.providers.openid import OpenIDConsumer
+        return OpenIDConsumer('openid', 'openid', discovery_cache=False, **kw)
+
+    def test_in_pyramid_session(self):
+        consumer = self._makeOne()
+        consumer._save_openid_session(self.request, {'a': 1})
+        self.assertEqual(self.request.session['velruse.openid_session'],
+                         {'a': 1})
+        self.assertEqual(consumer._load_openid_session(self.request),
+                         {'a': 1})
+        self.assertEqual(consumer._load_openid_session(self.request), None)
+
+    def test_in_velruse_store(self):
+        consumer = self._makeOne(session_storage='velruse_store')
+        consumer._save_openid_session(self.request, {'a': 1})
+        key = self.request.session['velruse.openid_session_key']
+        self.assertFalse('velruse.openid_session' in self.request.session)
+        store = self.request.registry.velruse_store
+        self.assertEqual(store.retrieve(key), {'a': 1})
+        self.assertEqual(consumer._load_openid_session(self.request),
+                         {'a': 1})
+        self.assertRaises(KeyError, store.retrieve, key)
+        self.assertEqual(consumer._load_openid_session(self.request), None)
+
+    def test_expired_in_store(self):
+        consumer = self._makeOne(session_storage='velruse_store')
+        consumer._save_openid_session(self.request, {'a': 1})
+        self.request.registry.velruse_store._store.clear()
+        self.assertEqual(consumer._load_openid_session(self.request), None)
+
+
+class TestOpenIDConsumerExtensions(unittest.TestCase):
+
+    def _addExtensions(self, consumer):
+        from openid.message import Message, OPENID2_NS
+
+        class AuthRequest(object):
+            message = Message(OPENID2_NS)
+
+            def addExtension(self, ext):
+                ext.toMessage(self.message)
+
+        authrequest = AuthRequest()
+        consumer._update_authrequest(testing.DummyRequest(), authrequest)
+        return authrequest.message.toPostArgs()
+
+    def test_precompiled_once(self):
+        from velruse.providers.openid import OpenIDConsumer
+        consumer = OpenIDConsumer('openid', 'openid', discovery_cache=False)
+        extensions = consumer.auth_extensions
+        args = self._addExtensions(consumer)
+        self.assertTrue(consumer.auth_extensions is extensions)
+        self.assertEqual(args, self._addExtensions(consumer))
+        self.assertEqual(args['openid.ax.mode'], 'fetch_request')
+        self.assertTrue('openid.sreg.optional' in args)
+
+    def test_google_attributes(self):
+        from velruse.providers.google_hybrid import GoogleConsumer
+        from velruse.providers.openid import attributes
+        consumer = GoogleConsumer('google', attrs=['email'],
+                                  discovery_cache=False)
+        args = self._addExtensions(consumer)
+        self.assertEqual(args['openid.ax.required'], 'ext0')
+        self.assertEqual(args['openid.ax.type.ext0'], attributes['email'])
+
+
+class TestExtractOpenIDData(unittest.TestCase):
+
+    def _callFUT(self, identifier, sreg_data=None, ax_data=None):
+        from openid.extensions import ax, sreg
+        from velruse.providers.openid import attributes
+        from velruse.providers.openid import extract_openid_data
+        ax_resp = ax.FetchResponse()
+        for key, value in (ax_data or {}).items():
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                ax_resp.addValue(attributes[key], v)
+        sreg_resp = sreg.SRegResponse(data=sreg_data or {})
+        return extract_openid_data(identifier, sreg_resp, ax_resp)
+
+    def test_ax_preferred_over_sreg(self):
+        profile = self._callFUT(
+            'http://example.com/jdoe',
+            sreg_data={'nickname': 'sreg', 'fullname': 'John Doe',
+                       'dob': '1980-1-2', 'email': 'sreg@example.com'},
+            ax_data={'nickname': 'ax', 'gender': 'F'})
+        self.assertEqual(profile['preferredUsername'], 'ax')
+        self.assertEqual(profile['displayName'], 'John Doe')
+        self.assertEqual(profile['birthday'], '1980-01-02')
+        self.assertEqual(profile['gender'], 'female')
+        self.assertEqual(profile['emails'], ['sreg@example.com'])
+        self.assertFalse('verifiedEmail' in profile)
+
+    def test_verified_email_is_ax_only(self):
+        profile = self._callFUT(
+            'https://me.yahoo.com/jdoe',
+            sreg_data={'email': 'sreg@example.com'})
+        self.assertFalse('verifiedEmail' in profile)
+        profile = self._callFUT(
+            'https://me.yahoo.com/jdoe',
+            ax_data={'email': 'ax@example.com'})
+        self.assertEqual(profile['verifiedEmail'], 'ax@example.com')
+
+    def test_invalid_birthday(self):
+        profile = self._callFUT('http://example.com/jdoe',
+                                sreg_data={'dob': '1980-02-31'})
+        self.assertFalse('birthday' in profile)
+
+    def test_multiple_values_not_read(self):
+        profile = self._callFUT(
+            'http://example.com/jdoe',
+            ax_data={'nickname': 'ax', 'language': ['en', 'fr']})
+        self.assertEqual(profile['preferredUsername'], 'ax')
+
+    def test_multiple_values_read(self):
+        from openid.extensions import ax
+        self.assertRaises(ax.AXError, self._callFUT,
+                          'http://example.com/jdoe',
+                          ax_data={'nickname': ['a', 'b']})
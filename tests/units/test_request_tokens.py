@@ -0,0 +1,145 @@
+import unittest
+
+
+class DummyFetch(object):
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, callback_uri):
+        if self.fail:
+            raise ValueError('down')
+        self.calls.append(callback_uri)
+        return {'oauth_token': 't%s' % len(self.calls),
+                'oauth_token_secret': 's'}
+
+
+class TestRequestTokenPool(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from velruse.request_tokens import RequestTokenPool
+        kw.setdefault('background', False)
+        hosts = kw.pop('hosts', ['http://example.com', 'http://a.example.com',
+                                 'http://b.example.com'])
+        return RequestTokenPool(hosts, **kw)
+
+    def test_falls_back_to_fetch(self):
+        pool = self._makeOne(size=2)
+        fetch = DummyFetch()
+        token = pool.take('http://example.com/cb', fetch)
+        self.assertEqual(token['oauth_token'], 't1')
+        self.assertEqual(pool.stats()['misses'], 1)
+
+    def test_refill(self):
+        pool = self._makeOne(size=2)
+        fetch = DummyFetch()
+        pool.take('http://example.com/cb', fetch)
+        pool.refill()
+        self.assertEqual(len(fetch.calls), 3)
+        self.assertEqual(pool.available(), 2)
+        token = pool.take('http://example.com/cb', fetch)
+        self.assertEqual(token['oauth_token'], 't2')
+        self.assertEqual(len(fetch.calls), 3)
+        self.assertEqual(pool.take('http://example.com/cb', fetch),
+                         {'oauth_token': 't3', 'oauth_token_secret': 's'})
+        stats = pool.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['fetched'], 2)
+        self.assertEqual(stats['available'], 0)
+
+    def test_pooled_per_callback(self):
+        pool = self._makeOne(size=1)
+        fetch = DummyFetch()
+        pool.take('http://a.example.com/cb', fetch)
+        pool.refill()
+        pool.take('http://b.example.com/cb', fetch)
+        self.assertEqual(fetch.calls[-1], 'http://b.example.com/cb')
+
+    def test_other_hosts_not_pooled(self):
+        pool = self._makeOne(size=1, hosts=['https://Example.com/'])
+        fetch = DummyFetch()
+        pool.take('http://example.com/cb', fetch)
+        pool.take('https://evil.example.com/cb', fetch)
+        pool.take('https://example.com/cb', fetch)
+        pool.refill()
+        self.assertEqual(fetch.calls[-1], 'https://example.com/cb')
+        self.assertEqual(len(fetch.calls), 4)
+        self.assertEqual(pool.available(), 1)
+
+    def test_expired_tokens_discarded(self):
+        pool = self._makeOne(size=1, ttl=-1)
+        fetch = DummyFetch()
+        pool.take('http://example.com/cb', fetch)
+        pool.refill()
+        self.assertEqual(pool.take('http://example.com/cb', fetch),
+                         {'oauth_token': 't3', 'oauth_token_secret': 's'})
+        self.assertEqual(pool.stats()['expired'], 1)
+
+    def test_failed_refill(self):
+        pool = self._makeOne(size=1)
+        fetch = DummyFetch(fail=True)
+        self.assertRaises(ValueError, pool.take, 'http://example.com/cb',
+                          fetch)
+        pool.refill()
+        self.assertEqual(pool.stats()['failed'], 1)
+        self.assertEqual(pool.available(), 0)
+
+    def test_background_refill(self):
+        import time
+        pool = self._makeOne(size=1, background=True)
+        fetch = DummyFetch()
+        pool.take('http://example.com/cb', fetch)
+        for i in range(100):
+            if pool.available():
+                break
+            time.sleep(0.01)
+        self.assertEqual(pool.available(), 1)
+
+    def test_from_settings(self):
+        from velruse.request_tokens import request_token_pool_from_settings
+        self.assertEqual(request_token_pool_from_settings({}, 'p.'), None)
+        pool = request_token_pool_from_settings({
+            'p.request_token_pool.size': '3',
+            'p.request_token_pool.ttl': '60',
+            'p.request_token_pool.hosts': 'https://example.com\n'
+                                          'https://www.example.com',
+        }, 'p.')
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.ttl, 60)
+        self.assertEqual(pool.hosts, frozenset([
+            'https://example.com', 'https://www.example.com']))
+
+    def test_from_settings_requires_hosts(self):
+        from pyramid.exceptions import ConfigurationError
+        from velruse.request_tokens import request_token_pool_from_settings
+        self.assertRaises(ConfigurationError,
+                          request_token_pool_from_settings,
+                          {'p.request_token_pool.size': '3'}, 'p.')
+
+
+class TestTwitterLogin(unittest.TestCase):
+
+    def test_pooled_request_token(self):
+        from pyramid import testing
+        from velruse.providers import twitter
+        from velruse.request_tokens import RequestTokenPool
+        pool = RequestTokenPool(['http://example.com'], size=1,
+                                background=False)
+        provider = twitter.TwitterProvider(
+            'twitter', 'key', 'secret', request_token_pool=pool)
+        fetch = DummyFetch()
+        provider._fetch_request_token = fetch
+        config = testing.setUp()
+        try:
+            config.add_route(provider.callback_route, '/callback')
+            request = testing.DummyRequest()
+            resp = provider.login(request)
+            self.assertTrue(resp.location.endswith('oauth_token=t1'))
+            pool.refill()
+            resp = provider.login(request)
+            self.assertTrue(resp.location.endswith('oauth_token=t2'))
+            self.assertEqual(request.session['velruse.token']['oauth_token'],
+                             't2')
+            self.assertEqual(fetch.calls, ['http://example.com/callback'] * 2)
+        finally:
+            testing.tearDown()
@@ -0,0 +1,154 @@
+import unittest
+
+from pyramid import testing
+
+
+class TestSessionState(unittest.TestCase):
+
+    def _makeOne(self):
+        from velruse.state import SessionState
+        return SessionState()
+
+    def test_roundtrip(self):
+        manager = self._makeOne()
+        request = testing.DummyRequest()
+        state = manager.issue(request, 'facebook')
+        self.assertEqual(request.session['velruse.state'], state)
+        request.GET['state'] = state
+        manager.verify(request, 'facebook')
+        self.assertFalse('velruse.state' in request.session)
+
+    def test_mismatch(self):
+        from velruse.exceptions import CSRFError
+        manager = self._makeOne()
+        request = testing.DummyRequest()
+        manager.issue(request, 'facebook')
+        request.GET['state'] = 'forged'
+        self.assertRaises(CSRFError, manager.verify, request, 'facebook')
+
+    def test_duplicate(self):
+        from velruse.exceptions import CSRFError
+        manager = self._makeOne()
+        request = testing.DummyRequest()
+        state = manager.issue(request, 'facebook')
+        browser = manager.browser_key(request)
+        self.assertTrue(browser)
+        request.GET['state'] = state
+        # sent by the browser before the first callback verified the state
+        manager.verify_duplicate(request, 'facebook')
+        manager.verify(request, 'facebook')
+        self.assertRaises(CSRFError, manager.verify, request, 'facebook')
+        manager.verify_duplicate(request, 'facebook')
+        request.GET['state'] = 'forged'
+        self.assertRaises(CSRFError, manager.verify_duplicate, request,
+                          'facebook')
+        manager.issue(request, 'facebook')
+        self.assertEqual(manager.browser_key(request), browser)
+
+
+class TestSignedState(unittest.TestCase):
+
+    def _makeOne(self, secret='seekrit', **kw):
+        from velruse.state import SignedState
+        return SignedState(secret, **kw)
+
+    def _issue(self, manager, name='facebook', cookies=None):
+        from webob import Response
+        request = testing.DummyRequest(cookies=cookies or {})
+        state = manager.issue(request, name)
+        response = Response()
+        for callback in request.response_callbacks:
+            callback(request, response)
+        cookie = response.headers['Set-Cookie']
+        return state, cookie.split(';')[0].split('=', 1)[1]
+
+    def _verify(self, manager, state, cookie, name='facebook'):
+        request = testing.DummyRequest(params={'state': state})
+        request.GET = request.params
+        if cookie is not None:
+            request.cookies['velruse.state'] = cookie
+        return manager.verify(request, name)
+
+    def test_roundtrip_without_session(self):
+        manager = self._makeOne()
+        request = testing.DummyRequest()
+        manager.issue(request, 'facebook')
+        self.assertEqual(dict(request.session), {})
+        state, cookie = self._issue(manager)
+        self._verify(self._makeOne(), state, cookie)
+
+    def test_cookie(self):
+        manager = self._makeOne()
+        state, cookie = self._issue(manager)
+        self.assertEqual(len(cookie), 32)
+        # the browser's cookie is kept for its next logins
+        state, again = self._issue(manager, cookies={'velruse.state': cookie})
+        self.assertEqual(again, cookie)
+        self._verify(manager, state, cookie)
+
+    def test_other_browser(self):
+        from velruse.exceptions import CSRFError
+        manager = self._makeOne()
+        state, cookie = self._issue(manager)
+        self.assertRaises(CSRFError, self._verify, manager, state, None)
+        self.assertRaises(CSRFError, self._verify, manager, state, 'other')
+
+    def test_browser_key(self):
+        manager = self._makeOne()
+        state, cookie = self._issue(manager)
+        request = testing.DummyRequest(cookies={'velruse.state': cookie})
+        self.assertEqual(manager.browser_key(request), cookie)
+        self.assertEqual(manager.browser_key(testing.DummyRequest()), None)
+
+    def test_wrong_secret_or_provider(self):
+        from velruse.exceptions import CSRFError
+        state, cookie = self._issue(self._makeOne())
+        self.assertRaises(CSRFError, self._verify,
+                          self._makeOne('other'), state, cookie)
+        self.assertRaises(CSRFError, self._verify,
+                          self._makeOne(), state, cookie, 'github')
+
+    def test_tampered(self):
+        from velruse.exceptions import CSRFError
+        manager = self._makeOne()
+        state, cookie = self._issue(manager)
+        timestamp, nonce, signature = state.split('.')
+        forged = '.'.join([str(int(timestamp) + 1), nonce, signature])
+        self.assertRaises(CSRFError, self._verify, manager, forged, cookie)
+        self.assertRaises(CSRFError, self._verify, manager, '', cookie)
+        self.assertRaises(CSRFError, self._verify, manager, 'a.b.c', cookie)
+
+    def test_expired(self):
+        from velruse.exceptions import CSRFError
+        manager = self._makeOne(max_age=-100)
+        state, cookie = self._issue(manager)
+        self.assertRaises(CSRFError, self._verify, manager, state, cookie)
+
+    def test_requires_secret(self):
+        self.assertRaises(ValueError, self._makeOne, '')
+
+
+class TestCompareDigest(unittest.TestCase):
+
+    def _callFUT(self, a, b):
+        from velruse.compat import compare_digest
+        return compare_digest(a, b)
+
+    def test_it(self):
+        self.assertTrue(self._callFUT('abc', 'abc'))
+        self.assertFalse(self._callFUT('abc', 'abd'))
+        self.assertFalse(self._callFUT('abc', 'ab'))
+
+
+class TestStateManagerFromSettings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from velruse.state import state_manager_from_settings
+        return state_manager_from_settings(settings, 'p.')
+
+    def test_it(self):
+        self.assertEqual(self._callFUT({}), None)
+        manager = self._callFUT({'p.state_secret': 'seekrit',
+                                 'p.state_max_age': '60'})
+        self.assertEqual(manager.secret, b'seekrit')
+        self.assertEqual(manager.max_age, 60)
@@ -1,57 +1,281 @@
+from io import BytesIO
 import os
+import time
 
 from anykeystore import create_store_from_settings
 
 from pyramid.config import Configurator
 from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
 from pyramid.response import Response
 
+from velruse.app.codecs import dumps_json
+from velruse.app.fields import mask_from_settings
+from velruse.app.results import results_from_settings
+from velruse.app.tokens import tokens_from_settings
 from velruse.app.utils import generate_token
 from velruse.app.utils import redirect_form
+from velruse.app.utils import sign_payload
+from velruse.client import client_from_settings
+from velruse.compat import STRING_TYPES
+from velruse.compat import urlsplit
 
 
 log = __import__('logging').getLogger(__name__)
 
+DEFAULT_MAX_BATCH = 100
+DEFAULT_PUSH_TIMEOUT = 5.0
+
 
 def auth_complete_view(context, request):
-    endpoint = request.registry.settings.get('endpoint')
-    token = generate_token()
-    storage = request.registry.velruse_store
+    profile = context.profile
+    mask = request.registry.velruse_profile_mask
+    if mask is not None:
+        profile = mask.apply(profile, context.provider_name)
     result_data = {
         'provider_type': context.provider_type,
         'provider_name': context.provider_name,
-        'profile': context.profile,
+        'profile': profile,
         'credentials': context.credentials,
     }
-    storage.store(token, result_data, expires=300)
-    form = redirect_form(endpoint, token)
-    return Response(body=form)
+    return deliver_result(context, request, result_data)
 
 
 def auth_denied_view(context, request):
-    endpoint = request.registry.settings.get('endpoint')
-    token = generate_token()
-    storage = request.registry.velruse_store
     error_dict = {
         'provider_type': context.provider_type,
         'provider_name': context.provider_name,
         'error': context.reason,
     }
-    storage.store(token, error_dict, expires=300)
+    return deliver_result(context, request, error_dict)
+
+
+def deliver_result(context, request, result):
+    """Hand the result of a login to the application using the configured
+    ``delivery`` mode."""
+    mode = request.registry.settings.get('delivery') or 'store'
+    return delivery_modes[mode](context, request, result)
+
+
+def result_token(context, issue=generate_token):
+    """Return the token for the result of ``context`` and whether it was
+    just issued by calling ``issue``.
+
+    A context returned again for a duplicate callback (see
+    :class:`velruse.cache.CallbackCache`) keeps the token it was first
+    given, so the application receives the same token twice and the
+    result is only delivered once.
+    """
+    token = issue()
+    # setdefault is atomic, concurrent duplicates get the same token
+    first_token = vars(context).setdefault('velruse_token', token)
+    return first_token, first_token is token
+
+
+def store_delivery(context, request, result):
+    """Keep the result in the store and POST its token to ``endpoint``."""
+    endpoint = request.registry.settings.get('endpoint')
+    token, issued = result_token(context)
+    if issued:
+        request.registry.velruse_results.store_json(
+            token, dumps_json(result), denied='error' in result)
     form = redirect_form(endpoint, token)
     return Response(body=form)
 
 
+def environ_delivery(context, request, result):
+    """Call the application wrapped by
+    :func:`velruse.app.middleware.make_velruse_middleware` directly.
+
+    The application receives a ``GET`` request for the path of
+    ``endpoint`` with the result in ``environ['velruse.result']`` and the
+    :class:`~velruse.AuthenticationComplete` or
+    :class:`~velruse.AuthenticationDenied` context in
+    ``environ['velruse.context']``.
+    """
+    endpoint = request.registry.settings.get('endpoint')
+    environ = dict(request.environ)
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': urlsplit(endpoint).path or '/',
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': BytesIO(),
+        'velruse.result': result,
+        'velruse.context': context,
+    })
+    environ.pop('CONTENT_TYPE', None)
+    return Request(environ).get_response(request.registry.velruse_app)
+
+
+def push_delivery(context, request, result):
+    """POST the result to ``push.url`` before sending the user to
+    ``endpoint``.
+
+    The body is the JSON object ``{"token": ..., "result": ...}`` and is
+    signed with ``push.secret`` (see
+    :func:`velruse.app.utils.sign_payload`). The same token is then POSTed
+    to ``endpoint`` by the user's browser. If the push is not acknowledged
+    with a 2xx response, even after retrying, the result is kept in the
+    store as with the ``store`` mode and can be fetched with ``auth_info``.
+
+    The push is sent once, without retries or hedging, so the application
+    never receives it twice.
+    """
+    settings = request.registry.settings
+    token, issued = result_token(context)
+    if not issued:
+        form = redirect_form(settings.get('endpoint'), token)
+        return Response(body=form)
+    data = dumps_json(result)
+    body = b''.join([
+        b'{"token":', dumps_json(token), b',"result":', data, b'}'])
+    timestamp = str(int(time.time()))
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Velruse-Timestamp': timestamp,
+        'X-Velruse-Signature': sign_payload(
+            settings['push.secret'], timestamp, body),
+    }
+    client = request.registry.velruse_push_client
+    try:
+        resp = client.post(settings['push.url'], data=body, headers=headers,
+                           endpoint='push', idempotent=False)
+        pushed = 200 <= resp.status_code < 300
+        if not pushed:
+            log.warning('push of %s rejected with status %s',
+                        token, resp.status_code)
+    except Exception:
+        log.exception('push of %s failed', token)
+        pushed = False
+    if not pushed:
+        request.registry.velruse_results.store_json(
+            token, data, denied='error' in result)
+    form = redirect_form(settings.get('endpoint'), token)
+    return Response(body=form)
+
+
+def token_delivery(context, request, result):
+    """POST a token holding the encrypted result to ``endpoint``.
+
+    Nothing is stored. The token is decoded by ``auth_info`` or by the
+    application itself, see :class:`velruse.app.tokens.EncryptedTokens`.
+    """
+    endpoint = request.registry.settings.get('endpoint')
+    token = result_token(
+        context, lambda: request.registry.velruse_tokens.encode(result))[0]
+    form = redirect_form(endpoint, token)
+    return Response(body=form)
+
+
+delivery_modes = {
+    'store': store_delivery,
+    'environ': environ_delivery,
+    'push': push_delivery,
+    'token': token_delivery,
+}
+
+
+def json_response(body, status=200):
+    return Response(body=body, status=status,
+                    content_type='application/json', charset='utf-8')
+
+
+def json_object_response(items):
+    """Return a JSON object from a dictionary of JSON bytes or `None`"""
+    body = b','.join(dumps_json(key) + b':' + (b'null' if v is None else v)
+                     for key, v in items.items())
+    return json_response(b'{' + body + b'}')
+
+
+def enrich_result(request, result):
+    """Complete the ``partial`` profile of ``result`` using the
+    ``enrich_profile`` method of its provider.
+
+    The result is returned unchanged if its profile is complete, or if it
+    can't be enriched.
+    """
+    profile = result.get('profile')
+    if not profile or not profile.get('partial'):
+        return result
+    providers = getattr(request.registry, 'velruse_providers', {})
+    provider = providers.get(result.get('provider_name'))
+    enrich = getattr(provider, 'enrich_profile', None)
+    if enrich is None:
+        return result
+    try:
+        profile = enrich(profile, result.get('credentials') or {})
+    except Exception:
+        log.exception('failed to enrich the %s profile',
+                      result.get('provider_name'))
+        return result
+    mask = request.registry.velruse_profile_mask
+    if mask is not None:
+        profile = mask.apply(profile, result.get('provider_name'))
+    return dict(result, profile=profile)
+
+
 def auth_info_view(request):
     # TODO: insecure URL, must be protected behind a firewall
-    storage = request.registry.velruse_store
     token = request.GET.get('token')
+    full = request.GET.get('profile') == 'full'
     try:
-        return storage.retrieve(token)
+        if request.registry.settings.get('delivery') == 'token':
+            result = request.registry.velruse_tokens.decode(token)
+        elif full:
+            result = request.registry.velruse_results.retrieve(token)
+        else:
+            # stored as JSON, returned without being parsed again
+            return json_response(
+                request.registry.velruse_results.retrieve_json(token))
     except KeyError:
-        log.info('auth_info requested invalid token "%s"')
-        request.response.status = 400
-        return None
+        log.info('auth_info requested invalid token "%s"', token)
+        return json_response(b'null', status=400)
+    if full:
+        result = enrich_result(request, result)
+    return json_response(dumps_json(result))
+
+
+def auth_info_batch_view(request):
+    """Return the results of a JSON list of tokens POSTed to ``auth_info``.
+
+    The response maps each token to its result, or to ``null`` if the token
+    is invalid or expired. At most ``auth_info.max_batch`` tokens (default
+    100) are accepted at once.
+    """
+    try:
+        tokens = request.json_body
+    except ValueError:
+        tokens = None
+    max_batch = int(request.registry.settings.get(
+        'auth_info.max_batch', DEFAULT_MAX_BATCH))
+    if (not isinstance(tokens, list) or len(tokens) > max_batch or
+            not all(isinstance(t, STRING_TYPES) for t in tokens)):
+        log.info('auth_info received an invalid batch')
+        return json_response(b'null', status=400)
+
+    full = request.GET.get('profile') == 'full'
+    if request.registry.settings.get('delivery') == 'token':
+        decode = request.registry.velruse_tokens.decode
+        results = {}
+        for token in tokens:
+            try:
+                results[token] = decode(token)
+            except KeyError:
+                results[token] = None
+    elif full:
+        results = request.registry.velruse_results.retrieve_many(tokens)
+    else:
+        # stored as JSON, returned without being parsed again
+        return json_object_response(
+            request.registry.velruse_results.retrieve_many_json(tokens))
+
+    for token, result in results.items():
+        if result is not None:
+            if full:
+                result = enrich_result(request, result)
+            results[token] = dumps_json(result)
+    return json_object_response(results)
 
 
 def default_setup(config):
@@ -70,7 +294,8 @@ def default_setup(config):
 
     ``store.*`` settings are used by the `anykeystore` library to construct
     a storage backend for user credentials. If no storage settings are
-    specified then an in-memory storage backend will be used.
+    specified then an in-memory storage backend will be used. No store is
+    created for the ``environ`` and ``token`` delivery modes.
 
     """
     from pyramid.session import UnencryptedCookieSessionFactoryConfig
@@ -92,6 +317,10 @@ def default_setup(config):
         secret, cookie_name=cookie_name)
     config.set_session_factory(factory)
 
+    # results are handed to the application, nothing to store
+    if settings.get('delivery') in ('environ', 'token'):
+        return
+
     # setup backing storage
     storage_string = settings.get('store', 'memory')
     settings['store.store'] = storage_string
@@ -173,6 +402,43 @@ def includeme(config):
     if not settings.get('endpoint'):
         raise ConfigurationError(
             'missing required setting "endpoint"')
+    delivery = settings.get('delivery') or 'store'
+    if delivery not in delivery_modes:
+        raise ConfigurationError(
+            'unknown delivery mode "%s"' % delivery)
+    if (delivery == 'environ' and
+            getattr(config.registry, 'velruse_app', None) is None):
+        raise ConfigurationError(
+            'the "environ" delivery mode requires wrapping an application '
+            'with velruse.app.middleware.make_velruse_middleware')
+    if delivery == 'push':
+        for key in ('push.url', 'push.secret'):
+            if not settings.get(key):
+                raise ConfigurationError(
+                    'missing required setting "%s"' % key)
+        # the user waits for the push, so it gets short timeouts by default
+        push_settings = {
+            'push.timeout.connect': DEFAULT_PUSH_TIMEOUT,
+            'push.timeout.read': DEFAULT_PUSH_TIMEOUT,
+        }
+        push_settings.update(settings)
+        config.registry.velruse_push_client = client_from_settings(
+            push_settings, prefix='push.')
+    if delivery in ('store', 'push'):
+        try:
+            config.registry.velruse_results = results_from_settings(
+                settings, lambda: config.registry.velruse_store)
+        except (ImportError, ValueError) as e:
+            raise ConfigurationError(str(e))
+    config.registry.velruse_profile_mask = mask_from_settings(settings)
+    if delivery == 'token':
+        if not settings.get('token.secret'):
+            raise ConfigurationError(
+                'missing required setting "token.secret"')
+        try:
+            config.registry.velruse_tokens = tokens_from_settings(settings)
+        except ImportError as e:
+            raise ConfigurationError(str(e))
 
     # add views
     config.add_view(
@@ -181,11 +447,16 @@ def includeme(config):
     config.add_view(
         auth_denied_view,
         context='velruse.AuthenticationDenied')
-    config.add_view(
-        auth_info_view,
-        name='auth_info',
-        request_param='format=json',
-        renderer='json')
+    if delivery != 'environ':
+        config.add_view(
+            auth_info_view,
+            name='auth_info',
+            request_param='format=json')
+        config.add_view(
+            auth_info_batch_view,
+            name='auth_info',
+            request_method='POST',
+            request_param='format=json')
 
 
 def make_app(global_conf, **settings):
@@ -0,0 +1,131 @@
+"""Codecs for the results kept in the Velruse store"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError: #pragma NO COVER
+    msgpack = None
+
+
+DEFAULT_COMPRESS_THRESHOLD = 1024
+DEFAULT_COMPRESS_LEVEL = 6
+
+RAW = b'r'
+COMPRESSED = b'z'
+
+
+class Codec(object):
+    """Serialize results to bytes, compressing them with zlib when they are
+    larger than ``compress_threshold`` bytes (``0`` disables compression).
+
+    Subclasses implement :meth:`dumps` and :meth:`loads`. The encoded
+    value starts with a byte telling whether the rest is compressed.
+
+    """
+    def __init__(self, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def encode(self, value):
+        return self._wrap(self.dumps(value))
+
+    def decode(self, data):
+        return self.loads(self._unwrap(data))
+
+    def encode_json(self, data):
+        """Encode a value already serialized as JSON bytes"""
+        return self.encode(json.loads(data.decode('utf-8')))
+
+    def decode_json(self, data):
+        """Decode a value to JSON bytes"""
+        return dumps_json(self.decode(data))
+
+    def _wrap(self, data):
+        if self.compress_threshold and len(data) > self.compress_threshold:
+            return COMPRESSED + zlib.compress(data, self.compress_level)
+        return RAW + data
+
+    def _unwrap(self, data):
+        flag, data = data[:1], data[1:]
+        if flag == COMPRESSED:
+            data = zlib.decompress(data)
+        return data
+
+
+def dumps_json(value):
+    """Serialize ``value`` to compact UTF-8 encoded JSON"""
+    data = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+    return data.encode('utf-8')
+
+
+def loads_json(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class JSONCodec(Codec):
+    """Compact JSON
+
+    JSON bytes are stored and returned without being parsed again.
+    """
+
+    def dumps(self, value):
+        return dumps_json(value)
+
+    def loads(self, data):
+        return loads_json(data)
+
+    def encode_json(self, data):
+        return self._wrap(data)
+
+    def decode_json(self, data):
+        return self._unwrap(data)
+
+
+class MsgpackCodec(Codec):
+    """MessagePack, requires the optional `msgpack` package"""
+
+    def __init__(self, *args, **kw):
+        if msgpack is None:
+            raise ImportError(
+                'the "msgpack" package is required for the msgpack codec')
+        super(MsgpackCodec, self).__init__(*args, **kw)
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs = {
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def codec_from_settings(settings, prefix='results.'):
+    """Return the codec selected by ``<prefix>codec`` or `None` to store
+    results as plain JSON.
+
+    ``<prefix>compress_threshold`` and ``<prefix>compress_level`` configure
+    the compression.
+    """
+    name = settings.get(prefix + 'codec')
+    if not name or name == 'none':
+        return None
+    if name not in codecs:
+        raise ValueError('unknown codec "%s"' % name)
+    return codecs[name](
+        compress_threshold=int(settings.get(
+            prefix + 'compress_threshold', DEFAULT_COMPRESS_THRESHOLD)),
+        compress_level=int(settings.get(
+            prefix + 'compress_level', DEFAULT_COMPRESS_LEVEL)),
+    )
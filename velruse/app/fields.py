@@ -0,0 +1,107 @@
+"""Projecting login profiles onto the fields used by the application"""
+import re
+import threading
+
+from velruse.app.codecs import dumps_json
+from velruse.compat import STRING_TYPES
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+def parse_fields(fields):
+    """Parse a list of fields, or a string of fields separated by commas or
+    whitespace, into a tree of nested dictionaries.
+
+    A dotted field such as ``name.formatted`` selects a key of a nested
+    dictionary, or of each dictionary in a nested list. A leaf is `None`,
+    selecting the whole value.
+    """
+    if isinstance(fields, STRING_TYPES):
+        fields = re.split(r'[\s,]+', fields)
+    tree = {}
+    for field in fields:
+        if not field:
+            continue
+        node = tree
+        parts = field.split('.')
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def project(value, tree):
+    """Return the parts of ``value`` selected by ``tree``"""
+    if tree is None:
+        return value
+    if isinstance(value, dict):
+        return dict((k, project(value[k], sub))
+                    for k, sub in tree.items() if k in value)
+    if isinstance(value, list):
+        return [project(v, tree) for v in value]
+    return value
+
+
+class ProfileMask(object):
+    """Keep only some fields of the profiles returned by the providers.
+
+    ``fields`` applies to every provider, unless ``provider_fields`` maps
+    the provider's name to its own fields. Both use the format of
+    :func:`parse_fields`. Profiles of providers without fields, or mapped
+    to empty fields, are left untouched. The ``partial`` flag of a profile
+    is always kept.
+
+    The sizes of the profiles, serialized as JSON, before and after the
+    projection are added up and returned by :meth:`stats`.
+
+    """
+    def __init__(self, fields=None, provider_fields=None):
+        self.fields = parse_fields(fields) if fields else None
+        self.provider_fields = dict(
+            (name, parse_fields(f) if f else None)
+            for name, f in (provider_fields or {}).items())
+        self.counters = dict(projected=0, bytes_before=0, bytes_after=0)
+        self._lock = threading.Lock()
+
+    def apply(self, profile, provider_name):
+        """Return the fields of ``profile`` to keep"""
+        tree = self.provider_fields.get(provider_name, self.fields)
+        if tree is None or profile is None:
+            return profile
+        projected = project(profile, tree)
+        if 'partial' in profile:
+            projected['partial'] = profile['partial']
+        before = len(dumps_json(profile))
+        after = len(dumps_json(projected))
+        with self._lock:
+            self.counters['projected'] += 1
+            self.counters['bytes_before'] += before
+            self.counters['bytes_after'] += after
+        log.debug('projected %s profile from %s to %s bytes',
+                  provider_name, before, after)
+        return projected
+
+    def stats(self):
+        """Return the counters along with the number of bytes saved"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['bytes_saved'] = stats['bytes_before'] - stats['bytes_after']
+        return stats
+
+
+def mask_from_settings(settings, prefix='profile_fields'):
+    """Create a :class:`ProfileMask` from the ``profile_fields`` setting and
+    the ``profile_fields.<provider name>`` settings, or return `None` if
+    none is set."""
+    fields = settings.get(prefix)
+    provider_fields = dict(
+        (key[len(prefix) + 1:], value)
+        for key, value in settings.items()
+        if key.startswith(prefix + '.'))
+    if not fields and not provider_fields:
+        return None
+    return ProfileMask(fields, provider_fields)
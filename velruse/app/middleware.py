@@ -0,0 +1,53 @@
+"""WSGI middleware passing login results straight to an application"""
+from pyramid.config import Configurator
+
+
+def passthrough_view(request):
+    """Let the wrapped application handle anything Velruse doesn't"""
+    return request.get_response(request.registry.velruse_app)
+
+
+def make_velruse_middleware(app, global_conf=None, **settings):
+    """Wrap the WSGI application ``app`` with the Velruse providers.
+
+    The middleware handles the login and callback URLs of the configured
+    providers and passes every other request to ``app``. Once a login
+    completes or is denied, ``app`` is called in-process with a ``GET``
+    request for the path of the ``endpoint`` setting and the result in the
+    environ. No store is needed and the ``auth_info`` view is not
+    available.
+
+    ``environ['velruse.result']``
+        The same dictionary that ``auth_info`` returns in the other modes.
+
+    ``environ['velruse.context']``
+        The :class:`~velruse.AuthenticationComplete` or
+        :class:`~velruse.AuthenticationDenied` instance.
+
+    It accepts the same settings as :func:`velruse.app.make_app` and is
+    compatible with the `PasteDeploy` filter-app factory API.
+
+    Example INI file:
+
+    .. code-block:: ini
+
+        [filter-app:main]
+        use = egg:velruse#middleware
+        next = YOURAPP
+
+        endpoint = /logged_in
+
+        provider.facebook.consumer_key = KMfXjzsA2qVUcnnRn3vpnwWZ2pwPRFZdb
+        provider.facebook.consumer_secret =
+            ULZ6PkJbsqw2GxZWCIbOEBZdkrb9XwgXNjRy
+
+        [app:YOURAPP]
+        use = egg:YOURAPP
+
+    """
+    settings['delivery'] = 'environ'
+    config = Configurator(settings=settings)
+    config.registry.velruse_app = app
+    config.include('velruse.app')
+    config.add_notfound_view(passthrough_view)
+    return config.make_wsgi_app()
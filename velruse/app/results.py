@@ -0,0 +1,298 @@
+"""Keeping login results in the Velruse store"""
+from datetime import datetime
+import os
+import threading
+import time
+
+from anykeystore.backends.memcached import MemcachedStore
+from anykeystore.backends.memory import MemoryStore
+from anykeystore.backends.redis import RedisStore
+from anykeystore.compat import pickle
+
+from velruse.app.codecs import codec_from_settings
+from velruse.app.codecs import dumps_json
+from velruse.app.codecs import loads_json
+from velruse.client import asbool
+
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_TTL = 300
+DEFAULT_SWEEP_INTERVAL = 60
+
+
+class ResultStore(object):
+    """Store login results under their token in an `anykeystore` backend.
+
+    ``storage`` is the backend, or a callable returning it, which lets the
+    backend be registered after the result store is created.
+
+    Complete and denied results are kept for ``complete_ttl`` and
+    ``denied_ttl`` seconds. With ``consume`` a result is deleted when it
+    is read, so it can only be retrieved once. The deletion is atomic on
+    the memory backend and on the Redis backend, when it exposes its
+    connection.
+
+    Backends that don't expire keys on their own are purged every
+    ``sweep_interval`` seconds by a background thread, started with the
+    first stored result. Use ``0`` to disable it.
+
+    Results are serialized to JSON once, when they are stored, and
+    :meth:`retrieve_json` returns them without parsing them again.
+    ``codec`` is a :class:`velruse.app.codecs.Codec` changing how they are
+    encoded in the backend. By default the JSON bytes are stored as they
+    are.
+
+    """
+    def __init__(self, storage, complete_ttl=DEFAULT_TTL,
+                 denied_ttl=DEFAULT_TTL, consume=False,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL, codec=None):
+        self._storage = storage
+        self.codec = codec
+        self.complete_ttl = complete_ttl
+        self.denied_ttl = denied_ttl
+        self.consume = consume
+        self.sweep_interval = sweep_interval
+        self.counters = dict(stored=0, retrieved=0, missed=0, consumed=0,
+                             swept=0)
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+
+    @property
+    def storage(self):
+        if callable(self._storage):
+            return self._storage()
+        return self._storage
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def store(self, token, result):
+        """Keep ``result`` under ``token`` for the TTL matching its kind"""
+        self.store_json(token, dumps_json(result), denied='error' in result)
+
+    def store_json(self, token, data, denied=False):
+        """Keep a result already serialized as JSON bytes under ``token``"""
+        ttl = self.denied_ttl if denied else self.complete_ttl
+        if self.codec is not None:
+            data = self.codec.encode_json(data)
+        self.storage.store(token, data, expires=ttl)
+        self._count('stored')
+        self._start_sweeper()
+
+    def retrieve(self, token):
+        """Return the result kept under ``token`` or raise a `KeyError`"""
+        return self._decode(self._get(token))
+
+    def retrieve_json(self, token):
+        """Return the result kept under ``token`` as JSON bytes, without
+        parsing it, or raise a `KeyError`"""
+        return self._decode_json(self._get(token))
+
+    def _decode(self, value):
+        if isinstance(value, dict):
+            # stored as is by an earlier version
+            return value
+        if self.codec is None:
+            return loads_json(value)
+        return self.codec.decode(value)
+
+    def _decode_json(self, value):
+        if isinstance(value, dict):
+            return dumps_json(value)
+        if self.codec is None:
+            return value
+        return self.codec.decode_json(value)
+
+    def _get(self, token):
+        storage = self.storage
+        try:
+            if not self.consume:
+                value = storage.retrieve(token)
+            else:
+                value = self._take(storage, token)
+                self._count('consumed')
+        except KeyError:
+            self._count('missed')
+            raise
+        self._count('retrieved')
+        return value
+
+    def _take(self, storage, token):
+        if isinstance(storage, MemoryStore):
+            with self._lock:
+                value = storage.retrieve(token)
+                storage.delete(token)
+            return value
+        conn, make_key = _redis_connection(storage)
+        if conn is not None:
+            pipe = conn.pipeline(transaction=True)
+            key = make_key(token)
+            data = pipe.get(key).delete(key).execute()[0]
+            if not data:
+                raise KeyError(token)
+            return pickle.loads(data)
+        # not atomic: two concurrent readers may both get the result
+        value = storage.retrieve(token)
+        storage.delete(token)
+        return value
+
+    def retrieve_many(self, tokens):
+        """Return a dictionary mapping each token to its result or `None`.
+
+        Uses a single round trip on backends providing ``retrieve_many``
+        and on the Redis backend, and one ``retrieve`` per token otherwise.
+        """
+        return self._get_many(tokens, self._decode)
+
+    def retrieve_many_json(self, tokens):
+        """Like :meth:`retrieve_many` but the results are JSON bytes"""
+        return self._get_many(tokens, self._decode_json)
+
+    def _get_many(self, tokens, decode):
+        tokens = list(set(tokens))
+        if self.consume:
+            values = {}
+            for token in tokens:
+                try:
+                    values[token] = self._get(token)
+                except KeyError:
+                    values[token] = None
+        else:
+            values = retrieve_many(self.storage, tokens)
+            found = len([v for v in values.values() if v is not None])
+            self._count('retrieved', found)
+            self._count('missed', len(values) - found)
+        return dict((token, None if value is None else decode(value))
+                    for token, value in values.items())
+
+    def size(self):
+        """Return the number of entries in the backend, or `None` if the
+        backend can't tell"""
+        entries = _memory_entries(self.storage)
+        if entries is None:
+            return None
+        return len(entries)
+
+    def stats(self):
+        """Return the size gauge along with the counters"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['size'] = self.size()
+        return stats
+
+    def sweep(self):
+        """Purge the expired entries from the backend"""
+        storage = self.storage
+        entries = _memory_entries(storage)
+        if entries is None:
+            storage.purge_expired()
+            return
+        # MemoryStore.purge_expired iterates over the live dictionary,
+        # which other threads may be changing
+        now = datetime.utcnow()
+        swept = 0
+        for key, (value, expires) in list(entries.items()):
+            if expires is not None and expires < now:
+                if entries.pop(key, None) is not None:
+                    swept += 1
+        self._count('swept', swept)
+
+    def _start_sweeper(self):
+        if not self.sweep_interval or self._sweeper_pid == os.getpid():
+            return
+        # these backends expire keys on their own
+        if isinstance(self.storage, (MemcachedStore, RedisStore)):
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            # also restarted in a process forked after it was started
+            self._sweeper_pid = os.getpid()
+        thread = threading.Thread(target=self._sweep_forever,
+                                  name='velruse-result-sweeper')
+        thread.daemon = True
+        thread.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                log.exception('failed to purge expired results')
+
+
+def _redis_connection(storage):
+    """Return the connection of a Redis backend and the function turning a
+    key into a Redis key, or ``(None, None)``.
+
+    These are internals of the `anykeystore` backend, so they are looked up
+    and ignored when missing.
+    """
+    if not isinstance(storage, RedisStore):
+        return None, None
+    get_conn = getattr(storage, '_get_conn', None)
+    make_key = getattr(storage, '_make_key', None)
+    if get_conn is None or make_key is None:
+        return None, None
+    return get_conn(), make_key
+
+
+def _memory_entries(storage):
+    """Return the dictionary holding the entries of a memory backend, or
+    `None`.
+
+    This is an internal of the `anykeystore` backend, so it is looked up
+    and ignored when missing.
+    """
+    if not isinstance(storage, MemoryStore):
+        return None
+    entries = getattr(storage, '_store', None)
+    if not isinstance(entries, dict):
+        return None
+    return entries
+
+
+def retrieve_many(storage, keys):
+    """Retrieve several keys from an `anykeystore` backend at once.
+
+    Returns a dictionary mapping each key to its value or `None`. Uses a
+    single round trip on backends providing ``retrieve_many`` and on the
+    Redis backend, and falls back to one ``retrieve`` per key otherwise.
+    """
+    keys = list(set(keys))
+    if hasattr(storage, 'retrieve_many'):
+        return storage.retrieve_many(keys)
+    conn, make_key = _redis_connection(storage) if keys else (None, None)
+    if conn is not None:
+        values = conn.mget([make_key(k) for k in keys])
+        return dict(
+            (k, pickle.loads(v) if v else None) for k, v in zip(keys, values))
+    results = {}
+    for key in keys:
+        try:
+            results[key] = storage.retrieve(key)
+        except KeyError:
+            results[key] = None
+    return results
+
+
+def results_from_settings(settings, storage, prefix='results.'):
+    """Create a :class:`ResultStore` from the ``results.*`` settings
+
+    See :func:`velruse.app.codecs.codec_from_settings` for the codec
+    settings.
+    """
+    def get(key, default):
+        return settings.get(prefix + key, default)
+
+    return ResultStore(
+        storage,
+        complete_ttl=int(get('complete_ttl', DEFAULT_TTL)),
+        denied_ttl=int(get('denied_ttl', DEFAULT_TTL)),
+        consume=asbool(get('consume', False)),
+        sweep_interval=float(get('sweep_interval', DEFAULT_SWEEP_INTERVAL)),
+        codec=codec_from_settings(settings, prefix),
+    )
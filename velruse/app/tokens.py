@@ -0,0 +1,83 @@
+"""Self-contained encrypted result tokens
+
+Requires the optional `cryptography` package.
+
+"""
+import base64
+import hashlib
+import json
+import time
+import zlib
+
+try:
+    from cryptography.fernet import Fernet
+    from cryptography.fernet import InvalidToken
+except ImportError: #pragma NO COVER
+    Fernet = None
+
+
+DEFAULT_MAX_AGE = 300
+
+
+class EncryptedTokens(object):
+    """Encrypt login results into tokens that carry the result itself.
+
+    Results are serialized as JSON, compressed and encrypted with Fernet
+    (AES-128-CBC and HMAC-SHA256) using a key derived from ``secret``.
+    Each token embeds its expiration time, ``max_age`` seconds after its
+    creation.
+
+    Anyone holding ``secret`` can decode a token without a store, e.g. the
+    application receiving it::
+
+        result = EncryptedTokens(secret).decode(token)
+
+    """
+    def __init__(self, secret, max_age=DEFAULT_MAX_AGE):
+        if Fernet is None:
+            raise ImportError(
+                'the "cryptography" package is required for encrypted '
+                'tokens')
+        if not secret:
+            raise ValueError('a secret is required to encrypt tokens')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        key = base64.urlsafe_b64encode(hashlib.sha256(secret).digest())
+        self.fernet = Fernet(key)
+        self.max_age = max_age
+
+    def encode(self, result):
+        """Return a token holding ``result``"""
+        payload = json.dumps({
+            'exp': int(time.time() + self.max_age),
+            'result': result,
+        }, separators=(',', ':'))
+        data = zlib.compress(payload.encode('utf-8'))
+        return self.fernet.encrypt(data).decode('ascii')
+
+    def decode(self, token):
+        """Return the result held by ``token``
+
+        Raises a `KeyError` if the token is invalid or expired, like a
+        missing token in a store.
+        """
+        if not token:
+            raise KeyError(token)
+        if not isinstance(token, bytes):
+            token = token.encode('ascii', 'replace')
+        try:
+            data = self.fernet.decrypt(token)
+        except InvalidToken:
+            raise KeyError(token)
+        payload = json.loads(zlib.decompress(data).decode('utf-8'))
+        if payload['exp'] < time.time():
+            raise KeyError(token)
+        return payload['result']
+
+
+def tokens_from_settings(settings, prefix='token.'):
+    """Create :class:`EncryptedTokens` from ``<prefix>secret`` and
+    ``<prefix>max_age``"""
+    return EncryptedTokens(
+        settings[prefix + 'secret'],
+        max_age=int(settings.get(prefix + 'max_age', DEFAULT_MAX_AGE)))
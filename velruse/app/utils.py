@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 import uuid
 
 from velruse.app.baseconvert import base_encode
@@ -29,3 +31,19 @@ for (var i = 0; i < elements.length; i++) {
 def generate_token():
     """Generate a random token"""
     return base_encode(uuid.uuid4().int)
+
+
+def sign_payload(secret, timestamp, body):
+    """Sign a pushed result
+
+    Returns the hex HMAC-SHA256 of ``"<timestamp>.<body>"`` keyed with
+    ``secret``. Receivers should compute the same value from the
+    ``X-Velruse-Timestamp`` header and the raw body, compare it to the
+    ``X-Velruse-Signature`` header and reject old timestamps.
+    """
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    msg = timestamp.encode('ascii') + b'.' + body
+    return hmac.new(secret, msg, hashlib.sha256).hexdigest()
@@ -0,0 +1,341 @@
+"""Caching helpers"""
+import functools
+import hashlib
+import threading
+import time
+
+from pyramid.exceptions import ConfigurationError
+
+from . import AuthenticationComplete
+from .compat import OrderedDict
+
+
+DEFAULT_ENRICHMENT_TTL = 300
+DEFAULT_ENRICHMENT_KEY_PREFIX = 'velruse.enrichment.'
+DEFAULT_CALLBACK_TTL = 30
+
+
+class TTLCache(object):
+    """A thread-safe, size-bounded LRU cache whose entries expire.
+
+    Entries live for ``ttl`` seconds unless a different ``ttl`` is given
+    when they are set. Once ``max_entries`` is reached the least recently
+    used entry is evicted.
+
+    """
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return default
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def purge_expired(self):
+        """Remove all of the expired entries"""
+        now = time.time()
+        with self._lock:
+            for key, (value, expires_at) in list(self._data.items()):
+                if expires_at <= now:
+                    del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls for the same key into a single call.
+
+    While a call for a key is in progress, other threads asking for the
+    same key wait for it and receive its result (or its exception) instead
+    of repeating the work.
+
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EnrichmentCache(object):
+    """Cache the data fetched to enrich the profiles of returning users.
+
+    Entries are keyed by the provider's name and the user's id, and kept
+    for ``ttl`` seconds. By default they are kept in memory, evicting the
+    least recently used ones beyond ``max_entries``. Entries are kept in
+    an `anykeystore` backend instead if ``store`` is given, or in the
+    ``velruse_store`` of ``registry``.
+
+    Concurrent fetches for the same user are collapsed into one. Hits and
+    misses are counted and returned by :meth:`stats`.
+
+    """
+    def __init__(self, ttl=DEFAULT_ENRICHMENT_TTL, max_entries=1000,
+                 store=None, registry=None,
+                 key_prefix=DEFAULT_ENRICHMENT_KEY_PREFIX):
+        self.ttl = ttl
+        self.memory = None
+        if store is None and registry is None:
+            self.memory = TTLCache(ttl=ttl, max_entries=max_entries)
+        self._store = store
+        self.registry = registry
+        self.key_prefix = key_prefix
+        self.flight = SingleFlight()
+        self.counters = dict(hits=0, misses=0)
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            return self.registry.velruse_store
+        return self._store
+
+    def _key(self, provider_name, user_id):
+        digest = hashlib.sha1(('%s\0%s' % (provider_name, user_id))
+                              .encode('utf-8')).hexdigest()
+        return self.key_prefix + digest
+
+    def _get(self, key):
+        if self.memory is not None:
+            return self.memory.get(key)
+        try:
+            return self.store.retrieve(key)
+        except KeyError:
+            return None
+
+    def _set(self, key, value):
+        if self.memory is not None:
+            self.memory.set(key, value)
+        else:
+            self.store.store(key, value, expires=self.ttl)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, provider_name, user_id, fetch):
+        """Return the data cached for the user or the result of ``fetch``.
+
+        The result is cached unless it is `None`, which ``fetch`` should
+        return when the data could not be obtained.
+        """
+        key = self._key(provider_name, user_id)
+        value = self._get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+        self._count('misses')
+        return self.flight.do(key, lambda: self._fetch(key, fetch))
+
+    def _fetch(self, key, fetch):
+        value = fetch()
+        if value is not None:
+            self._set(key, value)
+        return value
+
+    def stats(self):
+        """Return the hits and misses counters along with the hit rate"""
+        with self._lock:
+            stats = dict(self.counters)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+        return stats
+
+
+class CallbackCache(object):
+    """Remember the results of the callbacks for ``ttl`` seconds, so that
+    a duplicate callback gets the same result instead of exchanging the
+    single-use authorization code again.
+
+    Duplicates happen when the user refreshes the callback page or follows
+    the redirect twice. Results are keyed by a hash of the provider's
+    name, the code, the ``state`` and a secret identifying the browser
+    which started the login, so only that browser gets them. They are kept
+    in memory, evicting the least recently used ones beyond
+    ``max_entries``. Concurrent duplicates wait for the first callback and
+    share its result. Only :class:`~velruse.AuthenticationComplete`
+    results are kept.
+
+    """
+    def __init__(self, ttl=DEFAULT_CALLBACK_TTL, max_entries=1000):
+        self.memory = TTLCache(ttl=ttl, max_entries=max_entries)
+        self.flight = SingleFlight()
+        self.counters = dict(hits=0, misses=0)
+        self._lock = threading.Lock()
+
+    def _key(self, provider_name, code, state, browser):
+        return hashlib.sha256(('%s\0%s\0%s\0%s' % (
+            provider_name, code, state, browser)).encode('utf-8')).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, provider_name, code, state, browser, callback, verify):
+        """Return the result of the callback for ``code`` and ``state`` in
+        the ``browser``, calling ``callback`` to compute it unless it is
+        cached.
+
+        ``verify`` is called before returning the result of another
+        callback and should raise if the ``state`` is not valid for this
+        request.
+        """
+        key = self._key(provider_name, code, state, browser)
+        called = []
+
+        def call():
+            called.append(True)
+            return callback()
+
+        result = self.memory.get(key)
+        if result is not None:
+            self._count('hits')
+        else:
+            self._count('misses')
+            result = self.flight.do(key, lambda: self._call(key, call))
+        if not called:
+            verify()
+        return result
+
+    def _call(self, key, callback):
+        result = self.memory.get(key)
+        if result is not None:
+            # completed while waiting to be called
+            return result
+        result = callback()
+        if isinstance(result, AuthenticationComplete):
+            self.memory.set(key, result)
+        return result
+
+    def stats(self):
+        """Return the hits and misses counters along with the number of
+        cached results"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['size'] = len(self.memory)
+        return stats
+
+
+def idempotent_callback(wrapped):
+    """Answer the duplicates of a provider's callback from the provider's
+    ``callback_cache``, a :class:`CallbackCache`, if it has one.
+
+    The browser is identified by the ``browser_key`` of the provider's
+    ``state_manager`` and duplicates are checked by its
+    ``verify_duplicate``. Callbacks are not cached if the browser can't be
+    identified.
+    """
+    @functools.wraps(wrapped)
+    def wrapper(self, request):
+        cache = getattr(self, 'callback_cache', None)
+        code = request.GET.get('code')
+        if cache is None or not code:
+            return wrapped(self, request)
+        state_manager = self.state_manager
+        browser = state_manager.browser_key(request)
+        if not browser:
+            return wrapped(self, request)
+        return cache.get(
+            self.name, code, request.GET.get('state'), browser,
+            lambda: wrapped(self, request),
+            lambda: state_manager.verify_duplicate(request, self.name))
+    return wrapper
+
+
+def enrichment_cache_from_settings(settings, prefix='', registry=None):
+    """Create an :class:`EnrichmentCache` from the settings, or return
+    `None` if ``<prefix>enrichment_cache.ttl`` is not set.
+
+    ``<prefix>enrichment_cache.max_entries`` bounds the number of entries
+    kept in memory. If ``<prefix>enrichment_cache.store`` is
+    ``velruse_store`` the entries are kept in the ``velruse_store`` of
+    ``registry`` instead, which must already be registered.
+    """
+    prefix += 'enrichment_cache.'
+    ttl = int(settings.get(prefix + 'ttl') or 0)
+    if ttl <= 0:
+        return None
+    store = settings.get(prefix + 'store', 'memory')
+    if store not in ('memory', 'velruse_store'):
+        raise ValueError('unknown enrichment cache store "%s"' % store)
+    if (store == 'velruse_store' and
+            getattr(registry, 'velruse_store', None) is None):
+        raise ConfigurationError(
+            'the "velruse_store" enrichment cache store requires a '
+            'velruse_store, which the "environ" and "token" delivery modes '
+            'do not create')
+    return EnrichmentCache(
+        ttl=ttl,
+        max_entries=int(settings.get(prefix + 'max_entries', 1000)),
+        registry=registry if store == 'velruse_store' else None)
+
+
+def callback_cache_from_settings(settings, prefix=''):
+    """Create a :class:`CallbackCache` from the settings, or return `None`
+    if ``<prefix>callback_cache.ttl`` is not set.
+
+    ``<prefix>callback_cache.max_entries`` bounds the number of results
+    kept.
+    """
+    prefix += 'callback_cache.'
+    ttl = int(settings.get(prefix + 'ttl') or 0)
+    if ttl <= 0:
+        return None
+    return CallbackCache(
+        ttl=ttl,
+        max_entries=int(settings.get(prefix + 'max_entries', 1000)))
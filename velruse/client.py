@@ -0,0 +1,783 @@
+"""Outbound HTTP client shared by the providers"""
+from collections import deque
+from contextlib import contextmanager
+import functools
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from requests_oauthlib import OAuth1
+
+from .compat import queue
+from .compat import urlsplit
+from .exceptions import ThirdPartyFailure
+
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRIES = 2
+DEFAULT_EXCHANGE_RETRIES = 0
+DEFAULT_BACKOFF = 0.1
+DEFAULT_BACKOFF_MAX = 1.0
+DEFAULT_BULKHEAD_QUEUE_TIMEOUT = 1.0
+
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def asbool(value):
+    """Interpret a setting value as a boolean"""
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return False
+    return str(value).strip().lower() in ('true', 'yes', 'on', '1')
+
+
+class CircuitBreaker(object):
+    """Track the health of a single provider endpoint.
+
+    The breaker records the outcome of the last ``window`` calls. Once at
+    least ``min_requests`` of them are known and the share of failures
+    reaches ``error_rate`` the breaker opens and calls are rejected without
+    touching the network. After ``reset_timeout`` seconds it half-opens and
+    lets a single probe through: a success closes the breaker again, a
+    failure re-opens it.
+
+    """
+    def __init__(self,
+                 error_rate=0.5,
+                 min_requests=10,
+                 window=20,
+                 reset_timeout=30.0):
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.opened_at = None
+        self.outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return ``True`` if a call may be attempted right now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, success):
+        """Record the outcome of a call that was allowed through"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._trip()
+                return
+
+            self.outcomes.append(success)
+            total = len(self.outcomes)
+            if total >= self.min_requests:
+                failures = self.outcomes.count(False)
+                if float(failures) / total >= self.error_rate:
+                    self._trip()
+
+    def _trip(self):
+        self.state = OPEN
+        self.opened_at = time.time()
+
+    def info(self):
+        """Return a dictionary describing the breaker's current state"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'requests': len(self.outcomes),
+                'failures': self.outcomes.count(False),
+                'opened_at': self.opened_at,
+            }
+
+
+class Bulkhead(object):
+    """Cap the number of concurrent calls to a provider.
+
+    At most ``max_concurrent`` calls are in flight at once. Up to
+    ``max_queue`` more wait for one of them to finish, for at most
+    ``queue_timeout`` seconds. Calls beyond the queue, or waiting for too
+    long, are rejected with :class:`~velruse.exceptions.ThirdPartyFailure`
+    right away, so that a slow provider can't hold every worker thread.
+
+    """
+    def __init__(self,
+                 max_concurrent,
+                 max_queue=0,
+                 queue_timeout=DEFAULT_BULKHEAD_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self.waiting = 0
+        self.counters = dict(admitted=0, queued=0, rejected=0)
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """Wait for a free slot, for at most ``timeout`` seconds if it is
+        shorter than the ``queue_timeout``, or raise
+        :class:`~velruse.exceptions.ThirdPartyFailure`"""
+        if timeout is None or timeout > self.queue_timeout:
+            timeout = self.queue_timeout
+        with self._cond:
+            if self.active >= self.max_concurrent:
+                if self.waiting >= self.max_queue:
+                    self.counters['rejected'] += 1
+                    raise ThirdPartyFailure('Bulkhead full')
+                self.counters['queued'] += 1
+                self.waiting += 1
+                try:
+                    expires_at = time.time() + timeout
+                    while self.active >= self.max_concurrent:
+                        remaining = expires_at - time.time()
+                        if remaining <= 0:
+                            self.counters['rejected'] += 1
+                            raise ThirdPartyFailure(
+                                'Timeout waiting for the bulkhead')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.counters['admitted'] += 1
+
+    def release(self):
+        """Free the slot of a finished call"""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def info(self):
+        """Return a dictionary describing the bulkhead's current usage"""
+        with self._cond:
+            info = dict(self.counters)
+            info.update(
+                max_concurrent=self.max_concurrent,
+                max_queue=self.max_queue,
+                active=self.active,
+                waiting=self.waiting,
+            )
+            return info
+
+
+class LatencyTracker(object):
+    """Keep the latencies of an endpoint's most recent successful calls"""
+
+    def __init__(self, size=100, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, pct):
+        """Return the ``pct`` percentile or ``None`` if there are not enough
+        samples yet"""
+        samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+        return samples[index]
+
+
+def not_sent(error):
+    """Return ``True`` if a request failed before it was sent, because no
+    connection to the server could be established"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # urllib3 wraps the connection error in a MaxRetryError
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def endpoint_key(method, url):
+    """Identify an endpoint by its method, host and path"""
+    parts = urlsplit(url)
+    return '%s %s://%s%s' % (method, parts.scheme, parts.netloc, parts.path)
+
+
+class HTTPClient(object):
+    """A pooled, keep-alive HTTP client for a single provider.
+
+    Every provider owns one of these and issues all of its token exchanges
+    and profile requests through it, so that TCP and TLS connections to the
+    provider's hosts are reused across logins instead of being opened for
+    every call.
+
+    ``pool_connections`` is the number of per-host connection pools to
+    cache and ``pool_maxsize`` is the number of connections kept alive in
+    each of them. If ``pool_block`` is true the client waits for a free
+    connection instead of opening a throw-away one when the pool is
+    exhausted. Setting ``keep_alive`` to false asks the remote side to close
+    the connection after every response.
+
+    ``connect_timeout`` and ``read_timeout`` bound every single request, in
+    seconds. ``deadline`` is an overall budget, in seconds, shared by all of
+    the requests made within one :meth:`flow` (usually a provider's
+    callback). A request that would start after the budget is spent, or that
+    times out, raises :class:`~velruse.exceptions.ThirdPartyFailure`.
+
+    ``breaker`` is an optional dictionary of :class:`CircuitBreaker`
+    arguments. When given, every endpoint gets its own breaker and calls to
+    an endpoint whose breaker is open fail immediately with
+    :class:`~velruse.exceptions.ThirdPartyFailure`. Server errors (5xx),
+    timeouts and connection errors count as failures. The breakers are
+    available as :attr:`breakers`, keyed by endpoint.
+
+    Failed calls are retried with jittered exponential backoff starting at
+    ``backoff`` seconds and capped at ``backoff_max``. Idempotent calls
+    (profile lookups) are retried up to ``retries`` times on timeouts,
+    connection errors and 5xx responses. Calls that are not idempotent,
+    such as exchanging a single-use authorization code, are retried up to
+    ``exchange_retries`` times (none by default) and only when no
+    connection could be established. They are never retried once the
+    request may have been sent, e.g. on a read timeout, a reset connection
+    or a server error, where the provider may already have consumed the
+    code.
+
+    If ``hedge_delay`` is set, idempotent calls are hedged: when no response
+    has arrived after the endpoint's observed 95th percentile latency (or
+    ``hedge_delay`` seconds until enough samples were collected) a second,
+    identical request is sent and whichever answers first is used.
+
+    ``enrichment_timeout`` is a budget, in seconds, for the requests made
+    within :meth:`enrichment`, which fetch optional profile data.
+
+    ``bulkhead`` is an optional dictionary of :class:`Bulkhead` arguments
+    capping the requests in flight to the provider, available as
+    :attr:`bulkhead`. Waiting for a free slot also ends with the current
+    flow's deadline.
+
+    """
+    def __init__(self,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 keep_alive=True,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 deadline=None,
+                 breaker=None,
+                 retries=DEFAULT_RETRIES,
+                 exchange_retries=DEFAULT_EXCHANGE_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 backoff_max=DEFAULT_BACKOFF_MAX,
+                 hedge_delay=None,
+                 enrichment_timeout=None,
+                 bulkhead=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.breaker_settings = breaker
+        self.breakers = {}
+        self.retries = retries
+        self.exchange_retries = exchange_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.enrichment_timeout = enrichment_timeout
+        self.bulkhead = Bulkhead(**bulkhead) if bulkhead else None
+        self.latencies = {}
+
+        self.session = self._make_session()
+        self._signers = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @contextmanager
+    def flow(self):
+        """Share the client's ``deadline`` across the enclosed requests.
+
+        Nested flows reuse the budget of the outermost one.
+        """
+        if self.deadline is None or self.expires_at() is not None:
+            yield
+            return
+        self._local.expires_at = time.time() + self.deadline
+        try:
+            yield
+        finally:
+            self._local.expires_at = None
+
+    @contextmanager
+    def enrichment(self):
+        """Bound the enclosed requests by the ``enrichment_timeout``, within
+        the current flow's deadline."""
+        previous = self.expires_at()
+        if self.enrichment_timeout is None:
+            yield
+            return
+        expires_at = time.time() + self.enrichment_timeout
+        if previous is not None:
+            expires_at = min(expires_at, previous)
+        self._local.expires_at = expires_at
+        try:
+            yield
+        finally:
+            self._local.expires_at = previous
+
+    def expires_at(self):
+        """Return the absolute time at which the current flow expires or
+        ``None`` if there is no active deadline"""
+        return getattr(self._local, 'expires_at', None)
+
+    def remaining(self):
+        """Return the seconds left in the current flow or ``None``"""
+        expires_at = self.expires_at()
+        if expires_at is None:
+            return None
+        return expires_at - time.time()
+
+    def _timeout(self, timeout=None):
+        """Return the ``(connect, read)`` timeouts of a request, ``timeout``
+        if given or the client's, capped by the current deadline"""
+        if timeout is None:
+            connect, read = self.connect_timeout, self.read_timeout
+        elif isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise ThirdPartyFailure('Deadline exceeded')
+            connect = min(connect or remaining, remaining)
+            read = min(read or remaining, remaining)
+        return (connect, read)
+
+    def breaker(self, endpoint):
+        """Return the circuit breaker for ``endpoint`` or ``None`` if
+        circuit breaking is disabled"""
+        if self.breaker_settings is None:
+            return None
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(endpoint)
+                if breaker is None:
+                    breaker = CircuitBreaker(**self.breaker_settings)
+                    self.breakers[endpoint] = breaker
+        return breaker
+
+    def breaker_states(self):
+        """Return the state of every known endpoint's circuit breaker"""
+        return dict(
+            (endpoint, breaker.info())
+            for endpoint, breaker in list(self.breakers.items()))
+
+    def request(self, method, url, endpoint=None, idempotent=None, **kw):
+        """Send a request through the pooled session.
+
+        ``endpoint`` names the endpoint for circuit breaking. It defaults to
+        the method, host and path of ``url`` and should be given explicitly
+        when the path contains per-user values.
+
+        ``idempotent`` controls the retry policy. It defaults to ``True``
+        for ``GET`` requests and must be set to ``False`` for token
+        exchanges sent with ``GET``.
+
+        A ``timeout`` given explicitly replaces the client's timeouts but,
+        like them, is capped by the current deadline.
+
+        """
+        if endpoint is None:
+            endpoint = endpoint_key(method, url)
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        retries = self.retries if idempotent else self.exchange_retries
+        timeout = kw.pop('timeout', None)
+
+        attempt = 0
+        while True:
+            kw['timeout'] = self._timeout(timeout)
+            try:
+                if idempotent and self.hedge_delay is not None:
+                    resp = self._send_hedged(method, url, endpoint, kw)
+                else:
+                    resp = self._send(method, url, endpoint, kw)
+            except requests.Timeout as e:
+                if not (idempotent or not_sent(e)):
+                    raise ThirdPartyFailure(
+                        'Timeout requesting %s: %s' % (url, e))
+                if attempt >= retries or not self._backoff(attempt):
+                    raise ThirdPartyFailure(
+                        'Timeout requesting %s: %s' % (url, e))
+            except requests.ConnectionError as e:
+                if not (idempotent or not_sent(e)):
+                    raise
+                if attempt >= retries or not self._backoff(attempt):
+                    raise
+            else:
+                if not (idempotent and resp.status_code in RETRY_STATUSES):
+                    return resp
+                if attempt >= retries or not self._backoff(attempt):
+                    return resp
+            attempt += 1
+
+    def _backoff(self, attempt):
+        """Sleep before the next attempt. Returns ``False`` if the current
+        deadline leaves no room for another attempt."""
+        delay = random.uniform(
+            0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+        remaining = self.remaining()
+        if remaining is not None and remaining <= delay:
+            return False
+        time.sleep(delay)
+        return True
+
+    def _send(self, method, url, endpoint, kw):
+        if self.bulkhead is None:
+            return self._send_once(method, url, endpoint, kw)
+        # wait for a slot before asking the breaker, which may let a
+        # single probe through
+        self.bulkhead.acquire(self.remaining())
+        try:
+            return self._send_once(method, url, endpoint, kw)
+        finally:
+            self.bulkhead.release()
+
+    def _send_once(self, method, url, endpoint, kw):
+        breaker = self.breaker(endpoint)
+        if breaker is not None and not breaker.allow():
+            raise ThirdPartyFailure('Circuit open for %s' % endpoint)
+
+        start = time.time()
+        try:
+            resp = self.session.request(method, url, **kw)
+        except Exception:
+            # any error, not only timeouts, must end a half-open probe
+            if breaker is not None:
+                breaker.record(False)
+            raise
+        if breaker is not None:
+            breaker.record(resp.status_code < 500)
+        if resp.status_code < 500:
+            self._latency(endpoint).add(time.time() - start)
+        return resp
+
+    def _latency(self, endpoint):
+        tracker = self.latencies.get(endpoint)
+        if tracker is None:
+            tracker = self.latencies.setdefault(endpoint, LatencyTracker())
+        return tracker
+
+    def _send_hedged(self, method, url, endpoint, kw):
+        delay = self._latency(endpoint).percentile(95)
+        if delay is None:
+            delay = self.hedge_delay
+
+        results = queue.Queue()
+        expires_at = self.expires_at()
+
+        def attempt():
+            self._local.expires_at = expires_at
+            try:
+                results.put((True, self._send(method, url, endpoint, kw)))
+            except Exception as e:
+                results.put((False, e))
+            finally:
+                self._local.expires_at = None
+
+        def spawn():
+            t = threading.Thread(target=attempt)
+            t.daemon = True
+            t.start()
+
+        spawn()
+        pending = 1
+        try:
+            ok, value = results.get(timeout=delay)
+        except queue.Empty:
+            spawn()
+            pending += 1
+            ok, value = results.get()
+        pending -= 1
+        while not ok and pending:
+            ok, value = results.get()
+            pending -= 1
+        if not ok:
+            raise value
+        return value
+
+    def gather(self, *calls):
+        """Run independent calls concurrently and return their results.
+
+        Each call is a callable taking no arguments, usually wrapping one of
+        the client's request methods. The first call runs in the current
+        thread, the others in their own threads sharing the current flow's
+        deadline. Results are returned in the order of ``calls``. If any of
+        the calls raised, the exception of the first one is re-raised once
+        all of them have finished.
+
+        """
+        expires_at = self.expires_at()
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+
+        def run(index):
+            self._local.expires_at = expires_at
+            try:
+                results[index] = calls[index]()
+            except Exception as e:
+                errors[index] = e
+            finally:
+                self._local.expires_at = None
+
+        threads = []
+        for index in range(1, len(calls)):
+            t = threading.Thread(target=run, args=(index,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        if calls:
+            try:
+                results[0] = calls[0]()
+            except Exception as e:
+                errors[0] = e
+        for t in threads:
+            t.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def get(self, url, **kw):
+        return self.request('GET', url, **kw)
+
+    def post(self, url, data=None, **kw):
+        return self.request('POST', url, data=data, **kw)
+
+    def oauth1(self, client_key, client_secret=None, **kw):
+        """Return an ``OAuth1`` signer for the given credentials.
+
+        Signers that only carry the consumer credentials and an optional
+        ``callback_uri`` are the same for every login, so they are built
+        once and reused. Signers holding a user's request or access token
+        are specific to a single flow and are created on every call.
+
+        """
+        if set(kw) - set(['callback_uri']):
+            return OAuth1(client_key, client_secret=client_secret, **kw)
+
+        key = (client_key, client_secret, kw.get('callback_uri'))
+        signer = self._signers.get(key)
+        if signer is None:
+            with self._lock:
+                signer = self._signers.get(key)
+                if signer is None:
+                    signer = OAuth1(client_key,
+                                    client_secret=client_secret,
+                                    **kw)
+                    self._signers[key] = signer
+        return signer
+
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
+
+
+def with_deadline(wrapped):
+    """Run a provider method inside a :meth:`HTTPClient.flow` of the
+    provider's ``http`` client, so that all of its outbound requests share
+    one deadline."""
+    @functools.wraps(wrapped)
+    def wrapper(self, *args, **kw):
+        with self.http.flow():
+            return wrapped(self, *args, **kw)
+    return wrapper
+
+
+def enrich_or_degrade(provider, profile, credentials):
+    """Return ``profile`` completed by the provider's ``enrich_profile``.
+
+    The enrichment runs within the :meth:`HTTPClient.enrichment` budget of
+    the provider's client. If it fails or runs out of time, a copy of
+    ``profile`` flagged as ``partial`` is returned instead, so the login
+    completes with the identity already known.
+    """
+    try:
+        with provider.http.enrichment():
+            return provider.enrich_profile(profile, credentials)
+    except Exception:
+        log.warning('Failed to enrich the %s profile, returning a partial '
+                    'profile', provider.name, exc_info=True)
+        return dict(profile, partial=True)
+
+
+def client_from_settings(settings, prefix=''):
+    """Create an :class:`HTTPClient` from a settings dictionary.
+
+    Supported settings (relative to ``prefix``):
+
+    ``pool.connections``
+        Number of per-host connection pools to keep (default 10).
+
+    ``pool.maxsize``
+        Number of connections kept alive per host (default 10).
+
+    ``pool.block``
+        Wait for a free pooled connection instead of opening an extra one
+        when the pool is exhausted (default false).
+
+    ``keep_alive``
+        Reuse connections between requests (default true).
+
+    ``timeout.connect``
+        Seconds to wait for a connection to be established (default 10).
+
+    ``timeout.read``
+        Seconds to wait for the server to send data (default 30).
+
+    ``timeout.deadline``
+        Overall budget in seconds for all of the requests made while
+        handling a single callback (default unlimited).
+
+    ``breaker.error_rate``
+        Share of failed calls (between 0 and 1) at which an endpoint's
+        circuit breaker opens. Circuit breaking is disabled unless this is
+        set.
+
+    ``breaker.min_requests``
+        Number of recorded calls required before the breaker may open
+        (default 10).
+
+    ``breaker.window``
+        Number of most recent calls used to compute the error rate
+        (default 20).
+
+    ``breaker.reset_timeout``
+        Seconds an open breaker waits before letting a probe through
+        (default 30).
+
+    ``retry.max``
+        Number of times an idempotent request (e.g. a profile lookup) is
+        retried (default 2).
+
+    ``retry.exchange_max``
+        Number of times a token exchange is retried when no connection
+        could be established (default 0).
+
+    ``retry.backoff``
+        Base delay in seconds of the jittered exponential backoff between
+        retries (default 0.1).
+
+    ``retry.backoff_max``
+        Maximum delay in seconds between retries (default 1).
+
+    ``hedge.delay``
+        Enables hedged profile requests. A second request is sent if the
+        first did not answer within the endpoint's 95th percentile latency,
+        or within this many seconds while that is still unknown.
+
+    ``timeout.enrichment``
+        Budget in seconds for the requests fetching optional profile data
+        (default unlimited).
+
+    ``bulkhead.max_concurrent``
+        Number of requests to the provider allowed in flight at once.
+        Unlimited unless this is set.
+
+    ``bulkhead.max_queue``
+        Number of requests allowed to wait for a free slot, beyond which
+        requests are rejected immediately (default 0).
+
+    ``bulkhead.queue_timeout``
+        Seconds a request waits for a free slot before it is rejected
+        (default 1).
+
+    """
+    def get(key, default=None):
+        return settings.get(prefix + key, default)
+
+    def get_seconds(key, default=None):
+        value = get(key)
+        if value is None or value == '':
+            return default
+        return float(value)
+
+    breaker = None
+    error_rate = get('breaker.error_rate')
+    if error_rate:
+        breaker = dict(
+            error_rate=float(error_rate),
+            min_requests=int(get('breaker.min_requests', 10)),
+            window=int(get('breaker.window', 20)),
+            reset_timeout=get_seconds('breaker.reset_timeout', 30.0),
+        )
+
+    bulkhead = None
+    max_concurrent = get('bulkhead.max_concurrent')
+    if max_concurrent:
+        bulkhead = dict(
+            max_concurrent=int(max_concurrent),
+            max_queue=int(get('bulkhead.max_queue', 0)),
+            queue_timeout=get_seconds('bulkhead.queue_timeout',
+                                      DEFAULT_BULKHEAD_QUEUE_TIMEOUT),
+        )
+
+    return HTTPClient(
+        pool_connections=int(get('pool.connections',
+                                 DEFAULT_POOL_CONNECTIONS)),
+        pool_maxsize=int(get('pool.maxsize', DEFAULT_POOL_MAXSIZE)),
+        pool_block=asbool(get('pool.block', False)),
+        keep_alive=asbool(get('keep_alive', True)),
+        connect_timeout=get_seconds('timeout.connect',
+                                    DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=get_seconds('timeout.read', DEFAULT_READ_TIMEOUT),
+        deadline=get_seconds('timeout.deadline'),
+        breaker=breaker,
+        retries=int(get('retry.max', DEFAULT_RETRIES)),
+        exchange_retries=int(get('retry.exchange_max',
+                                 DEFAULT_EXCHANGE_RETRIES)),
+        backoff=get_seconds('retry.backoff', DEFAULT_BACKOFF),
+        backoff_max=get_seconds('retry.backoff_max', DEFAULT_BACKOFF_MAX),
+        hedge_delay=get_seconds('hedge.delay'),
+        enrichment_timeout=get_seconds('timeout.enrichment'),
+        bulkhead=bulkhead,
+    )
@@ -36,3 +36,70 @@ try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from hmac import compare_digest
+except ImportError: #pragma NO COVER Python < 2.7.7 and 3.3
+    def compare_digest(a, b):
+        """Compare two strings in a time independent of their contents"""
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+try:
+    from collections import OrderedDict
+except ImportError: #pragma NO COVER Python < 2.7
+    class OrderedDict(dict):
+        """The parts of :class:`collections.OrderedDict` used by velruse"""
+        def __init__(self):
+            dict.__init__(self)
+            self._keys = []
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                self._keys.append(key)
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            self._keys.remove(key)
+
+        def __iter__(self):
+            return iter(self._keys)
+
+        def pop(self, key, *default):
+            if key in self:
+                self._keys.remove(key)
+            return dict.pop(self, key, *default)
+
+        def popitem(self, last=True):
+            if not self._keys:
+                raise KeyError('dictionary is empty')
+            key = self._keys.pop() if last else self._keys.pop(0)
+            return key, dict.pop(self, key)
+
+        def clear(self):
+            dict.clear(self)
+            del self._keys[:]
+
+        def keys(self):
+            return list(self._keys)
+
+        def values(self):
+            return [self[key] for key in self._keys]
+
+        def items(self):
+            return [(key, self[key]) for key in self._keys]
@@ -5,25 +5,25 @@ http://confluence.atlassian.com/display/BITBUCKET/OAuth+on+Bitbucket
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-from requests_oauthlib import OAuth1
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..compat import parse_qsl
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
 
 
+log = __import__('logging').getLogger(__name__)
+
 REQUEST_URL = 'https://bitbucket.org/api/1.0/oauth/request_token/'
 AUTH_URL = 'https://bitbucket.org/api/1.0/oauth/authenticate/'
 ACCESS_URL = 'https://bitbucket.org/api/1.0/oauth/access_token/'
 USER_URL = 'https://bitbucket.org/api/1.0/user'
-EMAIL_URL = 'https://bitbucket.org/api/1.0/users/{username}/emails'
+EMAIL_URL = 'https://bitbucket.org/api/1.0/emails/'
 
 
 class BitbucketAuthenticationComplete(AuthenticationComplete):
@@ -41,8 +41,12 @@ def add_bitbucket_login_from_settings(config, prefix='velruse.bitbucket.'):
     p = ProviderSettings(settings, prefix)
     p.update('consumer_key', required=True)
     p.update('consumer_secret', required=True)
+    p.update('lazy_profile')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_request_token_pool()
+    p.update_enrichment_cache(config.registry)
     config.add_bitbucket_login(**p.kwargs)
 
 
@@ -51,11 +55,34 @@ def add_bitbucket_login(config,
                         consumer_secret,
                         login_path='/bitbucket/login',
                         callback_path='/bitbucket/login/callback',
-                        name='bitbucket'):
+                        name='bitbucket',
+                        http_client=None,
+                        lazy_profile=False,
+                        enrichment_cache=None,
+                        request_token_pool=None):
     """
     Add a Bitbucket login provider to the application.
+
+    With ``lazy_profile`` the login completes without the user's email
+    addresses, in a profile flagged as ``partial``. They are only fetched
+    when the profile is enriched, see
+    :meth:`BitbucketProvider.enrich_profile`.
+
+    ``enrichment_cache`` is a :class:`velruse.cache.EnrichmentCache`
+    keeping the email addresses of returning users. The addresses are then
+    requested after the user's profile, which gives their username, rather
+    than concurrently.
+
+    ``request_token_pool`` is a
+    :class:`velruse.request_tokens.RequestTokenPool` prefetching the request
+    tokens, so that the login redirect is served without a request to
+    Bitbucket.
     """
-    provider = BitbucketProvider(name, consumer_key, consumer_secret)
+    provider = BitbucketProvider(name, consumer_key, consumer_secret,
+                                 http_client=http_client,
+                                 lazy_profile=lazy_profile,
+                                 enrichment_cache=enrichment_cache,
+                                 request_token_pool=request_token_pool)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -69,11 +96,17 @@ def add_bitbucket_login(config,
 
 
 class BitbucketProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None,
+                 lazy_profile=False, enrichment_cache=None,
+                 request_token_pool=None):
         self.name = name
         self.type = 'bitbucket'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.lazy_profile = lazy_profile
+        self.enrichment_cache = enrichment_cache
+        self.request_token_pool = request_token_pool
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -81,15 +114,12 @@ class BitbucketProvider(object):
     def login(self, request):
         """Initiate a bitbucket login"""
         # grab the initial request token
-        oauth = OAuth1(
-            self.consumer_key,
-            client_secret=self.consumer_secret,
-            callback_uri=request.route_url(self.callback_route))
-        resp = requests.post(REQUEST_URL, auth=oauth)
-        if resp.status_code != 200:
-            raise ThirdPartyFailure("Status %s: %s" % (
-                resp.status_code, resp.content))
-        request_token = dict(parse_qsl(resp.text))
+        callback_uri = request.route_url(self.callback_route)
+        if self.request_token_pool is None:
+            request_token = self._fetch_request_token(callback_uri)
+        else:
+            request_token = self.request_token_pool.take(
+                callback_uri, self._fetch_request_token)
 
         # store the token for later
         request.session['velruse.token'] = request_token
@@ -98,6 +128,18 @@ class BitbucketProvider(object):
         auth_url = flat_url(AUTH_URL, oauth_token=request_token['oauth_token'])
         return HTTPFound(location=auth_url)
 
+    def _fetch_request_token(self, callback_uri):
+        oauth = self.http.oauth1(
+            self.consumer_key,
+            client_secret=self.consumer_secret,
+            callback_uri=callback_uri)
+        resp = self.http.post(REQUEST_URL, auth=oauth)
+        if resp.status_code != 200:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                resp.status_code, resp.content))
+        return dict(parse_qsl(resp.text))
+
+    @with_deadline
     def callback(self, request):
         """Process the bitbucket redirect"""
         if 'denied' in request.GET:
@@ -112,13 +154,13 @@ class BitbucketProvider(object):
         request_token = request.session.pop('velruse.token')
 
         # turn our request token into an access token
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.consumer_key,
             client_secret=self.consumer_secret,
             resource_owner_key=request_token['oauth_token'],
             resource_owner_secret=request_token['oauth_token_secret'],
             verifier=verifier)
-        resp = requests.post(ACCESS_URL, auth=oauth)
+        resp = self.http.post(ACCESS_URL, auth=oauth)
         if resp.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 resp.status_code, resp.content))
@@ -128,15 +170,16 @@ class BitbucketProvider(object):
             'oauthAccessTokenSecret': access_token['oauth_token_secret'],
         }
 
-        # setup oauth for general api calls
-        oauth = OAuth1(
-            self.consumer_key,
-            client_secret=self.consumer_secret,
-            resource_owner_key=creds['oauthAccessToken'],
-            resource_owner_secret=creds['oauthAccessTokenSecret'])
-
-        # request user profile
-        resp = requests.get(USER_URL, auth=oauth)
+        oauth = self._oauth(creds)
+        if self.lazy_profile or self.enrichment_cache is not None:
+            resp = self.http.get(USER_URL, auth=oauth)
+            emails = None
+        else:
+            # request the user profile and emails concurrently
+            resp, emails = self.http.gather(
+                lambda: self.http.get(USER_URL, auth=oauth),
+                lambda: self._try_fetch_emails(oauth),
+            )
         if resp.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 resp.status_code, resp.content))
@@ -169,21 +212,67 @@ class BitbucketProvider(object):
             display_name = data.get('display_name')
         profile['displayName'] = display_name
 
-        # request user emails
-        resp = requests.get(EMAIL_URL.format(username=username), auth=oauth)
-        if resp.status_code == 200:
-            data = resp.json()
-            emails = []
-            for item in data:
-                email = {'value': item['email']}
-                if item.get('primary'):
-                    email['primary'] = True
-                emails.append(email)
-                if item.get('active'):
-                    profile['verifiedEmail'] = item['email']
-            profile['emails'] = emails
+        if self.lazy_profile:
+            profile['partial'] = True
+        elif self.enrichment_cache is not None:
+            profile = enrich_or_degrade(self, profile, creds)
+        elif emails is None:
+            profile['partial'] = True
+        else:
+            self._update_emails(profile, emails)
 
         return BitbucketAuthenticationComplete(profile=profile,
                                                credentials=creds,
                                                provider_name=self.name,
                                                provider_type=self.type)
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the user's email addresses"""
+        profile = dict(profile)
+        profile.pop('partial', None)
+        oauth = self._oauth(credentials)
+
+        def fetch():
+            return self._fetch_emails(oauth)
+
+        if self.enrichment_cache is None:
+            emails = fetch()
+        else:
+            emails = self.enrichment_cache.get(
+                self.name, profile['accounts'][0]['username'], fetch)
+        self._update_emails(profile, emails)
+        return profile
+
+    def _oauth(self, credentials):
+        # setup oauth for general api calls
+        return self.http.oauth1(
+            self.consumer_key,
+            client_secret=self.consumer_secret,
+            resource_owner_key=credentials['oauthAccessToken'],
+            resource_owner_secret=credentials['oauthAccessTokenSecret'])
+
+    def _fetch_emails(self, oauth):
+        resp = self.http.get(EMAIL_URL, auth=oauth)
+        if resp.status_code != 200:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                resp.status_code, resp.content))
+        return resp.json()
+
+    def _try_fetch_emails(self, oauth):
+        try:
+            with self.http.enrichment():
+                return self._fetch_emails(oauth)
+        except Exception:
+            log.warning('Failed to fetch the %s emails, returning a partial '
+                        'profile', self.name, exc_info=True)
+
+    def _update_emails(self, profile, data):
+        emails = []
+        for item in data:
+            email = {'value': item['email']}
+            if item.get('primary'):
+                email['primary'] = True
+            emails.append(email)
+            if item.get('active'):
+                profile['verifiedEmail'] = item['email']
+        profile['emails'] = emails
@@ -2,13 +2,12 @@
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
@@ -32,6 +31,7 @@ def add_douban_login_from_settings(config, prefix='velruse.douban.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_douban_login(**p.kwargs)
 
 
@@ -41,11 +41,13 @@ def add_douban_login(config,
                      scope=None,
                      login_path='/login/douban',
                      callback_path='/login/douban/callback',
-                     name='douban'):
+                     name='douban',
+                     http_client=None):
     """
     Add a Douban login provider to the application.
     """
-    provider = DoubanProvider(name, consumer_key, consumer_secret, scope)
+    provider = DoubanProvider(name, consumer_key, consumer_secret, scope,
+                              http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -59,11 +61,13 @@ def add_douban_login(config,
 
 
 class DoubanProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None):
         self.name = name
         self.type = 'douban'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
         self.scope = scope
 
         self.login_route = 'velruse.%s-login' % name
@@ -79,6 +83,7 @@ class DoubanProvider(object):
                        redirect_uri=request.route_url(self.callback_route))
         return HTTPFound(url)
 
+    @with_deadline
     def callback(self, request):
         """Process the douban redirect"""
         code = request.GET.get('code')
@@ -88,7 +93,7 @@ class DoubanProvider(object):
                                         provider_name=self.name,
                                         provider_type=self.type)
 
-        r = requests.post(
+        r = self.http.post(
             'https://www.douban.com/service/auth2/token',
             dict(client_id=self.consumer_key,
             client_secret=self.consumer_secret,
@@ -104,25 +109,34 @@ class DoubanProvider(object):
         refresh_token = token_data.get('refresh_token')
         user_id = token_data['douban_user_id']
 
-        # Retrieve profile data if scopes allow
         profile = {
             'accounts': [{'domain': 'douban.com', 'userid': user_id}],
         }
-        user_url = flat_url(
-            'https://api.douban.com/v2/user/%s' % user_id,
-        )
-        r = requests.get(user_url)
-        if r.status_code == 200:
-            data = r.json()
-            profile['displayName'] = data['name']
-            profile['preferredUsername'] = data['name']
-            profile['avatar'] = data['large_avatar']
-            profile['data'] = data
-
         cred = {'oauthAccessToken': access_token,
                 'oauthRefreshToken': refresh_token}
+        profile = enrich_or_degrade(self, profile, cred)
 
         return DoubanAuthenticationComplete(profile=profile,
                                             credentials=cred,
                                             provider_name=self.name,
                                             provider_type=self.type)
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the user's details"""
+        # Retrieve profile data if scopes allow
+        profile = dict(profile)
+        profile.pop('partial', None)
+        user_url = flat_url(
+            'https://api.douban.com/v2/user/%s' % (
+                profile['accounts'][0]['userid'],),
+        )
+        r = self.http.get(user_url, endpoint='douban-user')
+        if r.status_code != 200:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                r.status_code, r.content))
+        data = r.json()
+        profile['displayName'] = data['name']
+        profile['preferredUsername'] = data['name']
+        profile['avatar'] = data['large_avatar']
+        profile['data'] = data
+        return profile
@@ -1,23 +1,30 @@
 """Facebook Authentication Views"""
 import datetime
-import uuid
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
-import requests
 
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..cache import idempotent_callback
+from ..client import HTTPClient, with_deadline
 from ..compat import parse_qsl
-from ..exceptions import CSRFError
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
+from ..utils import field_list
 from ..utils import flat_url
 
 
+# the Graph API fields used by extract_fb_data
+PROFILE_FIELDS = ['id', 'name', 'first_name', 'last_name', 'link', 'gender',
+                  'email', 'verified', 'timezone', 'birthday']
+REQUIRED_FIELDS = ['id', 'name']
+
+
 class FacebookAuthenticationComplete(AuthenticationComplete):
     """Facebook auth complete"""
 
@@ -34,8 +41,12 @@ def add_facebook_login_from_settings(config, prefix='velruse.facebook.'):
     p.update('consumer_key', required=True)
     p.update('consumer_secret', required=True)
     p.update('scope')
+    p.update('fields')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
+    p.update_callback_cache()
     config.add_facebook_login(**p.kwargs)
 
 
@@ -45,11 +56,25 @@ def add_facebook_login(config,
                        scope=None,
                        login_path='/login/facebook',
                        callback_path='/login/facebook/callback',
-                       name='facebook'):
+                       name='facebook',
+                       http_client=None,
+                       state_manager=None,
+                       fields=None,
+                       callback_cache=None):
     """
     Add a Facebook login provider to the application.
+
+    ``fields`` are the Graph API fields of the user to request, defaulting
+    to the ones used to build the profile.
+
+    ``callback_cache`` is a :class:`velruse.cache.CallbackCache` answering
+    duplicate callbacks with the result of the first one.
     """
-    provider = FacebookProvider(name, consumer_key, consumer_secret, scope)
+    provider = FacebookProvider(name, consumer_key, consumer_secret, scope,
+                                http_client=http_client,
+                                state_manager=state_manager,
+                                fields=fields,
+                                callback_cache=callback_cache)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -63,13 +88,21 @@ def add_facebook_login(config,
 
 
 class FacebookProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None,
+                 state_manager=None,
+                 fields=None,
+                 callback_cache=None):
         self.name = name
         self.type = 'facebook'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
+        self.callback_cache = callback_cache
         self.scope = scope
         self.display = 'page'
+        self.fields = field_list(fields or PROFILE_FIELDS, REQUIRED_FIELDS)
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -78,7 +111,7 @@ class FacebookProvider(object):
         """Initiate a facebook login"""
         scope = request.POST.get('scope', self.scope)
         display = request.POST.get('display', self.display)
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         fb_url = flat_url(
             'https://www.facebook.com/dialog/oauth/',
             scope=scope,
@@ -88,18 +121,11 @@ class FacebookProvider(object):
             state=state)
         return HTTPFound(location=fb_url)
 
+    @idempotent_callback
+    @with_deadline
     def callback(self, request):
         """Process the facebook redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error_reason', 'No reason provided.')
@@ -114,7 +140,7 @@ class FacebookProvider(object):
             client_secret=self.consumer_secret,
             redirect_uri=request.route_url(self.callback_route),
             code=code)
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -122,8 +148,9 @@ class FacebookProvider(object):
 
         # Retrieve profile data
         graph_url = flat_url('https://graph.facebook.com/me',
-                             access_token=access_token)
-        r = requests.get(graph_url)
+                             access_token=access_token,
+                             fields=self.fields)
+        r = self.http.get(graph_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -190,7 +217,7 @@ def extract_fb_data(data):
     profile['name'] = name
 
     # Now strip out empty values
-    for k, v in profile.items():
+    for k, v in list(profile.items()):
         if not v or (isinstance(v, list) and not v[0]):
             del profile[k]
 
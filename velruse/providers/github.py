@@ -1,23 +1,25 @@
 """Github Authentication Views"""
-import uuid
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..cache import idempotent_callback
+from ..client import HTTPClient, with_deadline
 from ..compat import parse_qsl
-from ..exceptions import CSRFError
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
 from ..utils import flat_url
 
 
+log = __import__('logging').getLogger(__name__)
+
+
 class GithubAuthenticationComplete(AuthenticationComplete):
     """Github auth complete"""
 
@@ -38,6 +40,9 @@ def add_github_login_from_settings(config, prefix='velruse.github.'):
     p.update('callback_path')
     p.update('secure')
     p.update('domain')
+    p.update_client()
+    p.update_state_manager()
+    p.update_callback_cache()
     config.add_github_login(**p.kwargs)
 
 
@@ -49,16 +54,25 @@ def add_github_login(config,
                      callback_path='/login/github/callback',
                      secure=True,
                      domain='github.com',
-                     name='github'):
+                     name='github',
+                     http_client=None,
+                     state_manager=None,
+                     callback_cache=None):
     """
     Add a Github login provider to the application.
+
+    ``callback_cache`` is a :class:`velruse.cache.CallbackCache` answering
+    duplicate callbacks with the result of the first one.
     """
     provider = GithubProvider(name,
                               consumer_key,
                               consumer_secret,
                               scope,
                               secure,
-                              domain)
+                              domain,
+                              http_client=http_client,
+                              state_manager=state_manager,
+                              callback_cache=callback_cache)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -78,11 +92,17 @@ class GithubProvider(object):
                  consumer_secret,
                  scope,
                  secure,
-                 domain):
+                 domain,
+                 http_client=None,
+                 state_manager=None,
+                 callback_cache=None):
         self.name = name
         self.type = 'github'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
+        self.callback_cache = callback_cache
         self.scope = scope
         self.protocol = 'http' if secure is False else 'https'
         self.domain = domain
@@ -93,7 +113,7 @@ class GithubProvider(object):
     def login(self, request):
         """Initiate a github login"""
         scope = request.POST.get('scope', self.scope)
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         gh_url = flat_url(
             '%s://%s/login/oauth/authorize' % (self.protocol, self.domain),
             scope=scope,
@@ -102,18 +122,11 @@ class GithubProvider(object):
             state=state)
         return HTTPFound(location=gh_url)
 
+    @idempotent_callback
+    @with_deadline
     def callback(self, request):
         """Process the github redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error', 'No reason provided.')
@@ -128,17 +141,22 @@ class GithubProvider(object):
             client_secret=self.consumer_secret,
             redirect_uri=request.route_url(self.callback_route),
             code=code)
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
         access_token = dict(parse_qsl(r.text))['access_token']
 
-        # Retrieve profile data
-        graph_url = flat_url('%s://api.%s/user' % (self.protocol, self.domain),
-                             access_token=access_token)
+        # Retrieve profile data and the user's email addresses concurrently
+        api_url = '%s://api.%s' % (self.protocol, self.domain)
+        graph_url = flat_url(api_url + '/user', access_token=access_token)
+        emails_url = flat_url(api_url + '/user/emails',
+                              access_token=access_token)
         graph_headers = dict(Accept='application/vnd.github.v3+json')
-        r = requests.get(graph_url, headers=graph_headers)
+        r, emails_r = self.http.gather(
+            lambda: self.http.get(graph_url, headers=graph_headers),
+            lambda: self._try_fetch_emails(emails_url, graph_headers),
+        )
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -154,13 +172,35 @@ class GithubProvider(object):
         profile['preferredUsername'] = data['login']
         profile['displayName'] = data.get('name', profile['preferredUsername'])
 
-        # We don't add this to verifiedEmail because ppl can change email
-        # addresses without verifying them
-        if 'email' in data:
+        # The email list is only available with the user:email scope. It
+        # flags verified addresses, unlike the public email on the profile
+        # which ppl can change without verifying it.
+        if emails_r is not None and emails_r.status_code == 200:
+            emails = []
+            for item in emails_r.json():
+                email = {'value': item['email']}
+                if item.get('primary'):
+                    email['primary'] = True
+                    if item.get('verified'):
+                        profile['verifiedEmail'] = item['email']
+                emails.append(email)
+            if emails:
+                profile['emails'] = emails
+        elif 'email' in data:
             profile['emails'] = [{'value': data['email']}]
+        if emails_r is None:
+            profile['partial'] = True
 
         cred = {'oauthAccessToken': access_token}
         return GithubAuthenticationComplete(profile=profile,
                                             credentials=cred,
                                             provider_name=self.name,
                                             provider_type=self.type)
+
+    def _try_fetch_emails(self, url, headers):
+        try:
+            with self.http.enrichment():
+                return self.http.get(url, headers=headers)
+        except Exception:
+            log.warning('Failed to fetch the %s emails, returning a partial '
+                        'profile', self.name, exc_info=True)
@@ -2,16 +2,17 @@ from __future__ import absolute_import
 
 from openid.extensions import ax
 
-import requests
-from requests_oauthlib import OAuth1
-
 from pyramid.security import NO_PERMISSION_REQUIRED
 
 from ..api import register_provider
+from ..client import enrich_or_degrade
 from ..compat import parse_qsl
+from ..exceptions import ThirdPartyFailure
 
 from .oid_extensions import OAuthRequest
+from .oid_extensions import PrecompiledExtension
 from .oid_extensions import UIRequest
+from .oid_store import openid_store
 from .openid import (
     attributes,
     OpenIDAuthenticationComplete,
@@ -49,7 +50,13 @@ def add_google_login(config,
                      scope=None,
                      login_path='/login/google',
                      callback_path='/login/google/callback',
-                     name='google'):
+                     name='google',
+                     http_client=None,
+                     discovery_cache=None,
+                     session_storage=None,
+                     session_ttl=600,
+                     lazy_profile=False,
+                     enrichment_cache=None):
     """
     Add a Google login provider to the application using the OpenID+OAuth
     hybrid protocol.  This protocol can be configured for purely
@@ -61,11 +68,20 @@ def add_google_login(config,
       + ``attrs``
       + ``realm``
       + ``storage``
+      + ``discovery_cache``
+      + ``session_storage``
+      + ``session_ttl``
     - OAuth parameters
       + ``consumer_key``
       + ``consumer_secret``
       + ``scope``
+      + ``lazy_profile``, to complete the login without the profile from
+        Google Contacts, which is only fetched when the ``partial`` profile
+        is enriched
+      + ``enrichment_cache``, a :class:`velruse.cache.EnrichmentCache`
+        keeping the Google Contacts profiles of returning users
     """
+    storage = openid_store(storage, config.registry)
     provider = GoogleConsumer(
         name,
         attrs,
@@ -73,7 +89,13 @@ def add_google_login(config,
         storage,
         consumer_key,
         consumer_secret,
-        scope)
+        scope,
+        http_client=http_client,
+        discovery_cache=discovery_cache,
+        session_storage=session_storage,
+        session_ttl=session_ttl,
+        lazy_profile=lazy_profile,
+        enrichment_cache=enrichment_cache)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -91,25 +113,41 @@ class GoogleConsumer(OpenIDConsumer):
     ]
 
     def __init__(self, name, attrs=None, realm=None, storage=None,
-                 oauth_key=None, oauth_secret=None, oauth_scope=None):
+                 oauth_key=None, oauth_secret=None, oauth_scope=None,
+                 http_client=None, discovery_cache=None,
+                 session_storage=None, session_ttl=600,
+                 lazy_profile=False, enrichment_cache=None):
         """Handle Google Auth
 
         This also handles making an OAuth request during the OpenID
         authentication.
 
         """
+        if attrs is not None:
+            self.openid_attributes = attrs
         OpenIDConsumer.__init__(self, name, 'google_hybrid', realm, storage,
-                                context=GoogleAuthenticationComplete)
+                                context=GoogleAuthenticationComplete,
+                                http_client=http_client,
+                                discovery_cache=discovery_cache,
+                                session_storage=session_storage,
+                                session_ttl=session_ttl)
         self.oauth_key = oauth_key
         self.oauth_secret = oauth_secret
         self.oauth_scope = oauth_scope
-        if attrs is not None:
-            self.openid_attributes = attrs
+        self.lazy_profile = lazy_profile
+        self.enrichment_cache = enrichment_cache
 
     def _lookup_identifier(self, request, identifier):
         """Return the Google OpenID directed endpoint"""
         return "https://www.google.com/accounts/o8/id"
 
+    def _build_extensions(self):
+        """Request the configured attributes with Attribute Exchange"""
+        ax_request = ax.FetchRequest()
+        for attr in self.openid_attributes:
+            ax_request.add(ax.AttrInfo(attributes[attr], required=True))
+        return [PrecompiledExtension(ax_request)]
+
     def _update_authrequest(self, request, authrequest):
         """Update the authrequest with Attribute Exchange and optionally OAuth
 
@@ -118,10 +156,8 @@ class GoogleConsumer(OpenIDConsumer):
         access requested.
 
         """
-        ax_request = ax.FetchRequest()
-        for attr in self.openid_attributes:
-            ax_request.add(ax.AttrInfo(attributes[attr], required=True))
-        authrequest.addExtension(ax_request)
+        for ext in self.auth_extensions:
+            authrequest.addExtension(ext)
 
         # Add OAuth request?
         oauth_scope = self.oauth_scope
@@ -148,22 +184,45 @@ class GoogleConsumer(OpenIDConsumer):
             http://www-opensocial.googleusercontent.com/api/people
 
         """
-        if self.oauth_key is None:
+        if self.oauth_key is None or 'oauthAccessToken' not in credentials:
             return
-
-        # setup oauth for general api calls
-        oauth = OAuth1(
-            self.oauth_key,
-            client_secret=self.oauth_secret,
-            resource_owner_key=credentials['oauthAccessToken'],
-            resource_owner_secret=credentials['oauthAccessTokenSecret'])
-
-        profile_url = \
-            'https://www-opensocial.googleusercontent.com/api/people/@me/@self'
-        resp = requests.get(profile_url, auth=oauth)
-        if resp.status_code != 200:
+        if self.lazy_profile:
+            profile['partial'] = True
             return
-        data = resp.json()
+        profile.update(enrich_or_degrade(self, profile, credentials))
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the profile from Google
+        Contacts"""
+        profile = dict(profile)
+        profile.pop('partial', None)
+        profile['accounts'] = [dict(a) for a in profile['accounts']]
+        self._fetch_contacts_profile(profile, credentials)
+        return profile
+
+    def _fetch_contacts_profile(self, profile, credentials):
+        def fetch():
+            # setup oauth for general api calls
+            oauth = self.http.oauth1(
+                self.oauth_key,
+                client_secret=self.oauth_secret,
+                resource_owner_key=credentials['oauthAccessToken'],
+                resource_owner_secret=credentials['oauthAccessTokenSecret'])
+
+            profile_url = 'https://www-opensocial.googleusercontent.com' \
+                '/api/people/@me/@self'
+            resp = self.http.get(profile_url, auth=oauth)
+            if resp.status_code != 200:
+                raise ThirdPartyFailure("Status %s: %s" % (
+                    resp.status_code, resp.content))
+            return resp.json()
+
+        if self.enrichment_cache is None:
+            data = fetch()
+        else:
+            # keyed by the OpenID identifier
+            data = self.enrichment_cache.get(
+                self.name, profile['accounts'][0]['username'], fetch)
         if 'entry' in data:
             profile.update(data['entry'])
 
@@ -172,12 +231,12 @@ class GoogleConsumer(OpenIDConsumer):
 
     def _get_access_token(self, request_token):
         """Retrieve the access token if OAuth hybrid was used"""
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.oauth_key,
             client_secret=self.oauth_secret,
             resource_owner_key=request_token)
 
-        resp = requests.post(GOOGLE_OAUTH, auth=oauth)
+        resp = self.http.post(GOOGLE_OAUTH, auth=oauth)
         if resp.status_code != 200:
             log.error(
                 'OAuth token validation failed. Status: %d, Content: %s',
@@ -1,18 +1,18 @@
-import uuid
+import base64
+import json
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
-from ..exceptions import CSRFError
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
 from ..utils import flat_url
 
 
@@ -46,6 +46,8 @@ def add_google_login_from_settings(config, prefix='velruse.google.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
     config.add_google_oauth2_login(**p.kwargs)
 
 def add_google_login(config,
@@ -54,7 +56,9 @@ def add_google_login(config,
                      scope=None,
                      login_path='/login/google',
                      callback_path='/login/google/callback',
-                     name='google'):
+                     name='google',
+                     http_client=None,
+                     state_manager=None):
     """
     Add a Google login provider to the application supporting the new
     OAuth2 protocol.
@@ -63,7 +67,9 @@ def add_google_login(config,
         name,
         consumer_key,
         consumer_secret,
-        scope)
+        scope,
+        http_client=http_client,
+        state_manager=state_manager)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -84,11 +90,15 @@ class GoogleOAuth2Provider(object):
                  name,
                  consumer_key,
                  consumer_secret,
-                 scope):
+                 scope,
+                 http_client=None,
+                 state_manager=None):
         self.name = name
         self.type = 'google_oauth2'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
         self.protocol = 'https'
         self.domain = GOOGLE_OAUTH2_DOMAIN
 
@@ -102,7 +112,7 @@ class GoogleOAuth2Provider(object):
     def login(self, request):
         """Initiate a google login"""
         scope = ' '.join(request.POST.getall('scope')) or self.scope
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
 
         approval_prompt = request.POST.get('approval_prompt', 'auto')
 
@@ -117,18 +127,10 @@ class GoogleOAuth2Provider(object):
             state=state)
         return HTTPFound(location=auth_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the google redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error', 'No reason provided.')
@@ -137,7 +139,7 @@ class GoogleOAuth2Provider(object):
                                         provider_type=self.type)
 
         # Now retrieve the access token with the code
-        r = requests.post(
+        r = self.http.post(
             '%s://%s/o/oauth2/token' % (self.protocol, self.domain),
             dict(client_id=self.consumer_key,
                  client_secret=self.consumer_secret,
@@ -152,12 +154,47 @@ class GoogleOAuth2Provider(object):
         access_token = token_data['access_token']
         refresh_token = token_data.get('refresh_token')
 
+        cred = {'oauthAccessToken': access_token,
+                'oauthRefreshToken': refresh_token}
+        profile = self._id_token_profile(token_data.get('id_token'))
+        if profile is None:
+            profile = self.enrich_profile({}, cred)
+        else:
+            profile = enrich_or_degrade(self, profile, cred)
+        return GoogleAuthenticationComplete(profile=profile,
+                                            credentials=cred,
+                                            provider_name=self.name,
+                                            provider_type=self.type)
+
+    def _id_token_profile(self, id_token):
+        # The ID token comes straight from Google's token endpoint over
+        # TLS, so its claims are used without checking the signature.
+        try:
+            payload = id_token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload.encode('ascii'))
+                .decode('utf-8'))
+            account = {'domain': self.domain, 'userid': claims['sub']}
+        except (AttributeError, IndexError, KeyError, TypeError,
+                ValueError):
+            return None
+        profile = {'accounts': [account]}
+        if 'email' in claims:
+            account['username'] = claims['email']
+            profile['preferredUsername'] = claims['email']
+            profile['emails'] = [{'value': claims['email']}]
+        return profile
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the user's details"""
         # Retrieve profile data if scopes allow
-        profile = {}
+        profile = dict(profile)
+        profile.pop('partial', None)
         user_url = flat_url(
             '%s://www.googleapis.com/oauth2/v1/userinfo' % self.protocol,
-            access_token=access_token)
-        r = requests.get(user_url)
+            access_token=credentials['oauthAccessToken'])
+        r = self.http.get(user_url)
 
         if r.status_code == 200:
             data = r.json()
@@ -173,10 +210,7 @@ class GoogleOAuth2Provider(object):
             profile['preferredUsername'] = data['email']
             profile['verifiedEmail'] = data['email']
             profile['emails'] = [{'value': data['email']}]
-
-        cred = {'oauthAccessToken': access_token,
-                'oauthRefreshToken': refresh_token}
-        return GoogleAuthenticationComplete(profile=profile,
-                                            credentials=cred,
-                                            provider_name=self.name,
-                                            provider_type=self.type)
+        elif profile:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                r.status_code, r.content))
+        return profile
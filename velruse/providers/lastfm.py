@@ -4,13 +4,12 @@ from hashlib import md5
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
@@ -35,6 +34,7 @@ def add_lastfm_login_from_settings(config, prefix='velruse.lastfm.'):
     p.update('consumer_secret', required=True)
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_lastfm_login(**p.kwargs)
 
 
@@ -43,11 +43,13 @@ def add_lastfm_login(config,
                      consumer_secret,
                      login_path='/lastfm/login',
                      callback_path='/lastfm/login/callback',
-                     name='lastfm'):
+                     name='lastfm',
+                     http_client=None):
     """
     Add a Last.fm login provider to the application.
     """
-    provider = LastfmProvider(name, consumer_key, consumer_secret)
+    provider = LastfmProvider(name, consumer_key, consumer_secret,
+                              http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -61,11 +63,12 @@ def add_lastfm_login(config,
 
 
 class LastfmProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None):
         self.name = name
         self.type = 'lastfm'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -76,6 +79,7 @@ class LastfmProvider(object):
                           api_key=self.consumer_key)
         return HTTPFound(location=fb_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the LastFM redirect"""
         if 'error' in request.GET:
@@ -96,7 +100,7 @@ class LastfmProvider(object):
         }
         signed_params = sign_call(params, self.consumer_secret)
         session_url = flat_url(API_BASE, format='json', **signed_params)
-        r = requests.get(session_url)
+        r = self.http.get(session_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -110,7 +114,7 @@ class LastfmProvider(object):
         # Fetch the user data
         user_url = flat_url(API_BASE, format='json', method='user.getInfo',
                             user=session['name'], api_key=self.consumer_key)
-        r = requests.get(user_url)
+        r = self.http.get(user_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -1,6 +1,4 @@
 """LinkedIn Authentication Views"""
-import requests
-from requests_oauthlib import OAuth1
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
@@ -10,15 +8,23 @@ from ..api import (
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..compat import parse_qsl
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..utils import field_list
 from ..utils import flat_url
 
 
 REQUEST_URL = 'https://api.linkedin.com/uas/oauth/requestToken'
 AUTH_URL = 'https://api.linkedin.com/uas/oauth/authenticate'
 ACCESS_URL = 'https://api.linkedin.com/uas/oauth/accessToken'
+PROFILE_URL = 'http://api.linkedin.com/v1/people/~'
+
+# the field selectors used to build the profile
+PROFILE_FIELDS = ['id', 'first-name', 'last-name', 'picture-url',
+                  'email-address']
+REQUIRED_FIELDS = ['id', 'first-name', 'last-name']
 
 
 class LinkedInAuthenticationComplete(AuthenticationComplete):
@@ -36,8 +42,11 @@ def add_linkedin_login_from_settings(config, prefix='velruse.linkedin.'):
     p = ProviderSettings(settings, prefix)
     p.update('consumer_key', required=True)
     p.update('consumer_secret', required=True)
+    p.update('fields')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_request_token_pool()
     config.add_linkedin_login(**p.kwargs)
 
 
@@ -46,11 +55,24 @@ def add_linkedin_login(config,
                        consumer_secret,
                        login_path='/login/linkedin',
                        callback_path='/login/linkedin/callback',
-                       name='linkedin'):
+                       name='linkedin',
+                       http_client=None,
+                       fields=None,
+                       request_token_pool=None):
     """
-    Add a Last.fm login provider to the application.
+    Add a LinkedIn login provider to the application.
+
+    ``fields`` are the profile field selectors to request, defaulting to
+    the ones used to build the profile.
+
+    ``request_token_pool`` is a
+    :class:`velruse.request_tokens.RequestTokenPool` prefetching the request
+    tokens, so that the login redirect is served without a request to
+    LinkedIn.
     """
-    provider = LinkedInProvider(name, consumer_key, consumer_secret)
+    provider = LinkedInProvider(name, consumer_key, consumer_secret,
+                                http_client=http_client, fields=fields,
+                                request_token_pool=request_token_pool)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -64,11 +86,15 @@ def add_linkedin_login(config,
 
 
 class LinkedInProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None,
+                 fields=None, request_token_pool=None):
         self.name = name
         self.type = 'linked_in'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.fields = field_list(fields or PROFILE_FIELDS, REQUIRED_FIELDS)
+        self.request_token_pool = request_token_pool
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -76,15 +102,12 @@ class LinkedInProvider(object):
     def login(self, request):
         """Initiate a LinkedIn login"""
         # grab the initial request token
-        oauth = OAuth1(
-            self.consumer_key,
-            client_secret=self.consumer_secret,
-            callback_uri=request.route_url(self.callback_route))
-        resp = requests.post(REQUEST_URL, auth=oauth)
-        if resp.status_code != 200:
-            raise ThirdPartyFailure("Status %s: %s" % (
-                resp.status_code, resp.content))
-        request_token = dict(parse_qsl(resp.text))
+        callback_uri = request.route_url(self.callback_route)
+        if self.request_token_pool is None:
+            request_token = self._fetch_request_token(callback_uri)
+        else:
+            request_token = self.request_token_pool.take(
+                callback_uri, self._fetch_request_token)
 
         # store the token for later
         request.session['velruse.token'] = request_token
@@ -93,6 +116,18 @@ class LinkedInProvider(object):
         auth_url = flat_url(AUTH_URL, oauth_token=request_token['oauth_token'])
         return HTTPFound(location=auth_url)
 
+    def _fetch_request_token(self, callback_uri):
+        oauth = self.http.oauth1(
+            self.consumer_key,
+            client_secret=self.consumer_secret,
+            callback_uri=callback_uri)
+        resp = self.http.post(REQUEST_URL, auth=oauth)
+        if resp.status_code != 200:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                resp.status_code, resp.content))
+        return dict(parse_qsl(resp.text))
+
+    @with_deadline
     def callback(self, request):
         """Process the LinkedIn redirect"""
         if 'denied' in request.GET:
@@ -107,13 +142,13 @@ class LinkedInProvider(object):
         request_token = request.session.pop('velruse.token')
 
         # turn our request token into an access token
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.consumer_key,
             client_secret=self.consumer_secret,
             resource_owner_key=request_token['oauth_token'],
             resource_owner_secret=request_token['oauth_token_secret'],
             verifier=verifier)
-        resp = requests.post(ACCESS_URL, auth=oauth)
+        resp = self.http.post(ACCESS_URL, auth=oauth)
         if resp.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 resp.status_code, resp.content))
@@ -124,18 +159,15 @@ class LinkedInProvider(object):
         }
 
         # setup oauth for general api calls
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.consumer_key,
             client_secret=self.consumer_secret,
             resource_owner_key=creds['oauthAccessToken'],
             resource_owner_secret=creds['oauthAccessTokenSecret'])
 
-        profile_url = 'http://api.linkedin.com/v1/people/~'
-        profile_url += (':(first-name,last-name,id,date-of-birth,picture-url,'
-                        'email-address)')
-        profile_url += '?format=json'
+        profile_url = '%s:(%s)?format=json' % (PROFILE_URL, self.fields)
 
-        resp = requests.get(profile_url, auth=oauth)
+        resp = self.http.get(profile_url, auth=oauth)
         if resp.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 resp.status_code, resp.content))
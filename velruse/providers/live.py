@@ -4,13 +4,12 @@ import datetime
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
@@ -34,6 +33,7 @@ def add_live_login_from_settings(config, prefix='velruse.live.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_live_login(**p.kwargs)
 
 
@@ -43,11 +43,13 @@ def add_live_login(config,
                    scope=None,
                    login_path='/login/live',
                    callback_path='/login/live/callback',
-                   name='live'):
+                   name='live',
+                   http_client=None):
     """
     Add a Live login provider to the application.
     """
-    provider = LiveProvider(name, consumer_key, consumer_secret, scope)
+    provider = LiveProvider(name, consumer_key, consumer_secret, scope,
+                            http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -61,11 +63,13 @@ def add_live_login(config,
 
 
 class LiveProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None):
         self.name = name
         self.type = 'live'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
         self.scope = scope
 
         self.login_route = 'velruse.%s-login' % name
@@ -81,6 +85,7 @@ class LiveProvider(object):
                           response_type="code")
         return HTTPFound(location=fb_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the Live redirect"""
         if 'error' in request.GET:
@@ -101,7 +106,7 @@ class LiveProvider(object):
             redirect_uri=request.route_url(self.callback_route),
             grant_type="authorization_code",
             code=code)
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -111,7 +116,7 @@ class LiveProvider(object):
         # Retrieve profile data
         graph_url = flat_url('https://apis.live.net/v5.0/me',
                              access_token=access_token)
-        r = requests.get(graph_url)
+        r = self.http.get(graph_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -4,20 +4,19 @@ You may see developer docs on http://api.mail.ru/docs/guides/oauth/
 """
 import hashlib
 import re
-import uuid
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
-from ..exceptions import CSRFError, ThirdPartyFailure
+from ..client import HTTPClient, with_deadline
+from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
 from ..utils import flat_url
 
 
@@ -57,6 +56,8 @@ def add_mailru_login_from_settings(config, prefix='velruse.mailru.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
     config.add_mailru_login(**p.kwargs)
 
 
@@ -67,10 +68,14 @@ def add_mailru_login(
     scope=None,
     login_path='/login/{name}'.format(name=PROVIDER_NAME),
     callback_path='/login/{name}/callback'.format(name=PROVIDER_NAME),
-    name=PROVIDER_NAME
+    name=PROVIDER_NAME,
+    http_client=None,
+    state_manager=None
 ):
     """Add a MailRu login provider to the application."""
-    provider = MailRuProvider(name, consumer_key, consumer_secret, scope)
+    provider = MailRuProvider(name, consumer_key, consumer_secret, scope,
+                              http_client=http_client,
+                              state_manager=state_manager)
     config.add_route(provider.login_route, login_path)
     config.add_view(
         provider,
@@ -88,11 +93,15 @@ def add_mailru_login(
 
 class MailRuProvider(object):
 
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None,
+                 state_manager=None):
         self.name = name
         self.type = PROVIDER_NAME
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
         self.scope = scope
 
         self.login_route = 'velruse.{name}-login'.format(name=name)
@@ -100,7 +109,7 @@ class MailRuProvider(object):
 
     def login(self, request):
         """Initiate a MailRu login"""
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         auth_url = flat_url(
             PROVIDER_AUTH_URL,
             scope=self.scope,
@@ -110,18 +119,10 @@ class MailRuProvider(object):
             state=state)
         return HTTPFound(location=auth_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the MailRu redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error', 'No reason provided.')
@@ -138,7 +139,7 @@ class MailRuProvider(object):
             client_secret=self.consumer_secret,
             redirect_uri=request.route_url(self.callback_route),
         )
-        r = requests.post(PROVIDER_ACCESS_TOKEN_URL, access_params)
+        r = self.http.post(PROVIDER_ACCESS_TOKEN_URL, access_params)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
@@ -175,7 +176,7 @@ class MailRuProvider(object):
             session_key=access_token,
             secure=1
         )
-        r = requests.get(profile_url)
+        r = self.http.get(profile_url)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
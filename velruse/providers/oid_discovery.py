@@ -0,0 +1,201 @@
+"""OpenID Discovery Cache
+
+Caches the result of Yadis/XRDS discovery so that logins for a known
+identifier don't repeat the discovery round trips.
+
+"""
+from __future__ import absolute_import
+
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+import re
+import time
+
+from openid import fetchers
+from openid.consumer.discover import DiscoveryFailure
+from openid.consumer.discover import OpenIDServiceEndpoint
+from openid.consumer.discover import discover
+from openid.consumer.discover import getOPOrUserServices
+from openid.consumer.discover import normalizeURL
+from openid.yadis import xri
+from openid.yadis.constants import YADIS_ACCEPT_HEADER
+from openid.yadis.discover import DiscoveryResult
+from openid.yadis.discover import whereIsYadis
+from openid.yadis.etxrd import XRDSError
+
+from ..cache import SingleFlight
+from ..cache import TTLCache
+from ..compat import urlsplit
+
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_TTL = 3600
+
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*"?(\d+)"?',
+                        re.I)
+NO_CACHE_RE = re.compile(r'(?:^|,)\s*(?:no-cache|no-store)\b', re.I)
+
+
+class DiscoveryCache(object):
+    """Cache OpenID discovery results by identifier.
+
+    Discovered services are kept for at most ``ttl`` seconds, or for less
+    if the HTTP responses fetched during discovery say so through their
+    ``Cache-Control`` or ``Expires`` headers. A response marked
+    ``no-cache`` or ``no-store`` is not cached at all. At most
+    ``max_entries`` identifiers are kept, normalized so that e.g.
+    ``example.com`` and ``http://example.com/`` share an entry.
+
+    Concurrent discoveries of the same identifier are collapsed into a
+    single fetch.
+
+    Documents are fetched with ``fetcher``, a python-openid
+    ``HTTPFetcher``, defaulting to python-openid's default fetcher.
+
+    An instance can be passed to the OpenID based providers using their
+    ``discovery_cache`` argument and may be shared between them.
+
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=1000, fetcher=None):
+        self.ttl = ttl
+        self.fetcher = fetcher
+        self.cache = TTLCache(ttl=ttl, max_entries=max_entries)
+        self.flight = SingleFlight()
+
+    def discover(self, identifier):
+        """Return ``(claimed_id, services)`` for ``identifier``.
+
+        Compatible with :func:`openid.consumer.discover.discover`.
+        """
+        key = normalize_identifier(identifier)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        return self.flight.do(key, lambda: self._fetch(key))
+
+    def _fetch(self, key):
+        if xri.identifierScheme(key) == 'XRI':
+            # resolved through an XRI proxy, cached for the default ttl
+            claimed_id, services = discover(key)
+            responses = []
+        else:
+            fetcher = _RecordingFetcher(
+                self.fetcher or fetchers.getDefaultFetcher())
+            claimed_id, services = discover_uri(key, fetcher)
+            responses = fetcher.responses
+
+        ttl = self.ttl
+        for resp in responses:
+            freshness = response_freshness(resp.headers or {})
+            if freshness is not None:
+                ttl = min(ttl, freshness)
+        if services and ttl > 0:
+            log.debug('Caching discovery of %s for %ss', key, ttl)
+            self.cache.set(key, (claimed_id, services), ttl=ttl)
+        return claimed_id, services
+
+
+def normalize_identifier(identifier):
+    """Normalize an OpenID identifier the way discovery does.
+
+    Raises :class:`openid.consumer.discover.DiscoveryFailure` if it is not
+    a valid HTTP(S) URL or XRI.
+    """
+    identifier = identifier.strip()
+    if xri.identifierScheme(identifier) == 'XRI':
+        return identifier
+    parsed = urlsplit(identifier)
+    if parsed[0] and parsed[1]:
+        if parsed[0] not in ('http', 'https'):
+            raise DiscoveryFailure('URI scheme is not HTTP or HTTPS', None)
+    else:
+        identifier = 'http://' + identifier
+    return normalizeURL(identifier)
+
+
+def discover_uri(uri, fetcher):
+    """Discover the OpenID services of a normalized URL, fetching the
+    documents with ``fetcher``.
+
+    Same as :func:`openid.consumer.discover.discoverURI`, which always
+    uses python-openid's global default fetcher.
+    """
+    result = _yadis_discover(uri, fetcher)
+    yadis_url = result.normalized_uri
+    body = result.response_text
+    try:
+        services = OpenIDServiceEndpoint.fromXRDS(yadis_url, body)
+    except XRDSError:
+        services = []
+
+    if not services:
+        if result.isXRDS():
+            # fetch the document again without following the Yadis header
+            return _discover_no_yadis(uri, fetcher)
+        services = OpenIDServiceEndpoint.fromHTML(yadis_url, body)
+
+    return normalizeURL(yadis_url), getOPOrUserServices(services)
+
+
+def _check_status(resp, what):
+    if resp.status not in (200, 206):
+        raise DiscoveryFailure(
+            'HTTP Response status from %s is not 200. Got status %r' % (
+                what, resp.status), resp)
+
+
+def _yadis_discover(uri, fetcher):
+    result = DiscoveryResult(uri)
+    resp = fetcher.fetch(uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    _check_status(resp, 'identity URL host')
+    result.normalized_uri = resp.final_url
+    result.content_type = resp.headers.get('content-type')
+    result.xrds_uri = whereIsYadis(resp)
+    if result.xrds_uri and result.usedYadisLocation():
+        resp = fetcher.fetch(result.xrds_uri)
+        _check_status(resp, 'Yadis host')
+        result.content_type = resp.headers.get('content-type')
+    result.response_text = resp.body
+    return result
+
+
+def _discover_no_yadis(uri, fetcher):
+    resp = fetcher.fetch(uri)
+    _check_status(resp, 'identity URL host')
+    claimed_id = resp.final_url
+    services = OpenIDServiceEndpoint.fromHTML(claimed_id, resp.body)
+    return normalizeURL(claimed_id), services
+
+
+def response_freshness(headers):
+    """Return how many seconds a response may be cached according to its
+    headers or ``None`` if they don't say"""
+    headers = dict((k.lower(), v) for k, v in headers.items())
+    cache_control = headers.get('cache-control', '')
+    if NO_CACHE_RE.search(cache_control):
+        return 0
+    match = MAX_AGE_RE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    expires = headers.get('expires')
+    if expires:
+        parsed = parsedate_tz(expires)
+        if parsed is None:
+            return 0
+        return max(0, int(mktime_tz(parsed) - time.time()))
+    return None
+
+
+class _RecordingFetcher(fetchers.HTTPFetcher):
+    """Delegate to another fetcher, keeping the responses of a single
+    discovery"""
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.responses = []
+
+    def fetch(self, url, body=None, headers=None):
+        resp = self.fetcher.fetch(url, body, headers)
+        self.responses.append(resp)
+        return resp
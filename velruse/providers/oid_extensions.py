@@ -38,3 +38,21 @@ class OAuthRequest(extension.Extension):
 
     def getExtensionArgs(self):
         return self._args
+
+
+class PrecompiledExtension(extension.Extension):
+    """An extension whose arguments are computed once from ``ext`` and then
+    reused for every auth request
+
+    Useful for requests that only depend on the consumer's configuration,
+    such as the attributes asked for with Attribute Exchange.
+
+    """
+    def __init__(self, ext):
+        super(PrecompiledExtension, self).__init__()
+        self.ns_uri = ext.ns_uri
+        self.ns_alias = ext.ns_alias
+        self._args = ext.getExtensionArgs()
+
+    def getExtensionArgs(self):
+        return self._args
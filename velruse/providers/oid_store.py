@@ -0,0 +1,220 @@
+"""OpenID Association and Nonce Stores
+
+Stores that keep python-openid's associations and nonces so that the
+consumer doesn't have to run in stateless mode, where each response must
+be verified with an extra ``check_authentication`` request to the OP.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import heapq
+import threading
+import time
+
+from openid.association import Association
+from openid.store import nonce
+from openid.store.interface import OpenIDStore
+
+
+DEFAULT_KEY_PREFIX = 'velruse.openid.'
+
+
+class MemoryOpenIDStore(OpenIDStore):
+    """Keep associations and nonces in the memory of the process.
+
+    Used nonces are indexed by their expiration time so that cleaning them
+    up only touches the expired ones. Expired nonces are also cleaned up
+    whenever a nonce is used, keeping the store bounded without a separate
+    sweeper.
+
+    """
+    def __init__(self):
+        self.associations = {}
+        self.nonces = set()
+        self._nonce_expiry = []
+        self._lock = threading.Lock()
+
+    def storeAssociation(self, server_url, association):
+        with self._lock:
+            assocs = self.associations.setdefault(server_url, {})
+            assocs[association.handle] = association
+
+    def getAssociation(self, server_url, handle=None):
+        with self._lock:
+            assocs = self.associations.get(server_url)
+            if not assocs:
+                return None
+            if handle is not None:
+                assoc = assocs.get(handle)
+                if assoc is not None and assoc.expiresIn <= 0:
+                    del assocs[handle]
+                    return None
+                return assoc
+            best = None
+            for handle, assoc in list(assocs.items()):
+                if assoc.expiresIn <= 0:
+                    del assocs[handle]
+                elif best is None or assoc.issued > best.issued:
+                    best = assoc
+            return best
+
+    def removeAssociation(self, server_url, handle):
+        with self._lock:
+            assocs = self.associations.get(server_url, {})
+            return assocs.pop(handle, None) is not None
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+        key = (server_url, timestamp, salt)
+        with self._lock:
+            self._cleanup_nonces(now)
+            if key in self.nonces:
+                return False
+            self.nonces.add(key)
+            heapq.heappush(self._nonce_expiry, (timestamp + nonce.SKEW, key))
+            return True
+
+    def _cleanup_nonces(self, now):
+        expiry = self._nonce_expiry
+        count = 0
+        while expiry and expiry[0][0] < now:
+            _, key = heapq.heappop(expiry)
+            self.nonces.discard(key)
+            count += 1
+        return count
+
+    def cleanupNonces(self):
+        with self._lock:
+            return self._cleanup_nonces(time.time())
+
+    def cleanupAssociations(self):
+        count = 0
+        with self._lock:
+            for server_url, assocs in list(self.associations.items()):
+                for handle, assoc in list(assocs.items()):
+                    if assoc.expiresIn <= 0:
+                        del assocs[handle]
+                        count += 1
+                if not assocs:
+                    del self.associations[server_url]
+        return count
+
+
+class KeyValueOpenIDStore(OpenIDStore):
+    """Keep associations and nonces in an `anykeystore` backend.
+
+    Sharing the backend between processes lets every worker reuse the
+    associations negotiated by the others. Entries are stored with an
+    expiration, so cleaning up is left to the backend.
+
+    ``store`` is the backend to use. If it is `None`, the
+    ``velruse_store`` of ``registry`` is used once it is needed.
+
+    """
+    def __init__(self, store=None, registry=None,
+                 key_prefix=DEFAULT_KEY_PREFIX):
+        if store is None and registry is None:
+            raise ValueError('either a store or a registry is required')
+        self._store = store
+        self.registry = registry
+        self.key_prefix = key_prefix
+
+    @property
+    def store(self):
+        if self._store is None:
+            return self.registry.velruse_store
+        return self._store
+
+    def _key(self, kind, *parts):
+        digest = hashlib.sha1(
+            '\0'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+        return '%s%s.%s' % (self.key_prefix, kind, digest)
+
+    def _load_associations(self, server_url):
+        try:
+            data = self.store.retrieve(self._key('assoc', server_url))
+        except KeyError:
+            return {}
+        assocs = {}
+        for handle, value in data.items():
+            assoc = Association.deserialize(value)
+            if assoc.expiresIn > 0:
+                assocs[handle] = assoc
+        return assocs
+
+    def _save_associations(self, server_url, assocs):
+        key = self._key('assoc', server_url)
+        if not assocs:
+            self.store.delete(key)
+            return
+        data = dict((h, a.serialize()) for h, a in assocs.items())
+        expires = max(a.expiresIn for a in assocs.values())
+        self.store.store(key, data, expires=expires)
+
+    def storeAssociation(self, server_url, association):
+        assocs = self._load_associations(server_url)
+        assocs[association.handle] = association
+        self._save_associations(server_url, assocs)
+
+    def getAssociation(self, server_url, handle=None):
+        assocs = self._load_associations(server_url)
+        if handle is not None:
+            return assocs.get(handle)
+        if not assocs:
+            return None
+        return max(assocs.values(), key=lambda a: a.issued)
+
+    def removeAssociation(self, server_url, handle):
+        assocs = self._load_associations(server_url)
+        if assocs.pop(handle, None) is None:
+            return False
+        self._save_associations(server_url, assocs)
+        return True
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+        key = self._key('nonce', server_url, timestamp, salt)
+        try:
+            self.store.retrieve(key)
+        except KeyError:
+            pass
+        else:
+            return False
+        expires = max(1, int(timestamp + nonce.SKEW - now))
+        self.store.store(key, True, expires=expires)
+        return True
+
+    def cleanupNonces(self):
+        return 0
+
+    def cleanupAssociations(self):
+        return 0
+
+
+def openid_store(storage, registry):
+    """Return the OpenID store to use for the ``storage`` argument of the
+    OpenID based providers.
+
+    - `None` keeps associations and nonces in memory.
+    - ``'velruse_store'`` keeps them in the ``velruse_store`` of
+      ``registry``.
+    - `False` runs the consumer in stateless mode.
+    - An `anykeystore` backend is wrapped in a
+      :class:`KeyValueOpenIDStore`.
+    - Anything else is expected to be an OpenID store and returned as is.
+
+    """
+    if storage is None:
+        return MemoryOpenIDStore()
+    if storage is False:
+        return None
+    if isinstance(storage, str) and storage == 'velruse_store':
+        return KeyValueOpenIDStore(registry=registry)
+    if not isinstance(storage, OpenIDStore) and hasattr(storage, 'retrieve'):
+        return KeyValueOpenIDStore(storage)
+    return storage
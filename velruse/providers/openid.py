@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import datetime
 import re
+import uuid
 
 from openid.consumer import consumer
 from openid.extensions import ax
@@ -16,11 +17,16 @@ from ..api import (
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..exceptions import (
     MissingParameter,
     ThirdPartyFailure,
 )
 
+from .oid_discovery import DiscoveryCache
+from .oid_extensions import PrecompiledExtension
+from .oid_store import openid_store
+
 log = __import__('logging').getLogger(__name__)
 
 # Setup our attribute objects that we'll be requesting
@@ -71,6 +77,9 @@ trans_dict = dict(
 
 attributes = ax_attributes
 
+# Much cheaper than datetime.strptime(value, '%Y-%m-%d')
+birthday_re = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})$')
+
 
 class OpenIDAuthenticationComplete(AuthenticationComplete):
     """OpenID auth complete"""
@@ -85,15 +94,37 @@ def add_openid_login(config,
                      storage=None,
                      login_path='/login/openid',
                      callback_path='/login/openid/callback',
-                     name='openid'):
+                     name='openid',
+                     discovery_cache=None,
+                     session_storage=None,
+                     session_ttl=600):
     """
     Add an OpenID login provider to the application.
 
     `storage` should be an object conforming to the
-    `openid.store.interface.OpenIDStore` protocol. If left as `None` then
-    the provider will run in a stateless mode.
+    `openid.store.interface.OpenIDStore` protocol or an `anykeystore`
+    backend. If left as `None` associations and nonces are kept in memory.
+    Use ``'velruse_store'`` to share them between processes through the
+    Velruse store, or `False` to run the provider in stateless mode.
+    See :func:`velruse.providers.oid_store.openid_store`.
+
+    `discovery_cache` is a
+    :class:`~velruse.providers.oid_discovery.DiscoveryCache` used to avoid
+    repeating discovery for known identifiers. A private cache with the
+    default settings is used if it is `None`. Pass `False` to disable
+    caching.
+
+    `session_storage` selects where the python-openid consumer session is
+    kept between the login and the callback. By default it is stored in
+    the Pyramid session. Use ``'velruse_store'`` or an `anykeystore`
+    backend to keep it on the server for at most `session_ttl` seconds,
+    leaving only a short reference in the Pyramid session.
     """
-    provider = OpenIDConsumer(name, 'openid', realm=realm, storage=storage)
+    storage = openid_store(storage, config.registry)
+    provider = OpenIDConsumer(name, 'openid', realm=realm, storage=storage,
+                              discovery_cache=discovery_cache,
+                              session_storage=session_storage,
+                              session_ttl=session_ttl)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -117,12 +148,23 @@ class OpenIDConsumer(object):
                  _type,
                  realm=None,
                  storage=None,
-                 context=OpenIDAuthenticationComplete):
+                 context=OpenIDAuthenticationComplete,
+                 http_client=None,
+                 discovery_cache=None,
+                 session_storage=None,
+                 session_ttl=600):
         self.openid_store = storage
         self.name = name
         self.type = _type
         self.context = context
         self.realm_override = realm
+        self.http = http_client or HTTPClient()
+        if discovery_cache is None:
+            discovery_cache = DiscoveryCache()
+        self.discovery_cache = discovery_cache
+        self.session_storage = session_storage
+        self.session_ttl = session_ttl
+        self.auth_extensions = self._build_extensions()
 
         self.login_route = 'velruse.%s-url' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -132,31 +174,70 @@ class OpenIDConsumer(object):
             return self.realm_override
         return request.host_url
 
+    def _get_session_storage(self, request):
+        storage = self.session_storage
+        if isinstance(storage, str) and storage == 'velruse_store':
+            return request.registry.velruse_store
+        return storage
+
+    def _save_openid_session(self, request, openid_session):
+        """Keep the consumer session until the callback"""
+        storage = self._get_session_storage(request)
+        if storage is None:
+            request.session['velruse.openid_session'] = openid_session
+            return
+        key = 'velruse.openid_session.%s' % uuid.uuid4().hex
+        storage.store(key, openid_session, expires=self.session_ttl)
+        request.session['velruse.openid_session_key'] = key
+
+    def _load_openid_session(self, request):
+        """Return the consumer session saved by the login, only once"""
+        openid_session = request.session.pop('velruse.openid_session', None)
+        key = request.session.pop('velruse.openid_session_key', None)
+        storage = self._get_session_storage(request)
+        if key is not None and storage is not None:
+            try:
+                openid_session = storage.retrieve(key)
+            except KeyError:
+                return None
+            storage.delete(key)
+        return openid_session
+
     def _lookup_identifier(self, request, identifier):
         """Extension point for inherited classes that want to change or set
         a default identifier"""
         return identifier
 
-    def _update_authrequest(self, request, authrequest):
-        """Update the authrequest with the default extensions and attributes
-        we ask for
+    def _build_extensions(self):
+        """Return the extensions added to every auth request
 
-        This method doesn't need to return anything, since the extensions
-        should be added to the authrequest object itself.
+        Called once when the consumer is created. The arguments of the
+        returned extensions are precomputed.
 
         """
         # Add on the Attribute Exchange for those that support that
         ax_request = ax.FetchRequest()
         for attrib in attributes.values():
             ax_request.add(ax.AttrInfo(attrib))
-        authrequest.addExtension(ax_request)
 
         # Form the Simple Reg request
         sreg_request = sreg.SRegRequest(
             optional=['nickname', 'email', 'fullname', 'dob', 'gender',
                       'postcode', 'country', 'language', 'timezone'],
         )
-        authrequest.addExtension(sreg_request)
+        return [PrecompiledExtension(ax_request),
+                PrecompiledExtension(sreg_request)]
+
+    def _update_authrequest(self, request, authrequest):
+        """Update the authrequest with the default extensions and attributes
+        we ask for
+
+        This method doesn't need to return anything, since the extensions
+        should be added to the authrequest object itself.
+
+        """
+        for ext in self.auth_extensions:
+            authrequest.addExtension(ext)
 
     def _get_access_token(self, request_token):
         """Called to exchange a request token for the access token
@@ -182,6 +263,8 @@ class OpenIDConsumer(object):
 
         openid_session = {}
         oidconsumer = consumer.Consumer(openid_session, self.openid_store)
+        if self.discovery_cache:
+            oidconsumer._discover = self.discovery_cache.discover
 
         try:
             log.debug('About to try OpenID begin')
@@ -202,7 +285,7 @@ class OpenIDConsumer(object):
         realm = self._get_realm(request)
         # TODO: add a csrf check to the return_to URL
         return_to = request.route_url(self.callback_route)
-        request.session['velruse.openid_session'] = openid_session
+        self._save_openid_session(request, openid_session)
 
         # OpenID 2.0 lets Providers request POST instead of redirect, this
         # checks for such a request.
@@ -224,11 +307,12 @@ class OpenIDConsumer(object):
     def _update_profile_data(self, request, user_data, credentials):
         """Update the profile data using an OAuth request to fetch more data"""
 
+    @with_deadline
     def callback(self, request):
         """Handle incoming redirect from OpenID Provider"""
         log.debug('Handling processing of response from server')
 
-        openid_session = request.session.pop('velruse.openid_session', None)
+        openid_session = self._load_openid_session(request)
         if not openid_session:
             raise ThirdPartyFailure("No OpenID Session has begun.")
 
@@ -274,31 +358,56 @@ class OpenIDConsumer(object):
             raise ThirdPartyFailure("OpenID failed.")
 
 
+# sreg field for each attribute that has one
+sreg_fields = dict(
+    (key, trans_dict.get(key, key)) for key in attributes
+    if trans_dict.get(key, key) in sreg.data_fields
+)
+
+# reverse lookups used to index the responses
+ax_keys = dict((type_uri, key) for key, type_uri in attributes.items())
+sreg_keys = dict((field, key) for key, field in sreg_fields.items())
+
+
 class AttribAccess(object):
     """Uniform attribute accessor for Simple Reg and Attribute Exchange
-    values"""
+    values
+
+    Both responses are indexed in a single pass when the accessor is
+    created. Like ``ax_resp.getSingle``, :meth:`get` raises
+    :class:`openid.extensions.ax.AXError` for an AX attribute holding more
+    than one value, but only when that attribute is read.
+
+    """
     def __init__(self, sreg_resp, ax_resp):
         self.sreg_resp = sreg_resp or {}
         self.ax_resp = ax_resp or ax.AXKeyValueMessage()
 
+        self.ax_values = ax_values = {}
+        for type_uri, values in self.ax_resp.data.items():
+            key = ax_keys.get(type_uri)
+            if key is not None and values:
+                ax_values[key] = values
+
+        self.sreg_values = sreg_values = {}
+        for field, value in self.sreg_resp.items():
+            key = sreg_keys.get(field)
+            if key is not None and value:
+                sreg_values[key] = value
+
     def get(self, key, ax_only=False):
         """Get a value from either Simple Reg or AX"""
-        # First attempt to fetch it from AX
-        v = self.ax_resp.getSingle(attributes[key])
-        if v:
+        values = self.ax_values.get(key)
+        v = None
+        if values:
+            # Same rules as ax_resp.getSingle
+            if len(values) > 1:
+                raise ax.AXError(
+                    'More than one value present for %r' % attributes[key])
+            v = values[0]
+        if v or ax_only:
             return v
-        if ax_only:
-            return None
-
-        # Translate the key if needed
-        if key in trans_dict:
-            key = trans_dict[key]
-
-        # Don't attempt to fetch keys that aren't valid sreg fields
-        if key not in sreg.data_fields:
-            return None
-
-        return self.sreg_resp.get(key)
+        return self.sreg_values.get(key)
 
 
 def extract_openid_data(identifier, sreg_resp, ax_resp):
@@ -370,10 +479,11 @@ def extract_openid_data(identifier, sreg_resp, ax_resp):
         ud['gender'] = {'M': 'male', 'F': 'female'}.get(gender)
 
     birthday = attribs.get('birthday')
-    if birthday:
+    match = birthday and birthday_re.match(birthday)
+    if match:
         try:
             # confirm that the date is valid
-            date = datetime.datetime.strptime(birthday, '%Y-%m-%d').date()
+            date = datetime.date(*[int(x) for x in match.groups()])
             ud['birthday'] = date.strftime('%Y-%m-%d')
         except ValueError:
             pass
@@ -384,7 +494,7 @@ def extract_openid_data(identifier, sreg_resp, ax_resp):
         ud['thumbnailUrl'] = thumbnail
 
     # Now strip out empty values
-    for k, v in ud.items():
+    for k, v in list(ud.items()):
         if not v or (isinstance(v, list) and not v[0]):
             del ud[k]
 
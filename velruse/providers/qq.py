@@ -4,13 +4,12 @@ import json
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..compat import parse_qsl
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
@@ -35,6 +34,7 @@ def add_qq_login_from_settings(config, prefix='velruse.qq.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_qq_login(**p.kwargs)
 
 
@@ -44,11 +44,13 @@ def add_qq_login(config,
                  scope=None,
                  login_path='/login/qq',
                  callback_path='/login/qq/callback',
-                 name='qq'):
+                 name='qq',
+                 http_client=None):
     """
     Add a QQ login provider to the application.
     """
-    provider = QQProvider(name, consumer_key, consumer_secret, scope)
+    provider = QQProvider(name, consumer_key, consumer_secret, scope,
+                          http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -62,11 +64,13 @@ def add_qq_login(config,
 
 
 class QQProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None):
         self.name = name
         self.type = 'qq'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
         self.scope = scope
 
         self.login_route = 'velruse.%s-login' % name
@@ -82,6 +86,7 @@ class QQProvider(object):
                           redirect_uri=request.route_url(self.callback_route))
         return HTTPFound(location=gh_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the qq redirect"""
         code = request.GET.get('code')
@@ -99,7 +104,7 @@ class QQProvider(object):
             grant_type='authorization_code',
             redirect_uri=request.route_url(self.callback_route),
             code=code)
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -108,33 +113,42 @@ class QQProvider(object):
         # Retrieve profile data
         graph_url = flat_url('https://graph.qq.com/oauth2.0/me',
                              access_token=access_token)
-        r = requests.get(graph_url)
+        r = self.http.get(graph_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
         data = json.loads(r.text[10:-3])
-        openid = data.get('openid', '')
+        openid = data.get('openid')
+        if not openid:
+            raise ThirdPartyFailure("No openid returned: %s" % r.content)
 
+        profile = {
+            'accounts': [{'domain': 'qq.com', 'userid': openid}],
+        }
+        cred = {'oauthAccessToken': access_token}
+        profile = enrich_or_degrade(self, profile, cred)
+        return QQAuthenticationComplete(profile=profile,
+                                        credentials=cred,
+                                        provider_name=self.name,
+                                        provider_type=self.type)
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the user's details"""
+        openid = profile['accounts'][0]['userid']
         user_info_url = flat_url(
             'https://graph.qq.com/user/get_user_info',
-            access_token=access_token,
+            access_token=credentials['oauthAccessToken'],
             oauth_consumer_key=self.consumer_key,
             openid=openid)
-        r = requests.get(user_info_url)
+        r = self.http.get(user_info_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
         data = r.json()
 
-        profile = {
+        return {
             'accounts': [{'domain': 'qq.com', 'userid': openid}],
             'displayName': data['nickname'],
             'preferredUsername': data['nickname'],
             'data': data
         }
-
-        cred = {'oauthAccessToken': access_token}
-        return QQAuthenticationComplete(profile=profile,
-                                        credentials=cred,
-                                        provider_name=self.name,
-                                        provider_type=self.type)
@@ -2,13 +2,12 @@
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
@@ -32,6 +31,7 @@ def add_renren_login_from_settings(config, prefix='velruse.renren.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_renren_login(**p.kwargs)
 
 
@@ -41,11 +41,13 @@ def add_renren_login(config,
                      scope='',
                      login_path='/login/renren',
                      callback_path='/login/renren/callback',
-                     name='renren'):
+                     name='renren',
+                     http_client=None):
     """
     Add a Renren login provider to the application.
     """
-    provider = RenrenProvider(name, consumer_key, consumer_secret, scope)
+    provider = RenrenProvider(name, consumer_key, consumer_secret, scope,
+                              http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -59,11 +61,13 @@ def add_renren_login(config,
 
 
 class RenrenProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None):
         self.name = name
         self.type = 'renren'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
         self.scope = scope
 
         self.login_route = 'velruse.%s-login' % name
@@ -79,6 +83,7 @@ class RenrenProvider(object):
                        redirect_uri=request.route_url(self.callback_route))
         return HTTPFound(url)
 
+    @with_deadline
     def callback(self, request):
         """Process the renren redirect"""
         code = request.GET.get('code')
@@ -96,7 +101,7 @@ class RenrenProvider(object):
             redirect_uri=request.route_url(self.callback_route),
             code=code)
 
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
@@ -5,13 +5,12 @@ import time
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
 from ..utils import flat_url
@@ -34,6 +33,7 @@ def add_taobao_login_from_settings(config, prefix='velruse.taobao.'):
     p.update('consumer_secret', required=True)
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
     config.add_taobao_login(**p.kwargs)
 
 
@@ -42,11 +42,13 @@ def add_taobao_login(config,
                      consumer_secret,
                      login_path='/login/taobao',
                      callback_path='/login/taobao/callback',
-                     name='taobao'):
+                     name='taobao',
+                     http_client=None):
     """
     Add a Taobao login provider to the application.
     """
-    provider = TaobaoProvider(name, consumer_key, consumer_secret)
+    provider = TaobaoProvider(name, consumer_key, consumer_secret,
+                              http_client=http_client)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -60,11 +62,12 @@ def add_taobao_login(config,
 
 
 class TaobaoProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None):
         self.name = name
         self.type = 'taobao'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -77,6 +80,7 @@ class TaobaoProvider(object):
                           redirect_uri=request.route_url(self.callback_route))
         return HTTPFound(location=gh_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the taobao redirect"""
         code = request.GET.get('code')
@@ -87,7 +91,7 @@ class TaobaoProvider(object):
                                         provider_type=self.type)
 
         # Now retrieve the access token with the code
-        r = requests.post(
+        r = self.http.post(
             'https://oauth.taobao.com/token',
             dict(grant_type='authorization_code',
                  client_id=self.consumer_key,
@@ -119,7 +123,7 @@ class TaobaoProvider(object):
         params['sign'] = md5(src).hexdigest().upper()
         get_user_info_url = flat_url('http://gw.api.taobao.com/router/rest',
                                      **params)
-        r = requests.get(get_user_info_url)
+        r = self.http.get(get_user_info_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
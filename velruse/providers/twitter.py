@@ -2,15 +2,12 @@
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
-from requests_oauthlib import OAuth1
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..compat import parse_qsl
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
@@ -37,8 +34,12 @@ def add_twitter_login_from_settings(config, prefix='velruse.twitter.'):
     p = ProviderSettings(settings, prefix)
     p.update('consumer_key', required=True)
     p.update('consumer_secret', required=True)
+    p.update('lazy_profile')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_request_token_pool()
+    p.update_enrichment_cache(config.registry)
     config.add_twitter_login(**p.kwargs)
 
 
@@ -47,11 +48,32 @@ def add_twitter_login(config,
                       consumer_secret,
                       login_path='/login/twitter',
                       callback_path='/login/twitter/callback',
-                      name='twitter'):
+                      name='twitter',
+                      http_client=None,
+                      lazy_profile=False,
+                      enrichment_cache=None,
+                      request_token_pool=None):
     """
     Add a Twitter login provider to the application.
+
+    With ``lazy_profile`` the login completes with the identity returned
+    with the access token, in a profile flagged as ``partial``. The
+    details from ``users/show`` are only fetched when the profile is
+    enriched, see :meth:`TwitterProvider.enrich_profile`.
+
+    ``enrichment_cache`` is a :class:`velruse.cache.EnrichmentCache`
+    keeping the details of returning users.
+
+    ``request_token_pool`` is a
+    :class:`velruse.request_tokens.RequestTokenPool` prefetching the request
+    tokens, so that the login redirect is served without a request to
+    Twitter.
     """
-    provider = TwitterProvider(name, consumer_key, consumer_secret)
+    provider = TwitterProvider(name, consumer_key, consumer_secret,
+                               http_client=http_client,
+                               lazy_profile=lazy_profile,
+                               enrichment_cache=enrichment_cache,
+                               request_token_pool=request_token_pool)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login',
@@ -66,11 +88,17 @@ def add_twitter_login(config,
 
 
 class TwitterProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None,
+                 lazy_profile=False, enrichment_cache=None,
+                 request_token_pool=None):
         self.name = name
         self.type = 'twitter'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.lazy_profile = lazy_profile
+        self.enrichment_cache = enrichment_cache
+        self.request_token_pool = request_token_pool
 
         self.login_route = 'velruse.%s-login' % name
         self.callback_route = 'velruse.%s-callback' % name
@@ -78,15 +106,12 @@ class TwitterProvider(object):
     def login(self, request):
         """Initiate a Twitter login"""
         # grab the initial request token
-        oauth = OAuth1(
-            self.consumer_key,
-            client_secret=self.consumer_secret,
-            callback_uri=request.route_url(self.callback_route))
-        resp = requests.post(REQUEST_URL, auth=oauth)
-        if resp.status_code != 200:
-            raise ThirdPartyFailure("Status %s: %s" % (
-                resp.status_code, resp.content))
-        request_token = dict(parse_qsl(resp.text))
+        callback_uri = request.route_url(self.callback_route)
+        if self.request_token_pool is None:
+            request_token = self._fetch_request_token(callback_uri)
+        else:
+            request_token = self.request_token_pool.take(
+                callback_uri, self._fetch_request_token)
 
         # store the token for later
         request.session['velruse.token'] = request_token
@@ -95,6 +120,18 @@ class TwitterProvider(object):
         auth_url = flat_url(AUTH_URL, oauth_token=request_token['oauth_token'])
         return HTTPFound(location=auth_url)
 
+    def _fetch_request_token(self, callback_uri):
+        oauth = self.http.oauth1(
+            self.consumer_key,
+            client_secret=self.consumer_secret,
+            callback_uri=callback_uri)
+        resp = self.http.post(REQUEST_URL, auth=oauth)
+        if resp.status_code != 200:
+            raise ThirdPartyFailure("Status %s: %s" % (
+                resp.status_code, resp.content))
+        return dict(parse_qsl(resp.text))
+
+    @with_deadline
     def callback(self, request):
         """Process the Twitter redirect"""
         if 'denied' in request.GET:
@@ -108,13 +145,13 @@ class TwitterProvider(object):
         request_token = request.session.pop('velruse.token')
 
         # turn our request token into an access token
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.consumer_key,
             client_secret=self.consumer_secret,
             resource_owner_key=request_token['oauth_token'],
             resource_owner_secret=request_token['oauth_token_secret'],
             verifier=verifier)
-        resp = requests.post(ACCESS_URL, auth=oauth)
+        resp = self.http.post(ACCESS_URL, auth=oauth)
         if resp.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 resp.status_code, resp.content))
@@ -136,31 +173,52 @@ class TwitterProvider(object):
         profile['displayName'] = username
         profile['preferredUsername'] = username
 
-        oauth = OAuth1(
-            self.consumer_key,
-            client_secret=self.consumer_secret,
-            resource_owner_key=access_token['oauth_token'],
-            resource_owner_secret=access_token['oauth_token_secret'])
-        resp = requests.get(DATA_URL % username, auth=oauth)
-        if resp.status_code == 200:
-            data = resp.json()
-            if 'name' in data:
-                # replace display name with the full name
-                profile['displayName'] = data['name']
-                profile['name'] = {'formatted': profile['displayName']}
-            if 'url' in data:
-                profile['urls'] = [{'value': data['url']}]
-            if 'location' in data:
-                profile['addresses'] = [{'formatted': data['location']}]
-            if 'profile_image_url' in data:
-                profile['photos'] = [{'value': data['profile_image_url']}]
-            if data.get('utc_offset'):
-                offset = float(data['utc_offset']) / 3600
-                h = int(offset)
-                m = int(abs(offset - h) * 60)
-                profile['utcOffset'] = '{h:+03d}:{m:02d}'.format(h=h, m=m)
+        if self.lazy_profile:
+            profile['partial'] = True
+        else:
+            profile = enrich_or_degrade(self, profile, creds)
 
         return TwitterAuthenticationComplete(profile=profile,
                                              credentials=creds,
                                              provider_name=self.name,
                                              provider_type=self.type)
+
+    def enrich_profile(self, profile, credentials):
+        """Return ``profile`` completed with the user's details"""
+        profile = dict(profile)
+        profile.pop('partial', None)
+        account = profile['accounts'][0]
+
+        def fetch():
+            oauth = self.http.oauth1(
+                self.consumer_key,
+                client_secret=self.consumer_secret,
+                resource_owner_key=credentials['oauthAccessToken'],
+                resource_owner_secret=credentials['oauthAccessTokenSecret'])
+            resp = self.http.get(DATA_URL % account['username'], auth=oauth)
+            if resp.status_code != 200:
+                raise ThirdPartyFailure("Status %s: %s" % (
+                    resp.status_code, resp.content))
+            return resp.json()
+
+        if self.enrichment_cache is None:
+            data = fetch()
+        else:
+            data = self.enrichment_cache.get(
+                self.name, account['userid'], fetch)
+        if 'name' in data:
+            # replace display name with the full name
+            profile['displayName'] = data['name']
+            profile['name'] = {'formatted': profile['displayName']}
+        if 'url' in data:
+            profile['urls'] = [{'value': data['url']}]
+        if 'location' in data:
+            profile['addresses'] = [{'formatted': data['location']}]
+        if 'profile_image_url' in data:
+            profile['photos'] = [{'value': data['profile_image_url']}]
+        if data.get('utc_offset'):
+            offset = float(data['utc_offset']) / 3600
+            h = int(offset)
+            m = int(abs(offset - h) * 60)
+            profile['utcOffset'] = '{h:+03d}:{m:02d}'.format(h=h, m=m)
+        return profile
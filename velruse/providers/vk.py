@@ -4,21 +4,21 @@ VK is considered to be the #1 social network
 (with more than a 100 million active users) in Russia.
 You may see the developer docs at http://vk.com/developers.php#devstep2
 """
-import uuid
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
-from ..exceptions import CSRFError, ThirdPartyFailure
+from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
+from ..utils import field_list
 from ..utils import flat_url
+from ..client import HTTPClient, with_deadline
 from ..compat import u
 
 
@@ -27,6 +27,12 @@ PROVIDER_AUTH_URL = 'https://oauth.vk.com/authorize'
 PROVIDER_ACCESS_TOKEN_URL = 'https://api.vk.com/oauth/access_token'
 PROVIDER_USER_PROFILE_URL = 'https://api.vk.com/method/getProfiles'
 
+# the fields used by extract_normalize_vk_data, ``contacts`` returns the
+# phone numbers
+PROFILE_FIELDS = ['first_name', 'last_name', 'nickname', 'sex', 'photo',
+                  'photo_medium', 'photo_big', 'photo_rec', 'contacts']
+REQUIRED_FIELDS = ['first_name', 'last_name']
+
 FIELD_SEX = {
     1: 'female',
     2: 'male'
@@ -49,8 +55,11 @@ def add_vk_login_from_settings(config, prefix='velruse.vk.'):
     p.update('consumer_key', required=True)
     p.update('consumer_secret', required=True)
     p.update('scope')
+    p.update('fields')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
     config.add_vk_login(**p.kwargs)
 
 
@@ -61,10 +70,20 @@ def add_vk_login(
     scope=None,
     login_path='/login/{name}'.format(name=PROVIDER_NAME),
     callback_path='/login/{name}/callback'.format(name=PROVIDER_NAME),
-    name=PROVIDER_NAME
+    name=PROVIDER_NAME,
+    http_client=None,
+    state_manager=None,
+    fields=None
 ):
-    """Add a VK login provider to the application."""
-    provider = VKProvider(name, consumer_key, consumer_secret, scope)
+    """Add a VK login provider to the application.
+
+    ``fields`` are the profile fields to request, defaulting to the ones
+    used to build the profile.
+    """
+    provider = VKProvider(name, consumer_key, consumer_secret, scope,
+                          http_client=http_client,
+                          state_manager=state_manager,
+                          fields=fields)
     config.add_route(provider.login_route, login_path)
     config.add_view(
         provider,
@@ -82,19 +101,25 @@ def add_vk_login(
 
 class VKProvider(object):
 
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None,
+                 state_manager=None,
+                 fields=None):
         self.name = name
         self.type = PROVIDER_NAME
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
         self.scope = scope
+        self.fields = field_list(fields or PROFILE_FIELDS, REQUIRED_FIELDS)
 
         self.login_route = 'velruse.{name}-login'.format(name=name)
         self.callback_route = 'velruse.{name}-callback'.format(name=name)
 
     def login(self, request):
         """Initiate a VK login"""
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         fb_url = flat_url(
             PROVIDER_AUTH_URL,
             scope=self.scope,
@@ -104,18 +129,10 @@ class VKProvider(object):
             state=state)
         return HTTPFound(location=fb_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the VK redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error_description',
@@ -133,7 +150,7 @@ class VKProvider(object):
             redirect_uri=request.route_url(self.callback_route),
             code=code
         )
-        r = requests.get(access_url)
+        r = self.http.get(access_url, idempotent=False)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
@@ -148,13 +165,9 @@ class VKProvider(object):
             PROVIDER_USER_PROFILE_URL,
             access_token=access_token,
             uids=data['user_id'],
-            fields=(
-                'first_name,last_name,nickname,domain,sex,bdate,city,country,'
-                'timezone,photo,photo_medium,photo_big,photo_rec,has_mobile,'
-                'mobile_phone,home_phone,rate,contacts,education'
-            )
+            fields=self.fields
         )
-        r = requests.get(graph_url)
+        r = self.http.get(graph_url)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
@@ -243,7 +256,7 @@ def extract_normalize_vk_data(data):
             })
 
     # Now strip out empty values
-    for k, v in profile.items():
+    for k, v in list(profile.items()):
         if not v or (isinstance(v, list) and not v[0]):
             del profile[k]
 
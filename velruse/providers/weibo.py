@@ -1,7 +1,4 @@
 """Sina Microblogging weibo.com Authentication Views"""
-import uuid
-
-import requests
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
@@ -12,9 +9,10 @@ from ..api import (
     AuthenticationDenied,
     register_provider,
 )
-from ..exceptions import CSRFError
+from ..client import HTTPClient, enrich_or_degrade, with_deadline
 from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
 from ..utils import flat_url
 
 
@@ -36,6 +34,8 @@ def add_weibo_login_from_settings(config, prefix='velruse.weibo.'):
     p.update('scope')
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
     config.add_weibo_login(**p.kwargs)
 
 
@@ -45,11 +45,15 @@ def add_weibo_login(config,
                     scope=None,
                     login_path='/login/weibo',
                     callback_path='/login/weibo/callback',
-                    name='weibo'):
+                    name='weibo',
+                    http_client=None,
+                    state_manager=None):
     """
     Add a Weibo login provider to the application.
     """
-    provider = WeiboProvider(name, consumer_key, consumer_secret, scope)
+    provider = WeiboProvider(name, consumer_key, consumer_secret, scope,
+                             http_client=http_client,
+                             state_manager=state_manager)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -63,11 +67,15 @@ def add_weibo_login(config,
 
 
 class WeiboProvider(object):
-    def __init__(self, name, consumer_key, consumer_secret, scope):
+    def __init__(self, name, consumer_key, consumer_secret, scope,
+                 http_client=None,
+                 state_manager=None):
         self.name = name
         self.type = 'weibo'
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
         self.scope = scope
 
         self.login_route = 'velruse.%s-login' % name
@@ -76,7 +84,7 @@ class WeiboProvider(object):
     def login(self, request):
         """Initiate a weibo login"""
         scope = request.POST.get('scope', self.scope)
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         url = flat_url('https://api.weibo.com/oauth2/authorize',
                        scope=scope,
                        client_id=self.consumer_key,
@@ -85,18 +93,10 @@ class WeiboProvider(object):
                        state=state)
         return HTTPFound(url)
 
+    @with_deadline
     def callback(self, request):
         """Process the weibo redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error_reason', 'No reason provided.')
@@ -105,7 +105,7 @@ class WeiboProvider(object):
                                         provider_type=self.type)
 
         # Now retrieve the access token with the code
-        r = requests.post(
+        r = self.http.post(
             'https://api.weibo.com/oauth2/access_token',
             dict(
                 client_id=self.consumer_key,
@@ -122,17 +122,29 @@ class WeiboProvider(object):
         access_token = token_data['access_token']
         user_id = token_data['uid']
 
+        profile = {
+            'accounts': [{'domain': 'weibo.com', 'userid': user_id}],
+        }
+        cred = {'oauthAccessToken': access_token}
+        profile = enrich_or_degrade(self, profile, cred)
+        return WeiboAuthenticationComplete(profile=profile,
+                                           credentials=cred,
+                                           provider_name=self.name,
+                                           provider_type=self.type)
+
+    def enrich_profile(self, profile, credentials):
+        """Return the profile of the user of ``profile``"""
         # Retrieve profile data
         graph_url = flat_url('https://api.weibo.com/2/users/show.json',
-                             access_token=access_token,
-                             uid=user_id)
-        r = requests.get(graph_url)
+                             access_token=credentials['oauthAccessToken'],
+                             uid=profile['accounts'][0]['userid'])
+        r = self.http.get(graph_url)
         if r.status_code != 200:
             raise ThirdPartyFailure("Status %s: %s" % (
                 r.status_code, r.content))
         data = r.json()
 
-        profile = {
+        return {
             'accounts': [{'domain': 'weibo.com', 'userid': data['id']}],
             'gender': data.get('gender'),
             'displayName': data['screen_name'],
@@ -140,9 +152,3 @@ class WeiboProvider(object):
             'avatar': data['avatar_large'],
             'data': data
         }
-
-        cred = {'oauthAccessToken': access_token}
-        return WeiboAuthenticationComplete(profile=profile,
-                                           credentials=cred,
-                                           provider_name=self.name,
-                                           provider_type=self.type)
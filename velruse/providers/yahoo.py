@@ -2,15 +2,14 @@ from __future__ import absolute_import
 
 from openid.extensions import ax
 
-import requests
-from requests_oauthlib import OAuth1
-
 from pyramid.security import NO_PERMISSION_REQUIRED
 
 from ..api import register_provider
 from ..compat import parse_qsl
 
 from .oid_extensions import OAuthRequest
+from .oid_extensions import PrecompiledExtension
+from .oid_store import openid_store
 from .openid import (
     OpenIDAuthenticationComplete,
     OpenIDConsumer,
@@ -38,16 +37,26 @@ def add_yahoo_login(config,
                     consumer_secret=None,
                     login_path='/login/yahoo',
                     callback_path='/login/yahoo/callback',
-                    name='yahoo'):
+                    name='yahoo',
+                    http_client=None,
+                    discovery_cache=None,
+                    session_storage=None,
+                    session_ttl=600):
     """
     Add a Yahoo login provider to the application.
 
-    OpenID parameters: realm, storage
+    OpenID parameters: realm, storage, discovery_cache, session_storage,
+    session_ttl
 
     OAuth parameters: consumer_key, consumer_secret
     """
+    storage = openid_store(storage, config.registry)
     provider = YahooConsumer(name, realm, storage,
-                             consumer_key, consumer_secret)
+                             consumer_key, consumer_secret,
+                             http_client=http_client,
+                             discovery_cache=discovery_cache,
+                             session_storage=session_storage,
+                             session_ttl=session_ttl)
 
     config.add_route(provider.login_route, login_path)
     config.add_view(provider, attr='login', route_name=provider.login_route,
@@ -62,7 +71,9 @@ def add_yahoo_login(config,
 
 class YahooConsumer(OpenIDConsumer):
     def __init__(self, name, realm=None, storage=None,
-                 oauth_key=None, oauth_secret=None):
+                 oauth_key=None, oauth_secret=None, http_client=None,
+                 discovery_cache=None, session_storage=None,
+                 session_ttl=600):
         """Handle Yahoo Auth
 
         This also handles making an OAuth request during the OpenID
@@ -70,7 +81,11 @@ class YahooConsumer(OpenIDConsumer):
 
         """
         OpenIDConsumer.__init__(self, name, 'yahoo', realm, storage,
-                                context=YahooAuthenticationComplete)
+                                context=YahooAuthenticationComplete,
+                                http_client=http_client,
+                                discovery_cache=discovery_cache,
+                                session_storage=session_storage,
+                                session_ttl=session_ttl)
         self.oauth_key = oauth_key
         self.oauth_secret = oauth_secret
 
@@ -78,7 +93,7 @@ class YahooConsumer(OpenIDConsumer):
         """Return the Yahoo OpenID directed endpoint"""
         return 'https://me.yahoo.com/'
 
-    def _update_authrequest(self, request, authrequest):
+    def _build_extensions(self):
         # Add on the Attribute Exchange for those that support that
         ax_request = ax.FetchRequest()
         for attrib in ['http://axschema.org/namePerson/friendly',
@@ -88,7 +103,11 @@ class YahooConsumer(OpenIDConsumer):
                        'http://axschema.org/media/image/default',
                        'http://axschema.org/contact/email']:
             ax_request.add(ax.AttrInfo(attrib))
-        authrequest.addExtension(ax_request)
+        return [PrecompiledExtension(ax_request)]
+
+    def _update_authrequest(self, request, authrequest):
+        for ext in self.auth_extensions:
+            authrequest.addExtension(ext)
 
         # Add OAuth request?
         if 'oauth' in request.POST:
@@ -96,12 +115,12 @@ class YahooConsumer(OpenIDConsumer):
             authrequest.addExtension(oauth_request)
 
     def _get_access_token(self, request_token):
-        oauth = OAuth1(
+        oauth = self.http.oauth1(
             self.oauth_key,
             client_secret=self.oauth_secret,
             resource_owner_key=request_token)
 
-        resp = requests.post(YAHOO_OAUTH, auth=oauth)
+        resp = self.http.post(YAHOO_OAUTH, auth=oauth)
         if resp.status_code != 200:
             log.error(
                 'OAuth token validation failed. Status: %d, Content: %s',
@@ -2,20 +2,19 @@
 
 You may see developer docs at http://api.yandex.com/oauth/
 """
-import uuid
 
 from pyramid.httpexceptions import HTTPFound
 from pyramid.security import NO_PERMISSION_REQUIRED
 
-import requests
-
 from ..api import (
     AuthenticationComplete,
     AuthenticationDenied,
     register_provider,
 )
-from ..exceptions import CSRFError, ThirdPartyFailure
+from ..client import HTTPClient, with_deadline
+from ..exceptions import ThirdPartyFailure
 from ..settings import ProviderSettings
+from ..state import SessionState
 from ..utils import flat_url
 
 
@@ -42,6 +41,8 @@ def add_yandex_login_from_settings(config, prefix='velruse.yandex.'):
     p.update('consumer_secret', required=True)
     p.update('login_path')
     p.update('callback_path')
+    p.update_client()
+    p.update_state_manager()
     config.add_yandex_login(**p.kwargs)
 
 
@@ -51,10 +52,14 @@ def add_yandex_login(
     consumer_secret,
     login_path='/login/{name}'.format(name=PROVIDER_NAME),
     callback_path='/login/{name}/callback'.format(name=PROVIDER_NAME),
-    name=PROVIDER_NAME
+    name=PROVIDER_NAME,
+    http_client=None,
+    state_manager=None
 ):
     """Add a Yandex login provider to the application."""
-    provider = YandexProvider(name, consumer_key, consumer_secret)
+    provider = YandexProvider(name, consumer_key, consumer_secret,
+                              http_client=http_client,
+                              state_manager=state_manager)
     config.add_route(provider.login_route, login_path)
     config.add_view(
         provider,
@@ -72,11 +77,14 @@ def add_yandex_login(
 
 class YandexProvider(object):
 
-    def __init__(self, name, consumer_key, consumer_secret):
+    def __init__(self, name, consumer_key, consumer_secret, http_client=None,
+                 state_manager=None):
         self.name = name
         self.type = PROVIDER_NAME
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.http = http_client or HTTPClient()
+        self.state_manager = state_manager or SessionState()
         self.login_route = 'velruse.{name}-login'.format(name=name)
         # Yandex doesn't support redirect_uri and scope parameters in
         # the query string.
@@ -88,7 +96,7 @@ class YandexProvider(object):
 
     def login(self, request):
         """Initiate a Yandex login"""
-        request.session['velruse.state'] = state = uuid.uuid4().hex
+        state = self.state_manager.issue(request, self.name)
         auth_url = flat_url(
             PROVIDER_AUTH_URL,
             client_id=self.consumer_key,
@@ -97,18 +105,10 @@ class YandexProvider(object):
         )
         return HTTPFound(location=auth_url)
 
+    @with_deadline
     def callback(self, request):
         """Process the Yandex redirect"""
-        sess_state = request.session.pop('velruse.state', None)
-        req_state = request.GET.get('state')
-        if not sess_state or sess_state != req_state:
-            raise CSRFError(
-                'CSRF Validation check failed. Request state {req_state} is '
-                'not the same as session state {sess_state}'.format(
-                    req_state=req_state,
-                    sess_state=sess_state
-                )
-            )
+        self.state_manager.verify(request, self.name)
         code = request.GET.get('code')
         if not code:
             reason = request.GET.get('error', 'No reason provided.')
@@ -124,7 +124,7 @@ class YandexProvider(object):
             'client_id': self.consumer_key,
             'client_secret': self.consumer_secret,
         }
-        r = requests.post(PROVIDER_ACCESS_TOKEN_URL, token_params)
+        r = self.http.post(PROVIDER_ACCESS_TOKEN_URL, token_params)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
@@ -140,7 +140,7 @@ class YandexProvider(object):
             format='json',
             oauth_token=access_token
         )
-        r = requests.get(profile_url)
+        r = self.http.get(profile_url)
         if r.status_code != 200:
             raise ThirdPartyFailure(
                 'Status {status}: {content}'.format(
@@ -0,0 +1,184 @@
+"""Prefetching OAuth 1.0 request tokens"""
+from collections import deque
+import os
+import threading
+import time
+
+from pyramid.exceptions import ConfigurationError
+
+from .compat import urlsplit
+
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_TOKEN_TTL = 300
+
+
+def _origin(url):
+    """Return the lowercased ``scheme://host[:port]`` of ``url``"""
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme.lower(), parts.netloc.lower())
+
+
+class RequestTokenPool(object):
+    """Keep request tokens fetched ahead of time, so that an OAuth 1.0
+    login can redirect the user without waiting on the provider.
+
+    A request token is bound to the callback URI it was requested with,
+    so tokens are pooled per callback URI. :meth:`take` hands out each
+    token once, or fetches one synchronously when the pool is empty, and
+    wakes a background thread refilling the pool up to ``size`` tokens.
+    The thread also runs every ``ttl / 2`` seconds to replace the tokens
+    about to expire.
+
+    Tokens are discarded ``ttl`` seconds after they were requested, which
+    should be shorter than the lifetime the provider gives them.
+
+    The callback URI is built from the ``Host`` header of the login
+    request, so only the callback URIs on one of ``hosts``, given as
+    ``scheme://host[:port]`` URLs, are pooled. Logins on other hosts fetch
+    their token synchronously and are never refilled.
+
+    Each process keeps its own pool. Hits, misses and the fetched, expired
+    and failed tokens are counted and returned by :meth:`stats`.
+
+    """
+    def __init__(self, hosts, size=DEFAULT_POOL_SIZE, ttl=DEFAULT_TOKEN_TTL,
+                 background=True):
+        self.hosts = frozenset(_origin(host) for host in hosts)
+        self.size = size
+        self.ttl = ttl
+        self.background = background
+        self.counters = dict(hits=0, misses=0, fetched=0, expired=0,
+                             failed=0)
+        self._tokens = {}
+        self._fetchers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._refiller_pid = None
+
+    def take(self, callback_uri, fetch):
+        """Return a request token for ``callback_uri``.
+
+        ``fetch`` is called with the callback URI to request a new token,
+        now if the pool is empty and later on to refill it.
+        """
+        if _origin(callback_uri) not in self.hosts:
+            with self._lock:
+                self.counters['misses'] += 1
+            return fetch(callback_uri)
+        with self._lock:
+            self._fetchers[callback_uri] = fetch
+            token = self._pop(callback_uri)
+            self.counters['hits' if token is not None else 'misses'] += 1
+        if token is None:
+            token = fetch(callback_uri)
+        self._schedule_refill()
+        return token
+
+    def _pop(self, callback_uri):
+        tokens = self._tokens.get(callback_uri)
+        if not tokens:
+            return None
+        self._evict(tokens)
+        if not tokens:
+            return None
+        return tokens.popleft()[1]
+
+    def _evict(self, tokens):
+        # tokens are queued in the order they expire
+        now = time.time()
+        while tokens and tokens[0][0] <= now:
+            tokens.popleft()
+            self.counters['expired'] += 1
+
+    def refill(self):
+        """Discard the expired tokens and fetch new ones until the pool of
+        each callback URI is full"""
+        with self._lock:
+            fetchers = list(self._fetchers.items())
+        for callback_uri, fetch in fetchers:
+            # bounded in case the tokens expire as soon as they are fetched
+            for i in range(self.size):
+                with self._lock:
+                    tokens = self._tokens.setdefault(callback_uri, deque())
+                    self._evict(tokens)
+                    if len(tokens) >= self.size:
+                        break
+                expires_at = time.time() + self.ttl
+                try:
+                    token = fetch(callback_uri)
+                except Exception:
+                    log.warning('failed to prefetch a request token for %s',
+                                callback_uri, exc_info=True)
+                    with self._lock:
+                        self.counters['failed'] += 1
+                    break
+                with self._lock:
+                    tokens.append((expires_at, token))
+                    self.counters['fetched'] += 1
+
+    def available(self):
+        """Return the number of pooled tokens, including expired ones not
+        discarded yet"""
+        with self._lock:
+            return sum(len(tokens) for tokens in self._tokens.values())
+
+    def stats(self):
+        """Return the counters along with the number of pooled tokens"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['available'] = self.available()
+        return stats
+
+    def _schedule_refill(self):
+        if not self.background:
+            return
+        self._start_refiller()
+        self._wakeup.set()
+
+    def _start_refiller(self):
+        if self._refiller_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refiller_pid == os.getpid():
+                return
+            # also restarted in a process forked after it was started
+            self._refiller_pid = os.getpid()
+        thread = threading.Thread(target=self._refill_forever,
+                                  name='velruse-request-token-refiller')
+        thread.daemon = True
+        thread.start()
+
+    def _refill_forever(self):
+        while True:
+            self._wakeup.wait(self.ttl / 2.0)
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except Exception:
+                log.exception('failed to refill the request token pool')
+
+
+def request_token_pool_from_settings(settings, prefix=''):
+    """Create a :class:`RequestTokenPool` from the settings, or return
+    `None` if ``<prefix>request_token_pool.size`` is not set.
+
+    ``<prefix>request_token_pool.hosts`` lists the URLs of the hosts the
+    application is served on, separated by whitespace, and is required.
+    ``<prefix>request_token_pool.ttl`` sets how many seconds a pooled
+    token is handed out after it was requested.
+    """
+    prefix += 'request_token_pool.'
+    size = int(settings.get(prefix + 'size') or 0)
+    if size <= 0:
+        return None
+    hosts = (settings.get(prefix + 'hosts') or '').split()
+    if not hosts:
+        raise ConfigurationError(
+            'missing required setting "%shosts"' % prefix)
+    return RequestTokenPool(
+        hosts,
+        size=size,
+        ttl=float(settings.get(prefix + 'ttl', DEFAULT_TOKEN_TTL)))
@@ -1,3 +1,10 @@
+from .cache import callback_cache_from_settings
+from .cache import enrichment_cache_from_settings
+from .client import client_from_settings
+from .state import state_manager_from_settings
+from .request_tokens import request_token_pool_from_settings
+
+
 def splitlines(s):
     return filter(None, [x.strip() for x in s.splitlines()])
 
@@ -25,3 +32,53 @@ class ProviderSettings(object):
             self.kwargs[dst] = value
         elif required:
             raise KeyError('missing required setting "%s"' % key)
+
+    def update_client(self, dst='http_client'):
+        """Create the provider's pooled HTTP client from the settings.
+
+        See :func:`velruse.client.client_from_settings` for the supported
+        keys.
+        """
+        self.kwargs[dst] = client_from_settings(self.settings, self.prefix)
+
+    def update_state_manager(self, dst='state_manager'):
+        """Sign the OAuth ``state`` instead of keeping it in the session if
+        a ``state_secret`` is set.
+
+        See :func:`velruse.state.state_manager_from_settings`.
+        """
+        manager = state_manager_from_settings(self.settings, self.prefix)
+        if manager is not None:
+            self.kwargs[dst] = manager
+
+    def update_enrichment_cache(self, registry=None,
+                                dst='enrichment_cache'):
+        """Cache the data fetched to enrich the profiles if an
+        ``enrichment_cache.ttl`` is set.
+
+        See :func:`velruse.cache.enrichment_cache_from_settings`.
+        """
+        cache = enrichment_cache_from_settings(
+            self.settings, self.prefix, registry)
+        if cache is not None:
+            self.kwargs[dst] = cache
+
+    def update_request_token_pool(self, dst='request_token_pool'):
+        """Prefetch the OAuth 1.0 request tokens if a
+        ``request_token_pool.size`` is set.
+
+        See :func:`velruse.request_tokens.request_token_pool_from_settings`.
+        """
+        pool = request_token_pool_from_settings(self.settings, self.prefix)
+        if pool is not None:
+            self.kwargs[dst] = pool
+
+    def update_callback_cache(self, dst='callback_cache'):
+        """Answer duplicate callbacks with the result of the first one if a
+        ``callback_cache.ttl`` is set.
+
+        See :func:`velruse.cache.callback_cache_from_settings`.
+        """
+        cache = callback_cache_from_settings(self.settings, self.prefix)
+        if cache is not None:
+            self.kwargs[dst] = cache
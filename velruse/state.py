@@ -0,0 +1,168 @@
+"""CSRF protection through the OAuth ``state`` parameter"""
+import base64
+import hashlib
+import hmac
+import time
+import uuid
+
+from .compat import compare_digest
+from .exceptions import CSRFError
+
+
+DEFAULT_MAX_AGE = 600
+
+
+class SessionState(object):
+    """Keep a random ``state`` in the session between the login and the
+    callback.
+
+    This is the default for the providers supporting the ``state``
+    parameter.
+
+    """
+    key = 'velruse.state'
+    verified_key = 'velruse.state.verified'
+    browser_key_name = 'velruse.browser'
+
+    def issue(self, request, provider_name):
+        """Return a new ``state`` for a login"""
+        request.session.setdefault(self.browser_key_name, uuid.uuid4().hex)
+        request.session[self.key] = state = uuid.uuid4().hex
+        return state
+
+    def verify(self, request, provider_name):
+        """Check the ``state`` received by the callback or raise
+        :class:`~velruse.exceptions.CSRFError`"""
+        sess_state = request.session.pop(self.key, None)
+        req_state = request.GET.get('state')
+        if not sess_state or sess_state != req_state:
+            raise CSRFError(
+                'CSRF Validation check failed. Request state {req_state} is '
+                'not the same as session state {sess_state}'.format(
+                    req_state=req_state,
+                    sess_state=sess_state
+                )
+            )
+        request.session[self.verified_key] = sess_state
+
+    def verify_duplicate(self, request, provider_name):
+        """Check the ``state`` received by a duplicate callback, which the
+        first callback may already have verified, or raise
+        :class:`~velruse.exceptions.CSRFError`"""
+        req_state = request.GET.get('state')
+        sess_states = (request.session.get(self.key),
+                       request.session.get(self.verified_key))
+        if not req_state or req_state not in sess_states:
+            raise CSRFError(
+                'CSRF Validation check failed. Request state {req_state} '
+                'was not issued to this session'.format(req_state=req_state))
+
+    def browser_key(self, request):
+        """Return a random value identifying the session of the browser
+        which started the login, or `None`"""
+        return request.session.get(self.browser_key_name)
+
+
+class SignedState(object):
+    """Issue a ``state`` signed with ``secret`` and verify it without any
+    session.
+
+    The ``state`` carries the time it was issued and a random nonce,
+    signed using HMAC-SHA256 together with the provider name and a random
+    value kept in a ``cookie_name`` cookie of the browser starting the
+    login. It is only accepted by the provider that issued it, for
+    ``max_age`` seconds, and from the same browser, so a ``state``
+    obtained by someone else can't be used to log a victim in. Because
+    nothing is stored server side, any process sharing the secret can
+    verify it.
+
+    Unlike :class:`SessionState` the ``state`` may be accepted more than
+    once within ``max_age``.
+
+    """
+    cookie_name = 'velruse.state'
+
+    def __init__(self, secret, max_age=DEFAULT_MAX_AGE):
+        if not secret:
+            raise ValueError('a secret is required to sign the state')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.max_age = max_age
+
+    def _sign(self, provider_name, timestamp, nonce, browser_nonce):
+        msg = '%s|%s|%s|%s' % (provider_name, timestamp, nonce,
+                               browser_nonce)
+        digest = hmac.new(self.secret, msg.encode('utf-8'),
+                          hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    def issue(self, request, provider_name):
+        """Return a new ``state`` for a login and set the cookie binding
+        it to the browser"""
+        # reused, so that concurrent logins in several tabs all succeed
+        browser_nonce = request.cookies.get(self.cookie_name)
+        if not browser_nonce:
+            browser_nonce = uuid.uuid4().hex
+
+        def set_cookie(request, response):
+            response.set_cookie(self.cookie_name, browser_nonce,
+                                max_age=self.max_age, path='/',
+                                secure=request.url.startswith('https:'),
+                                httponly=True)
+        request.add_response_callback(set_cookie)
+
+        timestamp = str(int(time.time()))
+        nonce = uuid.uuid4().hex
+        signature = self._sign(provider_name, timestamp, nonce,
+                               browser_nonce)
+        return '.'.join([timestamp, nonce, signature])
+
+    def verify(self, request, provider_name):
+        """Check the ``state`` received by the callback or raise
+        :class:`~velruse.exceptions.CSRFError`"""
+        req_state = request.GET.get('state') or ''
+        try:
+            timestamp, nonce, signature = req_state.split('.')
+            age = time.time() - int(timestamp)
+        except ValueError:
+            raise CSRFError(
+                'CSRF Validation check failed. Malformed request state '
+                '{req_state}'.format(req_state=req_state))
+        browser_nonce = request.cookies.get(self.cookie_name)
+        if not browser_nonce:
+            raise CSRFError(
+                'CSRF Validation check failed. Missing the {name} cookie '
+                'for request state {req_state}'.format(
+                    name=self.cookie_name, req_state=req_state))
+        expected = self._sign(provider_name, timestamp, nonce, browser_nonce)
+        if not compare_digest(expected, signature):
+            raise CSRFError(
+                'CSRF Validation check failed. Invalid signature for '
+                'request state {req_state}'.format(req_state=req_state))
+        if not -60 <= age <= self.max_age:
+            raise CSRFError(
+                'CSRF Validation check failed. Request state {req_state} '
+                'has expired'.format(req_state=req_state))
+
+    # the state is accepted more than once, duplicates are checked alike
+    verify_duplicate = verify
+
+    def browser_key(self, request):
+        """Return the random value of the browser's ``cookie_name`` cookie,
+        or `None`"""
+        return request.cookies.get(self.cookie_name)
+
+
+def state_manager_from_settings(settings, prefix=''):
+    """Return a :class:`SignedState` if ``<prefix>state_secret`` is set,
+    otherwise `None`.
+
+    ``<prefix>state_max_age`` sets how many seconds a signed ``state``
+    remains valid.
+    """
+    secret = settings.get(prefix + 'state_secret')
+    if not secret:
+        return None
+    max_age = int(settings.get(prefix + 'state_max_age', DEFAULT_MAX_AGE))
+    return SignedState(secret, max_age=max_age)
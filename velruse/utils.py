@@ -1,6 +1,23 @@
 """Utilities for the auth functionality"""
+import re
+
+from .compat import STRING_TYPES
 from .compat import urlencode
 
 def flat_url(url, **kw):
     """Creates a URL with the query param encoded"""
     return url + '?' + urlencode(kw)
+
+def field_list(fields, required=()):
+    """Join the fields to request from a provider API with commas.
+
+    ``fields`` is a list or a string of fields separated by commas or
+    whitespace. The ``required`` fields are prepended if missing.
+    """
+    if isinstance(fields, STRING_TYPES):
+        fields = re.split(r'[\s,]+', fields)
+    result = [f for f in required if f not in fields]
+    for f in fields:
+        if f and f not in result:
+            result.append(f)
+    return ','.join(result)